@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: result cache
+#Author: Martin Borek
+
+'''Time of xqr.py runs of an ORDER BY query over a generated catalog
+without --cache, with an empty cache directory (results are stored)
+and with the results already cached (input is not parsed).
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+from common import temp_catalog, best_of
+
+ITEMS = 200000
+QUERY = 'SELECT item FROM catalog WHERE price > 900 ORDER BY price DESC'
+XQR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "xqr.py")
+
+
+def main():
+    path = temp_catalog(ITEMS)
+    directory = tempfile.mkdtemp()
+    try:
+        def run(*args):
+            subprocess.check_call([sys.executable, XQR, "--input=" + path,
+                                   "--query=" + QUERY,
+                                   "--output=" + os.devnull] + list(args))
+
+        def miss():
+            shutil.rmtree(directory)
+            run("--cache=" + directory)
+
+        print("%d items, %.1f MB" % (ITEMS,
+                                     os.path.getsize(path) / (1024 * 1024)))
+        print("%-16s %10s" % ("", "time [ms]"))
+        print("%-16s %10.1f" % ("no cache", best_of(run) * 1000))
+        print("%-16s %10.1f" % ("cache miss", best_of(miss) * 1000))
+        print("%-16s %10.1f" % ("cache hit", best_of(
+            lambda: run("--cache=" + directory)) * 1000))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
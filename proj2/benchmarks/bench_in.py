@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: IN lists and OR-chains
+#Author: Martin Borek
+
+'''Time of WHERE conditions "id = 1 OR id = 2 OR ..." and "id IN (1, 2,
+...)" of growing length over all <item> elements of a generated catalog.
+Both are evaluated as one set lookup, so the time should not grow with
+the number of literals.
+'''
+
+import os
+import xml.etree.ElementTree as ET
+
+from common import xqr, temp_catalog, best_of
+
+ITEMS = 50000
+LENGTHS = (1, 10, 100, 1000, 5000)
+
+
+def main():
+    path = temp_catalog(ITEMS)
+    try:
+        items = ET.parse(path).getroot().findall(".//item")
+    finally:
+        os.remove(path)
+
+    def run(text):
+        match = xqr.Query.prepare("SELECT item FROM catalog WHERE " +
+                                  text).predicate()
+        return best_of(lambda: [el for el in items if match(el)])
+
+    print("%8s %14s %14s" % ("literals", "OR-chain [ms]", "IN [ms]"))
+    for length in LENGTHS:
+        literals = [str(i * 7) for i in range(length)]
+        chain = " OR ".join("item.id = " + literal for literal in literals)
+        in_list = "item.id IN (" + ", ".join(literals) + ")"
+        print("%8d %14.1f %14.1f" % (length, run(chain) * 1000,
+                                     run(in_list) * 1000))
+
+
+if __name__ == "__main__":
+    main()
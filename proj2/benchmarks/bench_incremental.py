@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: incremental evaluation
+#Author: Martin Borek
+
+'''Time of evaluating an ORDER BY query over a generated catalog as
+a whole and incrementally (IncrementalQuery, --state) after records
+were appended to it.
+'''
+
+import os
+import time
+
+from common import xqr, write_catalog, temp_catalog
+
+ITEMS = 200000
+APPENDED = 2000
+QUERY = ('SELECT item LIMIT 100 FROM catalog WHERE price > 500 '
+         'ORDER BY price ASC')
+
+
+def append(path, items, first):
+    '''Appends items <item> records before </catalog>.'''
+
+    part = path + ".part"
+    write_catalog(part, items, seed=first)
+    with open(part, encoding="utf-8") as f:
+        records = f.read().split("<catalog>\n", 1)[1]
+    os.remove(part)
+    with open(path, "r+", encoding="utf-8") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(f.tell() - len("</catalog>\n"))
+        f.write(records)
+
+
+def main():
+    path = temp_catalog(ITEMS)
+    try:
+        query = xqr.Query.prepare(QUERY)
+        incremental = xqr.IncrementalQuery(path, query)
+        start = time.perf_counter()
+        incremental.update()
+        first = time.perf_counter() - start
+
+        append(path, APPENDED, ITEMS)
+        start = time.perf_counter()
+        incremental.update()
+        update = time.perf_counter() - start
+
+        whole = xqr.IncrementalQuery(path, xqr.Query.prepare(QUERY))
+        start = time.perf_counter()
+        whole.update()
+        again = time.perf_counter() - start
+        assert ([xqr.ET.tostring(el) for el in whole.elements] ==
+                [xqr.ET.tostring(el) for el in incremental.elements])
+
+        print("%d items, %d appended" % (ITEMS, APPENDED))
+        print("%-24s %10s" % ("", "time [ms]"))
+        print("%-24s %10.1f" % ("first evaluation", first * 1000))
+        print("%-24s %10.1f" % ("after append, whole", again * 1000))
+        print("%-24s %10.1f" % ("after append, increment", update * 1000))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
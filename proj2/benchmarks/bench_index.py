@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: value indexes
+#Author: Martin Borek
+
+'''Compares queries over a parsed document without and with value indexes
+(Document.create_index).
+'''
+
+import os
+
+from common import xqr, temp_catalog, best_of
+
+ITEMS = 200000
+QUERIES = [
+    'SELECT item FROM catalog WHERE .id = 123456',
+    'SELECT item FROM catalog WHERE price > 995',
+    'SELECT item FROM catalog WHERE price < 3 AND .cat = "c2"',
+    'SELECT item FROM catalog WHERE sku CONTAINS "A12"',
+]
+
+
+def main():
+    path = temp_catalog(ITEMS)
+    try:
+        document = xqr.Document.load(path)
+    finally:
+        os.remove(path)
+
+    scan = {}
+    for text in QUERIES:
+        query = xqr.Query.prepare(text)
+        scan[text] = best_of(lambda: list(document.execute(query)))
+
+    build = best_of(lambda: [
+        document.create_index("item", ".id"),
+        document.create_index("item", "price"),
+        document.create_index("item", "sku", ("equal", "contains")),
+    ], repeat=1)
+    print("indexes built in %.1f ms" % (build * 1000))
+
+    print("%-58s %10s %10s" % ("query", "scan [ms]", "index [ms]"))
+    for text in QUERIES:
+        query = xqr.Query.prepare(text)
+        indexed = best_of(lambda: list(document.execute(query)))
+        print("%-58s %10.1f %10.2f" % (text, scan[text] * 1000,
+                                       indexed * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: input reading modes
+#Author: Martin Borek
+
+'''Expat throughput and peak RSS of reading the input as UTF-8 text
+(the original way), through InputReader over a memory-mapped file and
+through InputReader over a pipe. Every mode runs in its own process,
+so the RSS values are not affected by each other.
+'''
+
+import os
+import sys
+import time
+import resource
+import subprocess
+import xml.parsers.expat
+
+from common import xqr, temp_catalog
+
+ITEMS = 600000
+MODES = ("text", "mmap", "pipe")
+
+
+def feed(xml_input):
+    '''Feeds whole xml_input to expat (without building a tree, so
+    the reading itself is measured).'''
+
+    parser = xml.parsers.expat.ParserCreate()
+    while True:
+        data = xml_input.read(64 * 1024)
+        if not data:
+            break
+        parser.Parse(data, False)
+    parser.Parse(b"", True)
+
+
+def parse(mode, path):
+    '''Parses path in given mode, returns elapsed seconds.'''
+
+    start = time.perf_counter()
+    if mode == "text":
+        with open(path, "r", encoding="utf-8") as xml_input:
+            feed(xml_input)
+    elif mode == "mmap":
+        xml_input = xqr.InputReader.open(path)
+        assert xml_input.mapped
+        try:
+            feed(xml_input)
+        finally:
+            xml_input.close()
+    else:
+        cat = subprocess.Popen(["cat", path], stdout=subprocess.PIPE)
+        xml_input = xqr.InputReader(cat.stdout)
+        try:
+            feed(xml_input)
+        finally:
+            xml_input.close()
+            cat.wait()
+    return time.perf_counter() - start
+
+
+def main():
+    if len(sys.argv) == 3: # child process
+        elapsed = parse(sys.argv[1], sys.argv[2])
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print("%f %d" % (elapsed, rss))
+        return
+
+    path = temp_catalog(ITEMS)
+    try:
+        size = os.path.getsize(path) / (1024 * 1024)
+        print("%d items, %.1f MB" % (ITEMS, size))
+        print("%6s %10s %8s %10s" % ("mode", "time [ms]", "MB/s",
+                                     "RSS [MB]"))
+        for mode in MODES:
+            best = None
+            for _ in range(3):
+                out = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), mode, path])
+                elapsed, rss = out.split()
+                if best is None or float(elapsed) < best[0]:
+                    best = (float(elapsed), int(rss))
+            print("%6s %10.1f %8.1f %10.1f" % (mode, best[0] * 1000,
+                                               size / best[0],
+                                               best[1] / 1024))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
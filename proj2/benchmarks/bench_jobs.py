@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: parallel WHERE evaluation
+#Author: Martin Borek
+
+'''Time of evaluating a complex WHERE clause over a parsed catalog with
+different number of worker processes (XMLParser jobs, --jobs).
+'''
+
+import os
+import xml.etree.ElementTree as ET
+
+from common import xqr, temp_catalog, best_of
+
+ITEMS = 300000
+QUERY = ('SELECT item FROM catalog WHERE (price > 900 OR price < 50) AND '
+         'NOT .cat = "c3" AND (name CONTAINS "1" OR sku CONTAINS "2")')
+
+
+def main():
+    path = temp_catalog(ITEMS)
+    try:
+        root = ET.parse(path).getroot()
+    finally:
+        os.remove(path)
+    query = xqr.Query.prepare(QUERY)
+
+    def run(jobs):
+        parser = xqr.XMLParser(None, jobs=jobs)
+        parser.find_in(root, query)
+        return list(parser.results())
+
+    jobs_list = [1]
+    while jobs_list[-1] * 2 <= (os.cpu_count() or 1):
+        jobs_list.append(jobs_list[-1] * 2)
+
+    print("%d items, %d CPUs" % (ITEMS, os.cpu_count() or 1))
+    print("%6s %10s %8s" % ("jobs", "time [ms]", "speedup"))
+    serial = None
+    for jobs in jobs_list:
+        elapsed = best_of(lambda: run(jobs))
+        if serial is None:
+            serial = elapsed
+        print("%6d %10.1f %7.2fx" % (jobs, elapsed * 1000, serial / elapsed))
+
+
+if __name__ == "__main__":
+    main()
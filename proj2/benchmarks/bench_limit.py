@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: LIMIT without ORDER BY
+#Author: Martin Borek
+
+'''Latency of "SELECT item LIMIT 10 FROM catalog" for growing documents.
+With --stream reading stops after the 10th match, so the time should stay
+flat; the default mode still has to parse whole document.
+'''
+
+import os
+
+from common import temp_catalog, run_query, best_of
+
+QUERY = "SELECT item LIMIT 10 FROM catalog"
+SIZES = [10000, 100000, 1000000]
+
+
+def main():
+    print("%10s %12s %12s" % ("items", "tree [ms]", "stream [ms]"))
+    for size in SIZES:
+        path = temp_catalog(size)
+        try:
+            tree = best_of(lambda: run_query(path, QUERY))
+            stream = best_of(lambda: run_query(path, QUERY, stream=True))
+        finally:
+            os.remove(path)
+        print("%10d %12.1f %12.1f" % (size, tree * 1000, stream * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: memory of query objects
+#Author: Martin Borek
+
+'''Memory (tracemalloc) allocated for a parsed query with a long generated
+WHERE clause, for many small parsed queries and for SortObjects created
+by ORDER BY of a large result.
+'''
+
+import tracemalloc
+
+from common import xqr
+
+TERMS = 5000
+QUERIES = 10000
+RESULTS = 200000
+
+
+def traced(func):
+    '''Memory (bytes) allocated by func and still referenced by its
+    result.'''
+
+    tracemalloc.start()
+    try:
+        result = func()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    where = " OR ".join('(id = %d AND NOT name CONTAINS "x")' % i
+                        for i in range(TERMS))
+
+    def long_query():
+        query = xqr.Query("SELECT item FROM catalog WHERE " + where)
+        query.parse()
+        return query
+
+    def small_queries():
+        queries = [xqr.Query("SELECT a FROM b WHERE c = 1")
+                   for _ in range(QUERIES)]
+        for query in queries:
+            query.parse()
+        return queries
+
+    def sort_objects():
+        return [xqr.SortObject(None, float(i)) for i in range(RESULTS)]
+
+    print("%-32s %10s" % ("", "size [KB]"))
+    print("%-32s %10.0f" % ("query with %d OR terms" % TERMS,
+                            traced(long_query) / 1024))
+    print("%-32s %10.0f" % ("%d small queries" % QUERIES,
+                            traced(small_queries) / 1024))
+    print("%-32s %10.0f" % ("%d SortObjects" % RESULTS,
+                            traced(sort_objects) / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: many queries over one document
+#Author: Martin Borek
+
+'''Compares executing a batch of queries one by one (Document.execute)
+and in a single traversal (QuerySet) over a generated catalog.
+'''
+
+import os
+
+from common import xqr, temp_catalog, best_of
+
+ITEMS = 100000
+QUERIES = [
+    'SELECT item FROM catalog WHERE price > %d' % (i * 25) for i in range(20)
+] + [
+    'SELECT name FROM catalog WHERE name = "n%d"' % i for i in range(10)
+] + [
+    'SELECT item FROM catalog WHERE .cat = "c%d" AND price < 500' % (i % 7)
+    for i in range(10)
+]
+
+
+def main():
+    path = temp_catalog(ITEMS)
+    try:
+        document = xqr.Document.load(path)
+    finally:
+        os.remove(path)
+    queries = [xqr.Query.prepare(text) for text in QUERIES]
+
+    single = best_of(lambda: [list(document.execute(query))
+                              for query in queries])
+    one_pass = best_of(lambda: xqr.QuerySet(queries).find(document.root))
+    traversal = best_of(lambda: sum(1 for el in document.root.iter()))
+
+    print("%d queries over %d items" % (len(queries), ITEMS))
+    print("%-24s %10.1f ms" % ("one by one", single * 1000))
+    print("%-24s %10.1f ms" % ("single traversal", one_pass * 1000))
+    print("%-24s %10.1f ms" % ("(bare root.iter())", traversal * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: query server
+#Author: Martin Borek
+
+'''Latency of small queries over a generated catalog executed by a new
+xqr.py process for each query and by a running query server (--serve)
+with the document kept parsed in memory.
+'''
+
+import os
+import sys
+import time
+import socket
+import subprocess
+import urllib.parse
+import urllib.request
+
+from common import temp_catalog, percentile
+
+ITEMS = 20000
+REQUESTS = 200
+QUERY = 'SELECT item LIMIT 5 FROM catalog WHERE sku = "A5" AND price > 900'
+XQR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "xqr.py")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def report(name, latencies):
+    print("%-16s %10.1f %10.1f %10.1f" % (
+        name, percentile(latencies, 50) * 1000,
+        percentile(latencies, 99) * 1000, len(latencies) / sum(latencies)))
+
+
+def main():
+    path = temp_catalog(ITEMS)
+    port = free_port()
+    server = subprocess.Popen([sys.executable, XQR, "--serve=%d" % port],
+                              cwd=os.path.dirname(path))
+    try:
+        url = "http://127.0.0.1:%d/query?%s" % (port, urllib.parse.urlencode(
+            {"document": os.path.basename(path), "query": QUERY}))
+        for _ in range(50): # wait for the server
+            try:
+                urllib.request.urlopen(url).read()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        print("%d items, %d requests" % (ITEMS, REQUESTS))
+        print("%-16s %10s %10s %10s" % ("", "p50 [ms]", "p99 [ms]",
+                                        "queries/s"))
+        latencies = []
+        for _ in range(REQUESTS // 10):
+            start = time.perf_counter()
+            subprocess.check_output([sys.executable, XQR, "--input=" + path,
+                                     "--query=" + QUERY])
+            latencies.append(time.perf_counter() - start)
+        report("process", latencies)
+
+        latencies = []
+        for _ in range(REQUESTS):
+            start = time.perf_counter()
+            urllib.request.urlopen(url).read()
+            latencies.append(time.perf_counter() - start)
+        report("server", latencies)
+    finally:
+        server.terminate()
+        server.wait()
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
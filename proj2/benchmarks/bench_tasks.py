@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: many small input files
+#Author: Martin Borek
+
+'''Time of executing one query over each of many small generated catalogs
+one by one and by TaskRunner (--tasks) with different number of worker
+processes.
+'''
+
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+
+from common import xqr, write_catalog, best_of
+
+FILES = 400
+ITEMS = 500
+QUERY = 'SELECT item FROM catalog WHERE price > 900 ORDER BY price DESC'
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(directory, "c%d.xml" % i) for i in range(FILES)]
+        for seed, path in enumerate(paths):
+            write_catalog(path, ITEMS, seed)
+
+        def sequential():
+            for path in paths:
+                xqr.TaskRunner._query(xqr.TaskRunner._read(path), QUERY,
+                                      None, True)
+
+        def concurrent(jobs):
+            async def consume():
+                runner = xqr.TaskRunner(jobs)
+                tasks = (xqr.Task(path, QUERY) for path in paths)
+                async for task in runner.results(tasks):
+                    assert task.error is None
+            asyncio.run(consume())
+
+        print("%d files, %d items each, %d CPUs" % (FILES, ITEMS,
+                                                   os.cpu_count() or 1))
+        print("%-16s %10s" % ("", "time [ms]"))
+        print("%-16s %10.1f" % ("one by one", best_of(sequential) * 1000))
+        jobs = 1
+        while jobs <= (os.cpu_count() or 1):
+            print("%-16s %10.1f" % ("tasks, %d jobs" % jobs,
+                                    best_of(lambda: concurrent(jobs)) * 1000))
+            jobs *= 2
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
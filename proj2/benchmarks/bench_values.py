@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: typed value cache
+#Author: Martin Borek
+
+'''Time of queries using the same element in several WHERE leaves and
+in ORDER BY over a parsed catalog. Such elements are located and
+converted to float once per candidate (ValueCache).
+'''
+
+import os
+import xml.etree.ElementTree as ET
+
+from common import xqr, temp_catalog, best_of
+
+ITEMS = 300000
+QUERIES = (
+    'SELECT item FROM catalog WHERE price > 100 AND price < 900',
+    'SELECT item FROM catalog WHERE price > 100 AND price < 900 '
+    'ORDER BY price ASC',
+    'SELECT item FROM catalog WHERE (price < 100 OR price > 900) AND '
+    'NOT price = 500 ORDER BY price DESC',
+    'SELECT item FROM catalog WHERE name CONTAINS "1" OR name = "n2" '
+    'OR name = "n3" ORDER BY name ASC',
+)
+
+
+def main():
+    path = temp_catalog(ITEMS)
+    try:
+        root = ET.parse(path).getroot()
+    finally:
+        os.remove(path)
+
+    def run(text):
+        query = xqr.Query.prepare(text)
+        parser = xqr.XMLParser(None)
+        parser.find_in(root, query)
+        parser.restore()
+
+    print("%d items" % ITEMS)
+    print("%10s  %s" % ("time [ms]", "query"))
+    for text in QUERIES:
+        print("%10.1f  %s" % (best_of(lambda: run(text), 5) * 1000, text))
+
+
+if __name__ == "__main__":
+    main()
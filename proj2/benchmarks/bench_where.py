@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+#XQR benchmark: WHERE evaluation
+#Author: Martin Borek
+
+'''Compares evaluation of WHERE conditions by the interpreter
+(XMLParser._where) and by compiled functions (WhereCompiler) over
+all <item> elements of a generated catalog.
+'''
+
+import os
+import xml.etree.ElementTree as ET
+
+from common import xqr, temp_catalog, best_of
+
+ITEMS = 50000
+CONDITIONS = [
+    'price > 500',
+    '.cat = "c3"',
+    'name CONTAINS "1"',
+    'price > 500 AND .cat = "c3"',
+    'NOT (price < 100 OR price > 900) AND sku = "A5"',
+]
+
+
+def main():
+    path = temp_catalog(ITEMS)
+    try:
+        items = ET.parse(path).getroot().findall(".//item")
+    finally:
+        os.remove(path)
+    parser = xqr.XMLParser(None)
+
+    print("%-48s %12s %12s %8s" % ("condition", "interp [ms]",
+                                    "compiled [ms]", "speedup"))
+    for text in CONDITIONS:
+        query = xqr.Query("SELECT item FROM catalog WHERE " + text)
+        query.parse()
+        condition = query.where
+        function = xqr.WhereCompiler().compile(condition)
+
+        interp = best_of(lambda: [el for el in items
+                                  if parser._where(el, condition)])
+        compiled = best_of(lambda: [el for el in items if function(el)])
+        print("%-48s %12.1f %12.1f %7.1fx" % (text, interp * 1000,
+                                              compiled * 1000,
+                                              interp / compiled))
+
+
+if __name__ == "__main__":
+    main()
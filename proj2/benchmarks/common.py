@@ -0,0 +1,113 @@
+#XQR benchmarks - shared helpers
+#Author: Martin Borek
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+# Make xqr.py importable from the benchmarks directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xqr
+
+
+def write_catalog(path, items, seed=1):
+    '''Writes a flat <catalog> document with items <item> elements.
+    Values are generated by a seeded random generator, so the same
+    arguments give the same document.
+    '''
+
+    rnd = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<catalog>\n')
+        for i in range(items):
+            f.write('<item id="%d" cat="c%d"><name>n%d</name>'
+                    '<price>%d</price><sku>A%d</sku></item>\n'
+                    % (i, i % 7, rnd.randint(0, 50), rnd.randint(0, 1000),
+                       i % 13))
+        f.write('</catalog>\n')
+
+
+def write_document(path, items, depth=2, fanout=10, attributes=2, seed=1):
+    '''Writes a <catalog> document with items <item> elements nested in
+    depth levels of <group> elements, each group has at most fanout
+    children (groups or items), catalog as many groups as needed.
+    Every item has attributes id, cat and attributes more (a0, a1, ...)
+    and subelements name, price and sku (the same as in write_catalog).
+    Values are generated by a seeded
+    random generator, so the same arguments give the same document.
+    '''
+
+    rnd = random.Random(seed)
+    groups = [] # indexes of open groups, outermost first
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<catalog>\n')
+        for i in range(items):
+            position = [i // fanout ** level for level in range(depth, 0, -1)]
+            common = 0
+            while (common < len(groups) and
+                    groups[common] == position[common]):
+                common += 1
+            for _ in range(len(groups) - common):
+                f.write('</group>\n')
+            del groups[common:]
+            for level in range(common, depth):
+                f.write('<group id="g%d" level="%d">\n'
+                        % (position[level], level))
+                groups.append(position[level])
+            extra = "".join(' a%d="v%d"' % (a, rnd.randint(0, 99))
+                            for a in range(attributes))
+            f.write('<item id="%d" cat="c%d"%s><name>n%d</name>'
+                    '<price>%d</price><sku>A%d</sku></item>\n'
+                    % (i, i % 7, extra, rnd.randint(0, 50),
+                       rnd.randint(0, 1000), i % 13))
+        f.write('</group>\n' * len(groups))
+        f.write('</catalog>\n')
+
+
+def temp_catalog(items, seed=1):
+    '''Creates a catalog (see write_catalog) in a temporary file
+    and returns its path. Caller removes the file.
+    '''
+
+    fd, path = tempfile.mkstemp(suffix=".xml")
+    os.close(fd)
+    write_catalog(path, items, seed)
+    return path
+
+
+def run_query(path, text, stream=False):
+    '''Runs query given by text over file path, returns list of results.'''
+
+    query = xqr.Query(text)
+    query.parse()
+    xml_input = xqr.InputReader.open(path)
+    try:
+        parser = xqr.XMLParser(xml_input, stream)
+        parser.find(query)
+        return list(parser.results())
+    finally:
+        xml_input.close()
+
+
+def percentile(values, percent):
+    '''Nearest-rank percentile of a non-empty list of values.'''
+
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def best_of(func, repeat=3):
+    '''Best wall time (seconds) of repeat calls of func.'''
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
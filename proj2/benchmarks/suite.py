@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+#XQR benchmark suite
+#Author: Martin Borek
+
+'''Runs a fixed set of representative queries over a generated document
+(see common.write_document) and records latency percentiles, throughput
+and peak RSS of every query to JSON. With --baseline the results are
+compared with a stored JSON of a previous run and the suite fails
+(exit code 1) if a query got slower or bigger than --tolerance allows.
+
+Every query runs in its own process (the whole pipeline of xqr.main:
+query preparation, parsing, evaluation, sorting and writing to
+/dev/null), so peak RSS of one query doesn't include the others.
+
+    ./suite.py --json=base.json
+    (change xqr.py)
+    ./suite.py --baseline=base.json
+
+baseline.json next to this file are results of the default run
+(./suite.py --json=baseline.json) of the current xqr.py. Numbers of
+results are compared exactly; times and RSS depend on the machine, so
+measure your own base.json before a change and compare with it. Update
+baseline.json (same command) when a change makes queries faster or
+slower on purpose.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+from collections import OrderedDict
+
+from common import xqr, write_document, percentile
+
+# name, query, [--root, --stream]
+QUERIES = [
+    ("limit", "SELECT item LIMIT 10 FROM catalog", None, False),
+    ("from_attribute", "SELECT item FROM group.level WHERE price > 500",
+     None, False),
+    ("nested_logic", 'SELECT item FROM catalog WHERE (price > 900 OR '
+     'price < 50) AND NOT (.cat = "c3" OR name CONTAINS "7")', None, False),
+    ("contains", 'SELECT item FROM catalog WHERE name CONTAINS "12"',
+     None, False),
+    ("order_asc", "SELECT item FROM catalog WHERE price > 800 "
+     "ORDER BY price ASC", None, False),
+    ("order_desc", 'SELECT item FROM catalog WHERE .cat = "c1" '
+     'ORDER BY name DESC', None, False),
+    ("root", 'SELECT sku FROM catalog WHERE sku = "A5"', "results", False),
+    ("stream", 'SELECT item FROM catalog WHERE price < 10', "results", True),
+]
+PERCENTILES = (50, 90, 99)
+
+
+def run(path, text, root, stream):
+    '''Runs query like xqr.main, returns number of results.'''
+
+    query = xqr.Query.prepare(text)
+    xml_input = xqr.InputReader.open(path)
+    try:
+        with open(os.devnull, "wb") as output:
+            parser = xqr.XMLParser(xml_input, stream)
+            parser.find(query)
+            return parser.write(output, root)
+    finally:
+        xml_input.close()
+
+
+def child(path, name, repeat):
+    '''Runs query name repeat times, prints its latencies and peak RSS.'''
+
+    for query_name, text, root, stream in QUERIES:
+        if query_name == name:
+            break
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = run(path, text, root, stream)
+        latencies.append(time.perf_counter() - start)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"latencies": latencies, "results": results,
+                      "peak_rss_kb": rss}))
+
+
+def measure(path, name, repeat):
+    '''Measures query name in a child process, returns its results.'''
+
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                   "--child", path, name, str(repeat)])
+    child_result = json.loads(out.decode("utf-8"))
+    latencies = child_result["latencies"]
+    size = os.path.getsize(path) / (1024 * 1024)
+    median = percentile(latencies, 50)
+    latency = OrderedDict([("min", min(latencies) * 1000)])
+    for percent in PERCENTILES:
+        latency["p%d" % percent] = percentile(latencies, percent) * 1000
+    latency["max"] = max(latencies) * 1000
+    return OrderedDict([
+        ("results", child_result["results"]),
+        ("latency_ms", latency),
+        ("throughput_mb_s", size / median),
+        ("peak_rss_kb", child_result["peak_rss_kb"]),
+    ])
+
+
+def run_suite(path, document, names, repeat):
+    '''Measures queries names over document in file path.'''
+
+    current = OrderedDict([
+        ("document", document),
+        ("python", platform.python_version()),
+        ("repeat", repeat),
+        ("queries", OrderedDict()),
+    ])
+    print("%d items, %.1f MB, %d runs per query" % (
+        document["items"], document["bytes"] / (1024 * 1024), repeat))
+    print("%-16s %8s %10s %10s %10s %8s %10s" % (
+        "query", "results", "p50 [ms]", "p90 [ms]", "p99 [ms]", "MB/s",
+        "RSS [KB]"))
+    for name in names:
+        result = measure(path, name, repeat)
+        current["queries"][name] = result
+        latency = result["latency_ms"]
+        print("%-16s %8d %10.1f %10.1f %10.1f %8.1f %10d" % (
+            name, result["results"], latency["p50"], latency["p90"],
+            latency["p99"], result["throughput_mb_s"],
+            result["peak_rss_kb"]))
+    return current
+
+
+def compare(current, baseline, tolerance):
+    '''Prints comparison of current results with baseline, returns names
+    of regressed queries.'''
+
+    if current["document"] != baseline["document"]:
+        print("warning: baseline was measured on a different document")
+    regressions = []
+    print("%-16s %12s %12s %8s %12s %12s %8s" % (
+        "query", "p50 [ms]", "base [ms]", "ratio",
+        "RSS [KB]", "base [KB]", "ratio"))
+    for name, result in current["queries"].items():
+        base = baseline["queries"].get(name)
+        if base is None:
+            print("%-16s (not in baseline)" % name)
+            continue
+        time_ratio = (result["latency_ms"]["p50"] /
+                      base["latency_ms"]["p50"])
+        rss_ratio = result["peak_rss_kb"] / base["peak_rss_kb"]
+        regressed = (time_ratio > 1 + tolerance or
+                     rss_ratio > 1 + tolerance or
+                     result["results"] != base["results"])
+        if regressed:
+            regressions.append(name)
+        print("%-16s %12.1f %12.1f %7.2fx %12d %12d %7.2fx%s" % (
+            name, result["latency_ms"]["p50"], base["latency_ms"]["p50"],
+            time_ratio, result["peak_rss_kb"], base["peak_rss_kb"],
+            rss_ratio, "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--child": # child process
+        child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        return
+
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arg_parser.add_argument("--items", type=int, default=100000)
+    arg_parser.add_argument("--depth", type=int, default=2)
+    arg_parser.add_argument("--fanout", type=int, default=20)
+    arg_parser.add_argument("--attributes", type=int, default=2)
+    arg_parser.add_argument("--seed", type=int, default=1)
+    arg_parser.add_argument("--repeat", type=int, default=10)
+    arg_parser.add_argument("--query", action="append",
+                            help="run only given queries")
+    arg_parser.add_argument("--json", help="write results to file")
+    arg_parser.add_argument("--baseline", help="compare with results file")
+    arg_parser.add_argument("--tolerance", type=float, default=0.1,
+                            help="allowed slowdown (0.1 is 10 %%)")
+    args = arg_parser.parse_args()
+    if args.depth < 1:
+        arg_parser.error("--depth must be at least 1 (FROM group.level)")
+
+    names = [name for name, text, root, stream in QUERIES]
+    for name in args.query or ():
+        if name not in names:
+            arg_parser.error("unknown query %s, one of: %s"
+                             % (name, ", ".join(names)))
+    if args.query:
+        names = [name for name in names if name in args.query]
+
+    document = OrderedDict([
+        ("items", args.items), ("depth", args.depth),
+        ("fanout", args.fanout), ("attributes", args.attributes),
+        ("seed", args.seed),
+    ])
+    fd, path = tempfile.mkstemp(suffix=".xml")
+    os.close(fd)
+    try:
+        write_document(path, args.items, args.depth, args.fanout,
+                       args.attributes, args.seed)
+        document["bytes"] = os.path.getsize(path)
+        current = run_suite(path, document, names, args.repeat)
+    finally:
+        os.remove(path)
+
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2)
+            f.write("\n")
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print()
+        if compare(current, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
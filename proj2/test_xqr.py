@@ -0,0 +1,787 @@
+#!/usr/bin/env python3
+
+#XQR: regression tests
+#Author: Martin Borek
+
+'''Behavioural tests of xqr.py - every mode of execution (--stream,
+--jobs, --cache, --state, --batch, --tasks, query server) must give
+the same output as the plain serial run.
+
+    python -m pytest -q
+'''
+
+import io
+import os
+import sys
+import time
+import socket
+import subprocess
+import http.client
+import urllib.parse
+
+import pytest
+
+import xqr
+
+XQR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xqr.py")
+
+LIBRARY = '''<?xml version="1.0" encoding="utf-8"?>
+<library>
+  <book id="1" lang="cs"><title>Babicka</title><price>120</price>
+    <author>Nemcova</author></book>
+  <book id="2" lang="en"><title>Dune</title><price>350</price>
+    <author>Herbert</author></book>
+  <book id="3"><title>Krakatit</title><price>99.5</price>
+    <author>Capek</author></book>
+  <book id="4" lang="cs"><title>R.U.R.</title><price>350</price>
+    <author>Capek</author></book>
+  <magazine id="5"><title>Vesmir</title><price>80</price></magazine>
+</library>
+'''
+
+QUERIES = [
+    'SELECT book FROM library',
+    'SELECT book FROM library WHERE price > 100',
+    'SELECT book FROM library WHERE author = "Capek" OR .lang = "en"',
+    'SELECT book FROM library WHERE NOT price < 200 AND title CONTAINS "u"',
+    'SELECT book LIMIT 2 FROM library WHERE .id > 1',
+    'SELECT book FROM library ORDER BY price ASC',
+    'SELECT book LIMIT 3 FROM library ORDER BY price DESC',
+    'SELECT title FROM ROOT WHERE title CONTAINS "a"',
+    'SELECT price FROM book',
+    'SELECT magazine FROM library WHERE price IN (80, 90)',
+]
+
+
+def run(*args, cwd=None):
+    '''Runs xqr.py with args, returns (exit code, stdout).'''
+
+    process = subprocess.run([sys.executable, XQR] + list(args), cwd=cwd,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return process.returncode, process.stdout
+
+
+@pytest.fixture
+def library(tmp_path):
+    path = tmp_path / "library.xml"
+    path.write_text(LIBRARY, encoding="utf-8")
+    return str(path)
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_stream_matches_serial(library, query):
+    expected = run("--input=" + library, "--query=" + query)
+    assert expected[0] == 0
+    assert run("--input=" + library, "--query=" + query,
+               "--stream") == expected
+
+
+def test_stream_writes_results_before_error(tmp_path):
+    path = tmp_path / "broken.xml"
+    path.write_text('<library><book id="1"/><book id="2"/><book>',
+                    encoding="utf-8")
+    query = "--query=SELECT book FROM library"
+    assert run("--input=" + str(path), query) == (4, b"")
+    code, output = run("--input=" + str(path), query, "--stream")
+    assert code == 4
+    assert output.endswith(b'<book id="1" />') # tail of 2 is not known yet
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_jobs_match_serial(library, query):
+    expected = run("--input=" + library, "--query=" + query)
+    assert run("--input=" + library, "--query=" + query,
+               "--jobs=2") == expected
+
+
+def test_parallel_matcher_keeps_document_order():
+    root = xqr.ET.fromstring("<r>" + "<v>%d</v>" * 1000 % tuple(
+        (i * 7) % 10 for i in range(1000)) + "</r>")
+    candidates = list(root)
+    match = xqr.Query.prepare("SELECT v FROM r WHERE v > 6").predicate()
+    expected = [element for element in candidates if match(element)]
+    matcher = xqr.ParallelMatcher(2)
+    assert matcher.find(candidates, match) == expected
+    assert matcher.find(candidates, match, 5) == expected[:5]
+
+
+def test_parallel_matcher_raises_format_error():
+    root = xqr.ET.fromstring("<r>" + "<v>1</v>" * 10 + "<v><x/></v></r>")
+    match = xqr.Query.prepare("SELECT v FROM r WHERE v > 6").predicate()
+    with pytest.raises(xqr.FormatError):
+        xqr.ParallelMatcher(2).find(list(root), match)
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_cache_matches_serial(tmp_path, library, query):
+    expected = run("--input=" + library, "--query=" + query)
+    cache = "--cache=" + str(tmp_path / "cache")
+    for _ in range(2): # the second run writes cached results
+        assert run("--input=" + library, "--query=" + query,
+                   cache) == expected
+
+
+def test_cache_keys(tmp_path, library):
+    cache = xqr.ResultCache(str(tmp_path / "cache"))
+    fingerprint = cache.fingerprint(library)
+
+    def key(text, root_element=None, header=True):
+        return cache.key(fingerprint, xqr.Query.prepare(text), root_element,
+                         header)
+
+    query = QUERIES[1]
+    assert key(query) == key(query.replace(" ", "  "))
+    assert len({key(query), key(QUERIES[2]), key(query, "r"),
+                key(query, header=False)}) == 4
+    assert cache.get(key(query)) is None
+    cache.put(key(query), b"<r />")
+    assert xqr.ResultCache(str(tmp_path / "cache")).get(key(query)) == \
+        b"<r />" # stored in the directory
+    os.utime(library, ns=(0, 0))
+    assert cache.fingerprint(library) != fingerprint
+
+
+def test_cache_hit_doesnt_parse_input(tmp_path, library):
+    cache = "--cache=" + str(tmp_path / "cache")
+    expected = run("--input=" + library, "--query=" + QUERIES[1], cache)
+    info = os.stat(library)
+    with open(library, "r+b") as f: # same size and time, broken XML
+        f.write(b"<" * info.st_size)
+    os.utime(library, ns=(info.st_atime_ns, info.st_mtime_ns))
+    assert run("--input=" + library, "--query=" + QUERIES[1],
+               cache) == expected
+    assert run("--input=" + library, "--query=" + QUERIES[1])[0] == 4
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_state_matches_serial(tmp_path, library, query):
+    expected = run("--input=" + library, "--query=" + query)
+    state = "--state=" + str(tmp_path / "state.json")
+    for _ in range(2): # the second run uses the stored state
+        assert run("--input=" + library, "--query=" + query,
+                   state) == expected
+
+
+def test_state_parses_only_appended_records(tmp_path, monkeypatch):
+    path = tmp_path / "log.xml"
+    record = "<r><v>%d</v></r>\n"
+    path.write_text("<root>" + record % 5 + "</root>", encoding="utf-8")
+    parsed = []
+    records = xqr.ChunkedParser.records
+    monkeypatch.setattr(xqr.ChunkedParser, "records", lambda *args: (
+        parsed.append(args[1:]), records(*args))[1])
+    incremental = xqr.IncrementalQuery(
+        str(path), xqr.Query.prepare("SELECT r FROM root WHERE v > 3"))
+    assert incremental.update()
+    assert not incremental.update() # file not changed
+
+    path.write_text("<root>" + record % 5 + record % 1 + record % 9 +
+                    "</root>", encoding="utf-8")
+    assert incremental.update()
+    start = len("<root>" + record % 5)
+    assert parsed == [(6, start), (start, start + 2 * len(record % 1))]
+    assert [element.findtext("v") for element in incremental.elements] == \
+        ["5", "9"]
+
+
+def test_batch_matches_serial(tmp_path, library):
+    batch = tmp_path / "batch.txt"
+    with open(str(batch), "w", encoding="utf-8") as f:
+        for number, query in enumerate(QUERIES):
+            f.write("--query='%s' --output=%s\n" % (
+                query, tmp_path / ("%d.xml" % number)))
+    assert run("--input=" + library, "--batch=" + str(batch))[0] == 0
+    for number, query in enumerate(QUERIES):
+        expected = run("--input=" + library, "--query=" + query)[1]
+        assert (tmp_path / ("%d.xml" % number)).read_bytes() == expected
+
+
+def test_batch_line_options(tmp_path, library):
+    batch = tmp_path / "batch.txt"
+    batch.write_text("# comment\n\n--query='%s' -n --root=r --output=%s\n"
+                     % (QUERIES[1], tmp_path / "1.xml"), encoding="utf-8")
+    assert run("--input=" + library, "--batch=" + str(batch))[0] == 0
+    assert (tmp_path / "1.xml").read_bytes() == run(
+        "--input=" + library, "--query=" + QUERIES[1], "-n", "--root=r")[1]
+
+
+def test_batch_error_names_line(tmp_path, library):
+    batch = tmp_path / "batch.txt"
+    batch.write_text("--query='%s'\n--query='SELECT'\n" % QUERIES[1],
+                     encoding="utf-8")
+    process = subprocess.run([sys.executable, XQR, "--input=" + library,
+                              "--batch=" + str(batch)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert process.returncode == 80
+    assert process.stderr.startswith(b"Query error: Batch file, line 2:")
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_tasks_match_serial(tmp_path, library, jobs):
+    tasks = tmp_path / "tasks.txt"
+    with open(str(tasks), "w", encoding="utf-8") as f:
+        for number, query in enumerate(QUERIES):
+            f.write("--input=%s --query='%s' --output=%s\n" % (
+                library, query, tmp_path / ("%d.xml" % number)))
+    assert run("--tasks=" + str(tasks), "--jobs=" + jobs)[0] == 0
+    for number, query in enumerate(QUERIES):
+        expected = run("--input=" + library, "--query=" + query)[1]
+        assert (tmp_path / ("%d.xml" % number)).read_bytes() == expected
+
+
+def test_failed_task_doesnt_stop_others(tmp_path, library):
+    tasks = tmp_path / "tasks.txt"
+    tasks.write_text("--input=%s --query='%s' --output=%s\n"
+                     "--input=%s --query='%s'\n"
+                     "--input=%s --query='%s' --output=%s\n" % (
+                         library, QUERIES[1], tmp_path / "1.xml",
+                         tmp_path / "missing.xml", QUERIES[1],
+                         library, QUERIES[2], tmp_path / "3.xml"),
+                     encoding="utf-8")
+    process = subprocess.run([sys.executable, XQR, "--tasks=" + str(tasks)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert process.returncode == 2
+    assert process.stderr == (b"Tasks file, line 2: Input error: "
+                              b"Input file couldn't be opened.\n")
+    for number, query in ((1, QUERIES[1]), (3, QUERIES[2])):
+        assert (tmp_path / ("%d.xml" % number)).read_bytes() == run(
+            "--input=" + library, "--query=" + query)[1]
+
+
+@pytest.mark.parametrize("option", ["--help", "--jo=2", "--str", "--expl",
+                                    "--batch=x", "--inp=x.xml"])
+def test_task_rejects_option(tmp_path, library, option):
+    tasks = tmp_path / "tasks.txt"
+    tasks.write_text("--input=%s --query='%s' %s\n"
+                     "--input=%s --query='%s' --output=%s\n" % (
+                         library, QUERIES[1], option,
+                         library, QUERIES[2], tmp_path / "2.xml"),
+                     encoding="utf-8")
+    process = subprocess.run([sys.executable, XQR, "--tasks=" + str(tasks)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert process.returncode == 1
+    assert process.stdout == b""
+    assert process.stderr == (b"Tasks file, line 1: Arguments error: Only "
+                              b"--input, --query, --qf, --output, --level, "
+                              b"-n and --root can be used.\n")
+    assert (tmp_path / "2.xml").read_bytes() == run(
+        "--input=" + library, "--query=" + QUERIES[2])[1]
+
+
+def test_tasks_results_as_completed(library):
+    async def consume():
+        runner = xqr.TaskRunner(pending=2)
+        tasks = [xqr.Task(library, query) for query in QUERIES]
+        return [task async for task in runner.results(iter(tasks))]
+
+    done = xqr.asyncio.run(consume())
+    assert sorted(task.query for task in done) == sorted(QUERIES)
+    for task in done:
+        assert task.error is None
+        assert task.result == run("--input=" + library,
+                                  "--query=" + task.query)[1]
+
+
+def test_server_matches_serial(tmp_path, library, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    server = xqr.QueryServer("0", xqr.DocumentPool())
+    try:
+        for query in QUERIES:
+            expected = run("--input=" + library, "--query=" + query,
+                           "--root=r")[1]
+            assert server.execute({"document": "library.xml",
+                                   "query": query, "root": "r"}) == expected
+    finally:
+        server._server.server_close()
+
+
+def test_server_keeps_documents_and_reports_errors(tmp_path, library,
+                                                   monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    server = xqr.QueryServer("0", xqr.DocumentPool(1))
+    try:
+        for query in QUERIES[:3]:
+            server.execute({"document": "library.xml", "query": query})
+        assert server.pool.stats()["misses"] == 1 # parsed once
+        assert server.pool.stats()["hits"] == 2
+        with pytest.raises(xqr.InputError):
+            server.execute({"document": "../library.xml",
+                            "query": QUERIES[0]})
+        with pytest.raises(xqr.QueryError):
+            server.execute({"document": "library.xml", "query": "SELECT"})
+        try:
+            raise xqr.QueryError("Wrong query.")
+        except xqr.QueryError as e:
+            assert server.describe(e) == (400, 80,
+                                          b"Query error: Wrong query.\n")
+    finally:
+        server._server.server_close()
+
+
+def test_document_not_modified_by_queries(library):
+    document = xqr.Document.load(library)
+    before = xqr.ET.tostring(document.root)
+    query = xqr.Query.prepare(QUERIES[5]) # ORDER BY sets "order"
+    first = [xqr.ET.tostring(element) for element in document.execute(query)]
+    assert b'order="1"' in first[0]
+    assert xqr.ET.tostring(document.root) == before
+    assert [xqr.ET.tostring(element)
+            for element in document.execute(query)] == first
+
+
+def test_document_matches_serial(library):
+    document = xqr.Document.load(library)
+    document.create_index("book", "price")
+    for query in QUERIES:
+        output = io.BytesIO()
+        writer = xqr.ResultWriter(output, "r")
+        for element in document.execute(xqr.Query.prepare(query)):
+            writer.element(element)
+        writer.close()
+        expected = run("--input=" + library, "--query=" + query,
+                       "--root=r")[1]
+        assert output.getvalue() == expected
+
+
+def test_document_index_in_context(tmp_path, monkeypatch):
+    path = tmp_path / "shop.xml"
+    path.write_text('<shop><old><book><price>150</price></book>'
+                    '<book><price>50</price></book></old>'
+                    '<new id="n"><book><price>200</price></book>'
+                    '<book><price>90</price><book><price>300</price></book>'
+                    '</book></new><book><price>400</price></book></shop>',
+                    encoding="utf-8")
+    queries = ["SELECT book FROM new WHERE price > 100",
+               "SELECT book FROM new.id WHERE price < 100",
+               "SELECT book FROM .id WHERE price > 250",
+               "SELECT book FROM old WHERE price > 10 ORDER BY price DESC",
+               "SELECT book FROM shop WHERE price > 100",
+               "SELECT book FROM ROOT WHERE price > 100",
+               "SELECT book FROM missing WHERE price > 100",
+               "SELECT book FROM book WHERE price > 100"]
+    expected = [run("--input=" + str(path), "--query=" + query,
+                    "--root=r")[1] for query in queries]
+
+    def no_scan(self, root, query):
+        raise AssertionError("context scanned")
+
+    document = xqr.Document.load(str(path))
+    document.create_index("book", "price")
+    monkeypatch.setattr(xqr.XMLParser, "candidates", no_scan)
+    for query, output in zip(queries, expected):
+        result = io.BytesIO()
+        writer = xqr.ResultWriter(result, "r")
+        for element in document.execute(xqr.Query.prepare(query)):
+            writer.element(element)
+        writer.close()
+        assert result.getvalue() == output
+
+
+def test_optimizer_keeps_text_condition_after_attribute(tmp_path):
+    # info of the first book has subelements, the baseline never reads it
+    # because meta.k decides the AND first
+    path = tmp_path / "opt.xml"
+    path.write_text('<library>'
+                    '<book id="1"><meta k="aa"/><info><a>1</a></info></book>'
+                    '<book id="2"><meta k="xzzy"/><info>1</info></book>'
+                    '</library>', encoding="utf-8")
+    query = 'SELECT book FROM library WHERE meta.k CONTAINS "zz" AND info = 1'
+    code, output = run("--input=" + str(path), "--query=" + query)
+    assert code == 0
+    assert output.endswith(b'<book id="2"><meta k="xzzy" /><info>1</info>'
+                           b'</book>')
+    optimized = xqr.Query.prepare(query).where
+    assert [child.element.attribute for child in optimized.children] == \
+        ["k", None]
+
+
+def test_optimizer_moves_attribute_condition_first():
+    query = xqr.Query.prepare('SELECT book FROM library WHERE title = "a" '
+                              'AND .id = 1 AND price > 1 AND .lang = "cs"')
+    assert [child.element.attribute for child in query.where.children] == \
+        ["id", "lang", None, None]
+
+
+@pytest.mark.parametrize("root", ['<root xmlns="urn:x">',
+                                  '<root xmlns:p="urn:x">',
+                                  '<p:root xmlns:p="urn:x">'])
+def test_chunks_not_used_with_namespaces(tmp_path, monkeypatch, root):
+    monkeypatch.setattr(xqr.ChunkedParser, "MIN_SIZE", 0)
+    path = tmp_path / "ns.xml"
+    path.write_text(root + "<r>1</r>" * 100 + root.split()[0].replace(
+        "<", "</") + ">", encoding="utf-8")
+    query = xqr.Query.prepare("SELECT r FROM root")
+    assert xqr.ChunkedParser(str(path), 2).find(query) is None
+    assert run("--input=" + str(path), "--query=SELECT r FROM root",
+               "--jobs=2") == run("--input=" + str(path),
+                                  "--query=SELECT r FROM root")
+
+
+def test_chunks_match_serial(tmp_path, monkeypatch):
+    monkeypatch.setattr(xqr.ChunkedParser, "MIN_SIZE", 0)
+    path = tmp_path / "records.xml"
+    path.write_text("<root>" + "".join("<r><v>%d</v></r>\n" % (i % 7)
+                                       for i in range(1000)) + "</root>",
+                    encoding="utf-8")
+    query = xqr.Query.prepare("SELECT r FROM root WHERE v > 3")
+    found = xqr.ChunkedParser(str(path), 2).find(query)
+    serial = xqr.Document.load(str(path)).execute(query)
+    assert [xqr.ET.tostring(element) for element in found] == \
+        [xqr.ET.tostring(element) for element in serial]
+
+
+@pytest.mark.parametrize("root", ["<root>", '<root xmlns="urn:x">'])
+def test_state_matches_serial_after_append(tmp_path, root):
+    path = tmp_path / "log.xml"
+    state = "--state=" + str(tmp_path / "state.json")
+    query = "--query=SELECT r FROM root WHERE v > 3"
+    records = "".join("<r><v>%d</v></r>\n" % (i % 7) for i in range(50))
+    for count in (1, 2, 3):
+        path.write_text(root + records * count + "</root>", encoding="utf-8")
+        assert run("--input=" + str(path), query, state) == \
+            run("--input=" + str(path), query)
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_tasks_source_error_is_raised(library, jobs):
+    def tasks():
+        yield xqr.Task(library, QUERIES[1])
+        raise ValueError("broken source")
+
+    async def consume():
+        results = []
+        async for task in xqr.TaskRunner(jobs).results(tasks()):
+            results.append(task)
+        return results
+
+    with pytest.raises(ValueError, match="broken source"):
+        xqr.asyncio.run(xqr.asyncio.wait_for(consume(), 30))
+
+
+@pytest.fixture
+def server(tmp_path, library, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(xqr.QueryServer, "TIMEOUT", 1)
+    server = xqr.QueryServer("0", xqr.DocumentPool())
+    thread = xqr.threading.Thread(target=server._server.serve_forever)
+    thread.start()
+    yield server
+    server._server.shutdown()
+    thread.join()
+    server._server.server_close()
+
+
+def post(server, body, headers):
+    connection = http.client.HTTPConnection(
+        "127.0.0.1", server._server.server_address[1], timeout=10)
+    try:
+        connection.putrequest("POST", "/query")
+        for name, value in headers.items():
+            connection.putheader(name, value)
+        connection.endheaders()
+        connection.send(body)
+        response = connection.getresponse()
+        return (response.status, response.getheader("X-XQR-Exit-Code"),
+                response.read())
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("length, body", [("abc", b""), ("-1", b""),
+                                          ("2", b"\xff\xfe")])
+def test_server_rejects_bad_post(server, length, body):
+    status, exit_code, _ = post(server, body, {"Content-Length": length})
+    assert (status, exit_code) == (400, "1")
+    assert server.errors == 1
+    body = urllib.parse.urlencode({"document": "library.xml",
+                                   "query": QUERIES[0]}).encode()
+    status, exit_code, data = post(server, body, {
+        "Content-Length": str(len(body)),
+        "Content-Type": "application/x-www-form-urlencoded"})
+    assert (status, exit_code) == (200, None)
+
+
+def test_server_drops_stalled_client(server):
+    stalled = socket.create_connection(server._server.server_address)
+    try:
+        stalled.sendall(b"GET /query?document=library.xml")
+        start = time.perf_counter()
+        status, exit_code, _ = post(server, b"", {})
+        assert (status, exit_code) == (400, "1") # no query entered
+        assert time.perf_counter() - start < 5
+    finally:
+        stalled.close()
+
+
+@pytest.mark.parametrize("mode", [[], ["--stream"]])
+def test_profile_counters(tmp_path, library, mode):
+    profile = tmp_path / "profile.json"
+    assert run("--input=" + library, "--query=" + QUERIES[1],
+               "--profile=" + str(profile), *mode)[0] == 0
+    report = xqr.json.loads(profile.read_text(encoding="utf-8"))
+    assert report["counters"]["elements_visited"] == 4
+    assert report["counters"]["rows_emitted"] == 3
+    assert report["peak_memory_kb"] is None
+
+
+def test_profile_memory(tmp_path, library):
+    profile = tmp_path / "profile.json"
+    assert run("--input=" + library, "--query=" + QUERIES[1],
+               "--profile-memory")[0] == 1
+    assert run("--input=" + library, "--query=" + QUERIES[1],
+               "--profile=" + str(profile), "--profile-memory")[0] == 0
+    report = xqr.json.loads(profile.read_text(encoding="utf-8"))
+    assert report["peak_memory_kb"] > 0
+    assert report["stages"]["parse"]["peak_memory_kb"] > 0
+
+
+@pytest.mark.parametrize("encoding", ["utf-8", "iso-8859-2"])
+def test_index_matches_serial(tmp_path, encoding):
+    path = tmp_path / "library.xml"
+    path.write_bytes(LIBRARY.replace("utf-8", encoding).replace(
+        "Babicka", "Babička").encode(encoding))
+    expected = [run("--input=" + str(path), "--query=" + query)
+                for query in QUERIES]
+    assert run("--input=" + str(path), "--build-index")[0] == 0
+    assert [run("--input=" + str(path), "--query=" + query)
+            for query in QUERIES] == expected
+    explain = run("--input=" + str(path), "--query=" + QUERIES[1],
+                  "--explain")[1]
+    assert (b"index" in explain) == (encoding == "utf-8")
+
+
+def test_task_workers_are_not_forked():
+    with xqr.TaskRunner(2)._workers() as workers:
+        assert workers._mp_context.get_start_method() != "fork"
+
+
+@pytest.mark.parametrize("root, declaration", [(None, True), ("r", True),
+                                               (None, False), ("r", False)])
+def test_writer_without_private_serializer(root, declaration):
+    document = xqr.Document.parse(io.BytesIO(
+        '<a><b x="1">č<c/></b>t<b xmlns="urn:x">ř</b>\n</a>'.encode()))
+
+    def write(private):
+        output = io.BytesIO()
+        writer = xqr.ResultWriter(output, root, declaration)
+        writer._private = private # as if ET had no _serialize_xml
+        for element in document.root:
+            writer.element(element)
+        writer.close()
+        return output.getvalue()
+
+    assert write(False) == write(True)
+
+
+@pytest.mark.parametrize("madvise", [True, False])
+@pytest.mark.parametrize("stream", [False, True])
+def test_mapped_input_matches_read(tmp_path, monkeypatch, madvise, stream):
+    path = tmp_path / "big.xml"
+    path.write_text("<library>\n" + "".join(
+        '  <book id="%d"><price>%d</price></book>\n' % (number, number % 500)
+        for number in range(20000)) + "</library>\n", encoding="utf-8")
+    query = "SELECT book FROM library WHERE price > 250 ORDER BY price ASC"
+    expected = run("--input=" + str(path), "--query=" + query, "--root=r")[1]
+
+    monkeypatch.setattr(xqr.InputReader, "MMAP_SIZE", 1)
+    monkeypatch.setattr(xqr.InputReader, "RELEASE", xqr.mmap.PAGESIZE)
+    if not madvise:
+        monkeypatch.delattr(xqr.mmap, "MADV_SEQUENTIAL", raising=False)
+        monkeypatch.delattr(xqr.mmap, "MADV_DONTNEED", raising=False)
+    xml_input = xqr.InputReader.open(str(path))
+    try:
+        assert xml_input.mapped
+        parser = xqr.XMLParser(xml_input, stream)
+        parser.find(xqr.Query.prepare(query))
+        output = io.BytesIO()
+        parser.write(output, "r")
+        assert (xml_input._released > 0) == madvise
+    finally:
+        xml_input.close()
+    assert output.getvalue() == expected
+
+
+def test_stdin_is_read_only_without_input(tmp_path, library):
+    params = xqr.Params()
+    params.get_args(["--input=" + library, "--query=" + QUERIES[0]])
+    assert params.xml_input.name == library
+    params.cleanup()
+
+    params = xqr.Params()
+    assert params.xml_input is None
+    params.get_line_args(["--query=" + QUERIES[0]])
+    assert params.xml_input is None
+    params.cleanup()
+
+    with open(library, "rb") as stdin:
+        process = subprocess.run([sys.executable, XQR,
+                                  "--query=" + QUERIES[0]], stdin=stdin,
+                                 stdout=subprocess.PIPE)
+    assert process.stdout == run("--input=" + library,
+                                 "--query=" + QUERIES[0])[1]
+
+
+CODECS = {".gz": xqr.gzip, ".bz2": xqr.bz2, ".xz": xqr.lzma}
+
+
+@pytest.mark.parametrize("extension", sorted(CODECS))
+@pytest.mark.parametrize("level", [None, "1", "9"])
+def test_compressed_round_trip(tmp_path, library, extension, level):
+    codec = CODECS[extension]
+    data = tmp_path / "library.data" # recognized by magic bytes
+    data.write_bytes(codec.compress(LIBRARY.encode("utf-8")))
+    output = tmp_path / ("out.xml" + extension)
+    args = ["--input=" + str(data), "--query=" + QUERIES[5],
+            "--output=" + str(output)]
+    if level is not None:
+        args.append("--level=" + level)
+    assert run(*args)[0] == 0
+    expected = run("--input=" + library, "--query=" + QUERIES[5])[1]
+    assert codec.decompress(output.read_bytes()) == expected
+
+
+@pytest.mark.parametrize("args", [["--level=5"],
+                                  ["--level=5", "--output=o.xml"],
+                                  ["--level=0", "--output=o.gz"],
+                                  ["--level=x", "--output=o.gz"]])
+def test_level_is_checked(tmp_path, library, args):
+    assert run("--input=" + library, "--query=" + QUERIES[0], *args,
+               cwd=str(tmp_path))[0] == 1
+    assert not (tmp_path / "o.gz").exists()
+
+
+@pytest.mark.parametrize("extension", sorted(CODECS))
+@pytest.mark.parametrize("damage", ["truncated", "corrupt"])
+def test_damaged_compressed_input(tmp_path, extension, damage):
+    data = CODECS[extension].compress(LIBRARY.encode("utf-8"))
+    if damage == "truncated":
+        data = data[:len(data) // 2]
+    else:
+        data = data[:20] + bytes(30) + data[50:]
+    path = tmp_path / ("library.xml" + extension)
+    path.write_bytes(data)
+    process = subprocess.run([sys.executable, XQR, "--input=" + str(path),
+                              "--query=" + QUERIES[0]], timeout=60,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert process.returncode == 2
+    assert process.stderr == (b"Input error: Input file couldn't be "
+                              b"decompressed.\n")
+
+
+def test_read_ahead_stops_thread():
+    class Source:
+        closed = False
+
+        def __init__(self, data):
+            self.data = data
+
+        def read(self, size):
+            if self.data is None:
+                raise EOFError("truncated")
+            return self.data
+
+        def close(self):
+            self.closed = True
+
+    source = Source(None)
+    reader = xqr.ReadAhead(source)
+    with pytest.raises(xqr.InputError):
+        reader.read()
+    assert reader.read() == b""
+    reader.close()
+    assert not reader._thread.is_alive() and source.closed
+
+    # closed before the end, the thread waits on a full queue
+    source = Source(b"x")
+    reader = xqr.ReadAhead(source)
+    assert reader.read() == b"x"
+    time.sleep(0.2)
+    reader.close()
+    assert not reader._thread.is_alive() and source.closed
+
+
+def test_watch_replaces_output(tmp_path, library):
+    output = tmp_path / "out.xml"
+    output.write_bytes(b"<old />")
+    expected = run("--input=" + library, "--query=" + QUERIES[1])[1]
+    process = subprocess.Popen([sys.executable, XQR, "--input=" + library,
+                                "--query=" + QUERIES[1],
+                                "--output=" + str(output), "--watch=0.1"])
+    try:
+        for _ in range(100):
+            if output.read_bytes() == expected:
+                break
+            assert output.read_bytes() == b"<old />"
+            time.sleep(0.1)
+        assert output.read_bytes() == expected
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def test_watch_keeps_results_of_broken_file(tmp_path, library):
+    content = open(library, "rb").read()
+    path = tmp_path / "watched.xml"
+    path.write_bytes(content[:-len(b"</library>\n") - 20]) # in a write
+    output = tmp_path / "out.xml"
+    output.write_bytes(b"<old />")
+    query = "SELECT book FROM library"
+    process = subprocess.Popen([sys.executable, XQR, "--input=" + str(path),
+                                "--query=" + query, "--output=" + str(output),
+                                "--watch=0.1"], stderr=subprocess.PIPE)
+
+    def wait_for(expected):
+        for _ in range(100):
+            if output.read_bytes() == expected:
+                break
+            assert process.poll() is None
+            time.sleep(0.1)
+        assert output.read_bytes() == expected
+
+    try:
+        time.sleep(0.5)
+        assert process.poll() is None
+        assert output.read_bytes() == b"<old />"
+        path.write_bytes(content)
+        wait_for(run("--input=" + library, "--query=" + query)[1])
+        path.write_bytes(content[:len(content) // 2]) # rewritten
+        time.sleep(0.5)
+        wait_for(run("--input=" + library, "--query=" + query)[1])
+        path.write_bytes(content.replace(b"<book", b"<book new=\"1\"", 1))
+        wait_for(run("--input=" + str(path), "--query=" + query)[1])
+    finally:
+        process.terminate()
+        stderr = process.communicate()[1]
+    assert stderr.count(b"Format error: ") == 2
+
+
+@pytest.mark.parametrize("option", ["--jobs=2", "--build-index", "--stream",
+                                    "--jo=2", "--str", "--expl", "--help",
+                                    "--input=x.xml", "--que=x"])
+def test_batch_rejects_option(tmp_path, library, option):
+    batch = tmp_path / "batch.txt"
+    batch.write_text("--query='%s' --output=%s\n--query='%s' %s\n" % (
+        QUERIES[0], tmp_path / "1.xml", QUERIES[0], option),
+        encoding="utf-8")
+    process = subprocess.run([sys.executable, XQR, "--input=" + library,
+                              "--batch=" + str(batch)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert process.returncode == 1
+    assert process.stdout == b""
+    assert process.stderr == (b"Arguments error: Batch file, line 2: Only "
+                              b"--query, --qf, --output, --level, -n and "
+                              b"--root can be used.\n")
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_parser_results(library, stream):
+    query = xqr.Query.prepare(QUERIES[6])
+    with open(library, "rb") as xml_input:
+        parser = xqr.XMLParser(xml_input, stream)
+        parser.find(query)
+        results = list(parser.results())
+    assert [element.get("id") for element in results] == ["3", "1", "4"]
+    with open(library, "rb") as xml_input:
+        parser = xqr.XMLParser(xml_input, stream)
+        parser.find(query)
+        assert parser.write(io.BytesIO(), "r") == 3
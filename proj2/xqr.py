@@ -5,10 +5,47 @@
 #2014
 
 import sys
+import os
 import argparse
 import traceback
 import xml.etree.ElementTree as ET
 import re
+import itertools
+import heapq
+import operator
+import shlex
+import json
+import bisect
+import array
+import xml.parsers.expat
+import multiprocessing
+import mmap
+import stat
+import threading
+import queue
+import gzip
+import bz2
+import lzma
+import time
+import tracemalloc
+import io
+import hashlib
+import shutil
+import asyncio
+import concurrent.futures
+import signal
+import socket
+import socketserver
+import http.server
+import urllib.parse
+from collections import deque, OrderedDict
+
+# Valid name of XML element (query, --root).
+ELEMENT_NAME_RE = re.compile(r'\A[a-zA-Z_][a-zA-Z_\-0-9]*\Z')
+# Splits query by white chars and operators from WHERE clause.
+QUERY_TOKEN_RE = re.compile(r'(>|<|=|\(|\))|\s+')
+# Item of IN list - "string" or number, followed by comma or end of list.
+IN_ITEM_RE = re.compile(r'\s*(?:"([^"]*)"|([^\s,"]+))\s*(,|\Z)')
 
 class Params:
     '''Class for handling and parsing given arguments.'''
@@ -16,9 +53,28 @@ class Params:
     def __init__(self):
         self.header = True  # Generate XML header?
         self.output = sys.stdout
-        self.xml_input = sys.stdin
+        self.xml_input = None # InputReader, stdin if no --input is given
         self.query = None
         self.root_element = None # Wraps all results.
+        self.stream = False # Evaluate while parsing (iterparse)?
+        self.batch = None # Batch with queries (--batch)
+        self.input_name = None # Name of input file (--input)
+        self.build_index = False # Build index of input (--build-index)?
+        self.jobs = 1 # Number of processes evaluating WHERE clause
+        self.level = None # Compression level of output (--level)
+        self.explain = False # Print query plan instead of results?
+        self.profile = None # File for --profile ("" for stderr)
+        self.profile_memory = False # Trace memory for --profile?
+        self.serve = None # Address of query server (--serve)
+        self.pool = 8 # Number of documents kept by query server
+        self.tasks = None # File with tasks (--tasks)
+        self.pending = None # Number of tasks in progress (--tasks)
+        self.cache = None # Directory of result cache (--cache)
+        self.cache_ttl = None # Seconds results stay cached
+        self.cache_hash = False # Fingerprint input by content hash?
+        self.output_name = None # Name of output file (--output)
+        self.state = None # File with state of incremental evaluation
+        self.watch = None # Seconds between checks of input (--watch)
 
     def __del__(self):
         self.cleanup()
@@ -26,10 +82,12 @@ class Params:
     def cleanup(self):
         '''Close files opened in this Params instance.'''
 
-        if self.xml_input != "stdin":
+        if self.xml_input is not None:
             self.xml_input.close()
-        if self.output != "stdout":
+        if self.output is not sys.stdout:
             self.output.close()
+        if self.tasks is not None and self.tasks is not sys.stdin:
+            self.tasks.close()
 
     def _print_help(self):
         print("""XML Query:
@@ -39,35 +97,101 @@ Parametry:
     --help Napoveda
     --input=filename Vstupni soubor ve formatu XML
     --output=filename Vystupni soubor ve formatu XML s obahem podle zadaneho dotazu
+        Vstup komprimovany gzip, bzip2 nebo xz je rozpoznan automaticky,
+        vystup s priponou .gz, .bz2 nebo .xz je komprimovan.
+    --level=n Uroven komprese vystupu (1-9).
+    --explain Misto vysledku vypise upraveny dotaz (poradi podminek podle
+        odhadu ceny a selektivity) a zpusob cteni vstupu.
+    --profile[=filename] Po vyhodnoceni zapise do souboru (bez nej na
+        standardni chybovy vystup) JSON s casem kazde faze (parse, scan,
+        where, sort, write) a s pocitadly (navstivene elementy, vyhodnoceni
+        podminek, hledani hodnot, neuspesne prevody na cislo, zapsane
+        elementy).
+    --profile-memory S --profile meri i spicku pameti kazde faze
+        (tracemalloc, vyhodnoceni je nekolikrat pomalejsi).
     --query='dotaz' Zadany dotaz (format popsan nize)
     --qf=filename Dotaz (format popsan nize) v externim textovem souboru
     -n Negenerovat XML hlavicku na vystup 
     -root=element Jmeno paroveho korenoveho elementu obalujici vysledky.
+    --stream Vyhodnocovat dotaz prubezne behem cteni vstupu (v pameti jsou
+        jen prave zpracovavane elementy). Pri chybe ve vstupu muze byt cast
+        vysledku jiz zapsana.
+    --batch=filename Soubor s dotazy. Kazdy radek obsahuje parametry jednoho
+        dotazu (--query nebo --qf, --output, --level, -n, --root). Vstup je nacten
+        jen jednou pro vsechny dotazy. Lze kombinovat pouze s --input.
+    --build-index Vytvori index elementu a atributu vstupniho souboru
+        (soubor.xqi vedle vstupu). Dotazy nad nezmenenym vstupem pak index
+        pouziji automaticky. Bez dotazu se pouze vytvori index.
+    --serve=[host:]port|cesta Spusti server odpovidajici na dotazy pres HTTP
+        na portu (host 127.0.0.1) nebo Unix socketu (cesta obsahuje /):
+        /query?document=soubor&query=dotaz[&root=element][&n=1] vrati
+        vysledek dotazu nad souborem (relativne k pracovnimu adresari),
+        /metrics statistiky v JSON. Nactene dokumenty drzi v pameti.
+    --pool=n Server drzi nejvyse n nactenych dokumentu (vychozi 8).
+    --cache=adresar Vysledky dotazu uklada do adresare, opakovany dotaz nad
+        nezmenenym vstupem (cesta, cas zmeny a velikost souboru) zapise
+        ulozeny vysledek bez cteni vstupu. Vyzaduje --input (se --serve
+        uklada vysledky do adresare, v pameti je drzi vzdy).
+    --cache-ttl=s Ulozene vysledky starsi nez s sekund se nepouziji.
+    --cache-hash Vstup rozpoznava podle hashe obsahu misto casu zmeny.
+    --state=filename Prubezne vyhodnoceni vstupu, ke kteremu jsou pridavany
+        zaznamy (pred koncovou znacku korenoveho elementu): v souboru je
+        ulozen stav (pozice konce vyhodnocene casti a vysledky), pristi
+        beh zpracuje jen nove zaznamy a vysledky k drivejsim pripoji
+        (s ORDER BY je zaradi do serazenych vysledku).
+    --watch=s Kazdych s sekund zkontroluje vstup a pri zmene vyhodnoti
+        nove zaznamy a prepise --output (lze s --state). Chybny vstup
+        (napr. rozepsany soubor) ponecha posledni vysledky a zkusi se znovu.
+    --tasks=filename Soubor s ulohami (- pro standardni vstup). Kazdy radek
+        obsahuje --input a parametry dotazu (--query nebo --qf, --output,
+        --level, -n, --root). Ulohy se vykonavaji soubezne (cteni souboru
+        ve vlaknech, vyhodnoceni v --jobs procesech), vysledky se zapisuji
+        v poradi dokonceni, bez --output na standardni vystup.
+        Lze kombinovat pouze s --jobs a --pending.
+    --pending=n Nejvyse n rozpracovanych uloh, dalsi radky se ctou az po
+        zapsani vysledku (vychozi 4 * jobs).
+    --jobs=n Podminku WHERE vyhodnocuje n procesu (nacteny dokument sdili
+        pres fork, vysledky jsou ve stejnem poradi jako bez --jobs).
+        Velky vstupni soubor s FROM ROOT nebo FROM korenovy element deli
+        na useky zaznamu, ktere n procesu parsuje soubezne.
 
 Formát dotazu:
     SELECT element LIMIT n FROM element|element.attribute|ROOT WHERE condition
-    ORDER BY element|element.attribute ASC|DESC""")
+    ORDER BY element|element.attribute ASC|DESC
+    Podminka muze obsahovat i element IN (literal, literal, ...).""")
 
     def _open_input(self, filename):
         '''Opens input file given by filename.'''
 
-        try:
-            self.xml_input = open(filename, "r", encoding="utf-8")
-        except ValueError:
-            raise InputError("Input file encoding is not supported.")
-        except:
-            raise InputError("Input file couldn't be opened.")
+        xml_input = InputReader.open(filename)
+        if self.xml_input is not None:
+            self.xml_input.close()
+        self.xml_input = xml_input
+        self.input_name = filename
     
     def _open_output(self, filename):
         '''Opens output file given by filename.'''
 
+        self._set_output_name(filename)
+        codec = Codecs.by_extension(filename)
         try:
-            self.output = open(filename, "w", encoding="utf-8")
+            if codec is None:
+                self.output = open(filename, "w", encoding="utf-8")
+            else:
+                self.output = Codecs.writer(codec, filename, self.level)
         except ValueError:
             raise OutputError("Output file encoding is not supported.")
         except:
             raise OutputError("Output file couldn't be opened.")
 
+    def _set_output_name(self, filename):
+        '''Output file written later (--watch replaces it)'''
+
+        self.output_name = filename
+        if Codecs.by_extension(filename) is None and self.level is not None:
+            raise ArgError("--level requires compressed output "
+                           "(.gz, .bz2, .xz).")
+
     def _query_from_param(self, query):
         '''Reads XML query from --query=\'string\'.'''
 
@@ -93,15 +217,158 @@ Formát dotazu:
     def _set_root_element(self, name):
         '''Name of element wrapping all results'''
 
-        if re.match('\A[a-zA-Z_][a-zA-Z_\-0-9]*\Z' ,name) is None:
+        if ELEMENT_NAME_RE.match(name) is None:
             raise ArgError("Wrong root element.")
         self.root_element = name
+
+    def _set_stream(self):
+        '''Evaluate query while reading input (XMLParser streaming mode)'''
+
+        self.stream = True
+
+    def _set_jobs(self, jobs):
+        '''Number of processes evaluating WHERE clause'''
+
+        try:
+            self.jobs = int(jobs)
+        except ValueError:
+            raise ArgError("Expecting an integer in --jobs.")
+        if self.jobs < 1:
+            raise ArgError("--jobs must be at least 1.")
+
+    def _set_level(self, level):
+        '''Compression level of output'''
+
+        try:
+            self.level = int(level)
+        except ValueError:
+            raise ArgError("Expecting an integer in --level.")
+        if not 1 <= self.level <= 9:
+            raise ArgError("--level must be from 1 to 9.")
+
+    def _set_explain(self):
+        '''Print query plan instead of results'''
+
+        self.explain = True
+
+    def _set_profile(self, filename):
+        '''Write profile of the query to filename ("" for stderr)'''
+
+        self.profile = filename
+
+    def _set_profile_memory(self):
+        '''Measure peak memory of stages in profile'''
+
+        self.profile_memory = True
+
+    def _set_serve(self, address):
+        '''Address of query server'''
+
+        self.serve = address
+
+    def _set_pool(self, size):
+        '''Number of documents kept by query server'''
+
+        try:
+            self.pool = int(size)
+        except ValueError:
+            raise ArgError("Expecting an integer in --pool.")
+        if self.pool < 1:
+            raise ArgError("--pool must be at least 1.")
+
+    def _set_tasks(self, filename):
+        '''File with tasks ("-" for stdin)'''
+
+        if filename == "-":
+            self.tasks = sys.stdin
+            return
+        try:
+            self.tasks = open(filename, encoding="utf-8")
+        except ValueError:
+            raise QueryError("Encoding of tasks file is not supported.")
+        except:
+            raise QueryError("Tasks file couldn't be opened.")
+
+    def _set_pending(self, pending):
+        '''Number of tasks in progress'''
+
+        try:
+            self.pending = int(pending)
+        except ValueError:
+            raise ArgError("Expecting an integer in --pending.")
+        if self.pending < 1:
+            raise ArgError("--pending must be at least 1.")
+
+    def _set_cache(self, directory):
+        '''Directory of result cache'''
+
+        self.cache = directory
+
+    def _set_cache_ttl(self, ttl):
+        '''Seconds results stay cached'''
+
+        try:
+            self.cache_ttl = float(ttl)
+        except ValueError:
+            raise ArgError("Expecting a number in --cache-ttl.")
+        if self.cache_ttl < 0:
+            raise ArgError("--cache-ttl must not be negative.")
+
+    def _set_cache_hash(self):
+        '''Fingerprint input by hash of its content'''
+
+        self.cache_hash = True
+
+    def _set_cache_options(self, args):
+        '''Sets --cache, --cache-ttl and --cache-hash, returns their count.'''
+
+        if args.cache is None:
+            return 0
+        self._set_cache(args.cache)
+        argc = 1
+        if args.cache_ttl is not None:
+            self._set_cache_ttl(args.cache_ttl)
+            argc += 1
+        if args.cache_hash:
+            self._set_cache_hash()
+            argc += 1
+        return argc
+
+    def _set_state(self, filename):
+        '''File with state of incremental evaluation'''
+
+        self.state = filename
+
+    def _set_watch(self, seconds):
+        '''Seconds between checks of input'''
+
+        try:
+            self.watch = float(seconds)
+        except ValueError:
+            raise ArgError("Expecting a number in --watch.")
+        if self.watch <= 0:
+            raise ArgError("--watch must be positive.")
+
+    def _set_build_index(self):
+        '''Build index of input file (TagIndex)'''
+
+        self.build_index = True
+
+    def _batch_from_file(self, filename):
+        '''Reads queries from batch file --batch=filename.'''
+
+        self.batch = Batch(filename)
     
-    def get_args(self):
+    def get_args(self, argv=None):
         '''Parses given arguments. May open files for input/input - if given.
         Uses methods defined above.
+        argv is list of arguments (without program name), sys.argv
+        is used if None.
         '''
 
+        if argv is None:
+            argv = sys.argv[1:]
+
         try:
             arg_parser = argparse.ArgumentParser(add_help=False)
             arg_parser.add_argument("--input")
@@ -109,37 +376,213 @@ Formát dotazu:
             exclusive = arg_parser.add_mutually_exclusive_group()
             exclusive.add_argument("--query")
             exclusive.add_argument("--qf")
+            exclusive.add_argument("--batch")
             arg_parser.add_argument("-n", action="store_true")
             arg_parser.add_argument("--root")
+            arg_parser.add_argument("--stream", action="store_true")
+            arg_parser.add_argument("--build-index", action="store_true")
+            arg_parser.add_argument("--jobs")
+            arg_parser.add_argument("--level")
+            arg_parser.add_argument("--explain", action="store_true")
+            arg_parser.add_argument("--profile", nargs="?", const="")
+            arg_parser.add_argument("--profile-memory", action="store_true")
+            arg_parser.add_argument("--serve")
+            arg_parser.add_argument("--pool")
+            arg_parser.add_argument("--tasks")
+            arg_parser.add_argument("--pending")
+            arg_parser.add_argument("--cache")
+            arg_parser.add_argument("--cache-ttl")
+            arg_parser.add_argument("--cache-hash", action="store_true")
+            arg_parser.add_argument("--state")
+            arg_parser.add_argument("--watch")
             arg_parser.add_argument("--help", action="store_true") 
-            args = arg_parser.parse_args()
+            args = arg_parser.parse_args(argv)
         except:
             raise ArgError("Wrong argument(s) entered")
         
         # Count processed arguments to know if an argument is entered more
         # than once.
-        argc = 1
-        if len(sys.argv) == 1:
+        argc = 0
+        if len(argv) == 0:
             self._print_help()
             raise ArgError("No argument was entered.")
-        elif sys.argv[1] == "--help":
-            if len(sys.argv) > 2:
+        elif argv[0] == "--help":
+            if len(argv) > 1:
                 raise ArgError("--help cannot be combined with any other argument.")
             self._print_help()
             exit(0)
 
-        if args.query is None and args.qf is None:
-            raise ArgError("Neither --query nor --qf was entered.")
-        argc += 1
+        if args.cache is None and (args.cache_ttl is not None or
+                                   args.cache_hash):
+            raise ArgError("--cache-ttl and --cache-hash require --cache.")
+        if args.serve is not None:
+            allowed = (1 + (args.pool is not None) + (args.cache is not None)
+                       + (args.cache_ttl is not None) + args.cache_hash)
+            if len(argv) != allowed:
+                raise ArgError("--serve can be combined only with --pool "
+                               "and --cache options.")
+            self._set_serve(args.serve)
+            if args.pool is not None:
+                self._set_pool(args.pool)
+            self._set_cache_options(args)
+            return
+        if args.pool is not None:
+            raise ArgError("--pool requires --serve.")
+        if args.tasks is not None:
+            allowed = 1 + (args.jobs is not None) + (args.pending is not None)
+            if len(argv) != allowed:
+                raise ArgError("--tasks can be combined only with --jobs "
+                               "and --pending.")
+            if args.jobs is not None:
+                self._set_jobs(args.jobs)
+            if args.pending is not None:
+                self._set_pending(args.pending)
+            self._set_tasks(args.tasks)
+            return
+        if args.pending is not None:
+            raise ArgError("--pending requires --tasks.")
+
+        if args.build_index:
+            if args.input is None:
+                raise ArgError("--build-index requires --input.")
+            self._set_build_index()
+            argc += 1
+        if args.query is None and args.qf is None and args.batch is None:
+            if not args.build_index:
+                raise ArgError("Neither --query nor --qf was entered.")
+        elif args.batch is not None and (args.output is not None or args.n or
+                                         args.root is not None or args.stream
+                                         or args.jobs is not None or
+                                         args.explain or
+                                         args.profile is not None):
+            raise ArgError("--batch can be combined only with --input.")
+        else:
+            argc += 1
         if args.query is not None:
             self._query_from_param(args.query)
-        else: # --qf 
+        elif args.qf is not None:
             self._query_from_file(args.qf)
+        elif args.batch is not None:
+            self._batch_from_file(args.batch)
         if args.n:
             self._unset_header()
             argc += 1
         if args.input is not None:
             self._open_input(args.input)
+            if self.build_index and self.xml_input.compressed is not None:
+                raise ArgError("--build-index is not supported for "
+                               "compressed input.")
+            argc += 1
+        else:
+            self.xml_input = InputReader.stdin()
+        if args.level is not None:
+            if args.output is None:
+                raise ArgError("--level requires --output.")
+            self._set_level(args.level)
+            argc += 1
+        if args.output is not None:
+            if args.watch is None:
+                self._open_output(args.output)
+            else: # not truncated until the first results are written
+                self._set_output_name(args.output)
+            argc += 1
+        if args.root is not None:
+            self._set_root_element(args.root)
+            argc += 1
+        if args.stream:
+            self._set_stream()
+            argc += 1
+        if args.jobs is not None:
+            self._set_jobs(args.jobs)
+            argc += 1
+        if args.explain:
+            self._set_explain()
+            argc += 1
+        if args.profile is not None:
+            self._set_profile(args.profile)
+            argc += 1
+        if args.profile_memory:
+            if args.profile is None:
+                raise ArgError("--profile-memory requires --profile.")
+            self._set_profile_memory()
+            argc += 1
+        if args.cache is not None:
+            if args.input is None or (args.query is None and
+                                      args.qf is None):
+                raise ArgError("--cache requires --input and a query.")
+            argc += self._set_cache_options(args)
+        if args.state is not None or args.watch is not None:
+            if args.input is None or (args.query is None and
+                                      args.qf is None):
+                raise ArgError("--state and --watch require --input "
+                               "and a query.")
+            if (args.stream or args.jobs is not None or args.explain or
+                    args.profile is not None or args.cache is not None or
+                    args.build_index):
+                raise ArgError("--state and --watch can't be combined with "
+                               "--stream, --jobs, --explain, --profile, "
+                               "--cache and --build-index.")
+            if self.xml_input.compressed is not None:
+                raise ArgError("--state and --watch require uncompressed "
+                               "input.")
+            if args.state is not None:
+                self._set_state(args.state)
+                argc += 1
+            if args.watch is not None:
+                if args.output is None:
+                    raise ArgError("--watch requires --output.")
+                self._set_watch(args.watch)
+                argc += 1
+        if argc != len(argv):
+            raise ArgError("An argument was entered more than once.")
+
+    def get_line_args(self, argv, with_input=False):
+        '''Parses arguments of one query from a line of batch file -
+        --query or --qf, --output, --level, -n and --root. A line of
+        tasks file (with_input) must contain also one --input, which is
+        stored in input_name, not opened. Any other argument
+        (abbreviations and --help too) raises ArgError.
+        '''
+
+        try:
+            arg_parser = argparse.ArgumentParser(add_help=False,
+                                                 allow_abbrev=False)
+            arg_parser.add_argument("--output")
+            exclusive = arg_parser.add_mutually_exclusive_group()
+            exclusive.add_argument("--query")
+            exclusive.add_argument("--qf")
+            arg_parser.add_argument("-n", action="store_true")
+            arg_parser.add_argument("--root")
+            arg_parser.add_argument("--level")
+            if with_input:
+                arg_parser.add_argument("--input")
+            args, unknown = arg_parser.parse_known_args(argv)
+        except:
+            raise ArgError("Wrong argument(s) entered")
+        if unknown:
+            raise ArgError("Only %s--query, --qf, --output, --level, -n and "
+                           "--root can be used."
+                           % ("--input, " if with_input else ""))
+
+        argc = 1
+        if with_input:
+            if args.input is None:
+                raise ArgError("Exactly one --input must be entered.")
+            self.input_name = args.input
+            argc += 1
+        if args.query is not None:
+            self._query_from_param(args.query)
+        elif args.qf is not None:
+            self._query_from_file(args.qf)
+        else:
+            raise ArgError("Neither --query nor --qf was entered.")
+        if args.n:
+            self._unset_header()
+            argc += 1
+        if args.level is not None:
+            if args.output is None:
+                raise ArgError("--level requires --output.")
+            self._set_level(args.level)
             argc += 1
         if args.output is not None:
             self._open_output(args.output)
@@ -147,10 +590,72 @@ Formát dotazu:
         if args.root is not None:
             self._set_root_element(args.root)
             argc += 1
-        if argc != len(sys.argv):
+        if argc != len(argv):
             raise ArgError("An argument was entered more than once.")
 
 
+class Batch:
+    '''Queries from a batch file (--batch). Each line contains arguments
+    of one query - --query or --qf, and optionally --output, --level, -n
+    and --root.
+    Empty lines and comments (#) are skipped.
+    All queries are executed over one parsed document.
+    '''
+
+    def __init__(self, filename):
+        self.jobs = [] # (Params, Query) for each query
+        try:
+            batch_file = open(filename, encoding="utf-8")
+        except ValueError:
+            raise QueryError("Encoding of batch file is not supported.")
+        except:
+            raise QueryError("Batch file couldn't be opened.")
+        try:
+            for number, line in enumerate(batch_file, 1):
+                self._add_line(line, number)
+        finally:
+            batch_file.close()
+
+    def _add_line(self, line, number):
+        '''Parses arguments of a query from line of batch file.'''
+
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError:
+            raise ArgError("Batch file, line %d: Wrong quoting." % number)
+        if not argv:
+            return
+        params = Params()
+        try:
+            params.get_line_args(argv)
+            query = Query.prepare(params.query)
+        except (ArgError, QueryError) as e:
+            params.cleanup()
+            raise type(e)("Batch file, line %d: %s" % (number, e.value))
+        self.jobs.append((params, query))
+
+    def run(self, document):
+        '''Executes all queries over document (class Document) and writes
+        their results. All queries are evaluated in one traversal of
+        the document (QuerySet).
+        '''
+
+        query_set = QuerySet([query for params, query in self.jobs])
+        found = query_set.find(document.root)
+        for (params, query), elements in zip(self.jobs, found):
+            parser = XMLParser(None)
+            parser.found(elements, query)
+            parser.write(params.output, params.root_element, params.header)
+            parser.restore()
+            params.cleanup()
+
+    def cleanup(self):
+        '''Close files opened for queries.'''
+
+        for params, query in self.jobs:
+            params.cleanup()
+
+
 class QueryStates:
     '''States used in Query class FSM when parsing XML query.'''
 
@@ -168,15 +673,23 @@ class Operators:
     GREATER = 2
     LESS = 3
     CONTAINS = 4
+    IN = 5 # literal is a tuple of literals
 
 
 class Element:
     '''XML Element - only name and attribute. Used for searching.'''
 
+    __slots__ = ("name", "attribute")
+
     def __init__(self):
         self.name = None
         self.attribute = None
 
+    def __str__(self):
+        if self.attribute is None:
+            return self.name
+        return (self.name or "") + "." + self.attribute
+
     def parse(self, element):
         ''' Parses element\'s name and attribute from given string. element is
         a string to parse from. An attribute is separated from a name by "."
@@ -196,8 +709,8 @@ class Element:
         else:
             return False
         # Check if self.name is a valid XML element name
-        if (self.name is not None and re.match('\A[a-zA-Z_][a-zA-Z_\-0-9]*\Z',
-                                       self.name) is None):
+        if (self.name is not None and
+                ELEMENT_NAME_RE.match(self.name) is None):
             raise QueryError("Wrong format of element name.")
         return True
 
@@ -207,23 +720,46 @@ class Condition:
     Condtitions create a tree. Leafs contain self.element, self.op and
     self.literal for comparison. Other nodes represent "or", "and" and "()".
     If self.parent is None - root element.
+    Flags a (and), o (or), n (not) and bracket are bits of self.flags.
     '''
-    
+
+    __slots__ = ("parent", "flags", "children", "element", "op", "literal")
+
+    AND = 1
+    OR = 2
+    NOT = 4
+    BRACKET = 8
+
     def __init__(self, parent=None):
         '''parent= None ~ root node'''
 
         self.parent = parent
-        self.a = False # and
-        self.o = False # or
-        self.n = False # not
-        self.bracket = False
+        self.flags = 0
         self.children = []
         self.element = None
         self.op = None # operator from class Operators
         self.literal = None
 
+    def _flag(bit):
+        def get(self):
+            return self.flags & bit != 0
+
+        def set(self, value):
+            if value:
+                self.flags |= bit
+            else:
+                self.flags &= ~bit
+        return property(get, set)
+
+    a = _flag(AND)
+    o = _flag(OR)
+    n = _flag(NOT)
+    bracket = _flag(BRACKET)
+    del _flag
+
     def is_empty(self):
-        if self.a or self.o or self.children or self.op is not None:
+        if (self.flags & (self.AND | self.OR) or self.children or
+                self.op is not None):
             return False
         else:
             return True 
@@ -234,13 +770,17 @@ class Query:
     Parses given XML query and stores its values
     '''
 
+    __slots__ = ("text", "_stat", "_query", "_i", "select", "limit", "from_",
+                 "where", "order_element", "order_desc", "_match", "values")
+
     def __init__(self, query):
         '''query is XML query to parse.'''
 
+        self.text = query
         self._stat = QueryStates.BEGIN      
         # Split query into strings by white chars and operators from WHERE
         # clause. These operators must stay in final list.
-        self._query = list(filter(None, re.split(r'(>|<|=|\(|\))|\s+', query)))
+        self._query = list(filter(None, QUERY_TOKEN_RE.split(query)))
         self._i = 0 # index to word currently being processed
         self.select = None
         self.limit = None
@@ -248,6 +788,113 @@ class Query:
         self.where = None
         self.order_element = None
         self.order_desc = False
+        self._match = None # compiled WHERE clause, see predicate()
+        self.values = None # ValueCache of WHERE and ORDER BY, see predicate()
+
+    @classmethod
+    def prepare(cls, query):
+        '''Returns parsed Query from string query. Prepared query can be
+        executed repeatedly (Document.execute) without parsing it again.
+        '''
+
+        prepared = cls(query)
+        prepared.parse()
+        prepared.optimize()
+        prepared.predicate()
+        return prepared
+
+    def optimize(self):
+        '''Rewrites WHERE clause for faster evaluation (QueryOptimizer).
+        Must be called before predicate().
+        '''
+
+        if self.where is not None:
+            self.where = QueryOptimizer(self.select).rewrite(self.where)
+
+    def explain(self):
+        '''Lines describing the (optimized) query.'''
+
+        lines = ["SELECT " + self.select]
+        if self.limit is not None:
+            lines.append("LIMIT %d" % self.limit)
+        if self.from_ is None:
+            lines.append("FROM (nothing - empty result)")
+        else:
+            lines.append("FROM " + str(self.from_))
+        if self.where is not None:
+            lines.append("WHERE")
+            lines.extend(QueryOptimizer(self.select).explain(self.where,
+                                                             "  "))
+        if self.order_element is not None:
+            lines.append("ORDER BY %s %s" % (
+                self.order_element, "DESC" if self.order_desc else "ASC"))
+        return lines
+
+    def canonical(self):
+        '''Text identifying the query after optimize() - queries with
+        the same text have the same results (ResultCache).'''
+
+        def condition_text(condition):
+            prefix = "NOT " if condition.n else ""
+            if condition.op is None:
+                return prefix + "(%s)" % (" AND " if condition.a else
+                                          " OR ").join(
+                    condition_text(child) for child in condition.children)
+            if condition.op == Operators.IN:
+                literal = list(condition.literal)
+            else:
+                literal = condition.literal
+            return prefix + json.dumps([str(condition.element), condition.op,
+                                        literal])
+
+        return json.dumps([
+            self.select, self.limit,
+            None if self.from_ is None else str(self.from_),
+            None if self.where is None else condition_text(self.where),
+            None if self.order_element is None else str(self.order_element),
+            self.order_desc])
+
+    def context_key(self):
+        '''FROM as a hashable value - None, "ROOT" or (name, attribute).'''
+
+        if self.from_ is None or self.from_ == "ROOT":
+            return self.from_
+        return (self.from_.name, self.from_.attribute)
+
+    def predicate(self):
+        '''Function deciding whether an ElementTree.Element meets
+        the WHERE clause. Compiled on first call (WhereCompiler).
+        '''
+
+        if self._match is None:
+            self.instrument(None)
+        return self._match
+
+    def instrument(self, profile):
+        '''Compiles WHERE clause for predicate(), leaves counted
+        by profile (Profile) if it is not None.'''
+
+        self.values = ValueCache.for_query(self)
+        if self.where is None:
+            self._match = lambda element: True
+        else:
+            self._match = WhereCompiler(self.values, profile).compile(
+                self.where)
+            self._match = self.values.keeping(self._match,
+                                              self.order_element)
+
+    def leaves(self):
+        '''Leaf conditions (comparisons) of WHERE clause.'''
+
+        leaves = []
+        conditions = [self.where] if self.where is not None else []
+        while conditions:
+            condition = conditions.pop()
+            if condition.op is not None:
+                leaves.append(condition)
+            conditions.extend(reversed(condition.children))
+        leaves.reverse()
+        return leaves
 
     def parse(self):
         '''This method parses all query. It is a FSM. If IndexError occurs
@@ -262,8 +909,7 @@ class Query:
                     else:
                         self._i += 1
                         self.select = self._query[self._i]
-                        if re.match('\A[a-zA-Z_][a-zA-Z_\-0-9]*\Z',
-                                    self.select) is None:
+                        if ELEMENT_NAME_RE.match(self.select) is None:
                             raise QueryError("Wrong format of element name.")
                         self._i += 1
                         self._stat = QueryStates.LIMIT
@@ -441,12 +1087,18 @@ class Query:
                     current.op = Operators.LESS
                 elif self._query[self._i] == "CONTAINS":
                     current.op = Operators.CONTAINS
+                elif self._query[self._i] == "IN":
+                    current.op = Operators.IN
                 else:
                     raise QueryError("Relation-operator in WHERE clause not found.")
                 self._i += 1
 
                 if self._i >= len(self._query):
                     raise QueryError("Literal in WHERE clause missing.")
+                if current.op == Operators.IN:
+                    current.literal = self._parse_in_list()
+                    self._i += 1
+                    continue
                 try:
                     current.literal = float(self._query[self._i])
                     if current.op == Operators.CONTAINS:
@@ -471,263 +1123,3426 @@ class Query:
         # Empty current node means other data was expacted.
         if brackets != 0 or current.is_empty():
             raise QueryError("Wrong WHERE clause.")
+
+    def _parse_in_list(self):
+        '''Parses list of literals after IN - ( literal, literal, ... ).
+        Returns tuple of literals, self._i is left on ")".
+        '''
+
+        if self._query[self._i] != "(":
+            raise QueryError("Expecting '(' after IN in WHERE clause.")
+        start = self._i + 1
+        self._i = start
+        while self._query[self._i] != ")":
+            self._i += 1
+            if self._i >= len(self._query):
+                raise QueryError("')' is missing after IN list.")
+        text = " ".join(self._query[start:self._i])
+
+        literals = []
+        position = 0
+        while position < len(text):
+            item = IN_ITEM_RE.match(text, position)
+            if item is None:
+                raise QueryError("Wrong literal in IN list.")
+            if item.group(1) is not None:
+                literals.append(item.group(1))
+            else:
+                try:
+                    literals.append(float(item.group(2)))
+                except ValueError:
+                    raise QueryError("Literal in WHERE clause not found.")
+            position = item.end()
+            if item.group(3) == "," and position >= len(text):
+                raise QueryError("Literal in IN list missing.")
+        if not literals:
+            raise QueryError("Empty IN list in WHERE clause.")
+        return tuple(literals)
     
 
+class QueryOptimizer:
+    '''Rewrites a Condition tree (WHERE clause) before it is compiled:
+    - brackets with one child are removed, their NOT goes to the child
+      (double NOT cancels out),
+    - nested AND in AND and OR in OR are flattened,
+    - children of AND and OR are ordered by estimated cost and
+      selectivity - AND by cost / (1 - selectivity), OR by
+      cost / selectivity, so cheap conditions deciding the result often
+      go first,
+    - neighbouring equalities with the same element in OR are joined
+      into IN (WhereCompiler.merge_equal).
+    Conditions with text of subelements may raise FormatError, so they
+    never move in front of a condition that preceded them; only
+    attribute conditions move in front of them. Reordering can therefore skip an error the
+    original order would raise, but never raises a new one.
+    '''
+
+    # Estimated cost of locating the value of a leaf.
+    COST_OWN_ATTRIBUTE = 1.0 # attribute of the candidate itself
+    COST_ATTRIBUTE = 3.0 # attribute of some subelement
+    COST_TEXT = 4.0 # text of a subelement
+    COST_CONTAINS = 1.0 # added for substring search
+
+    # Estimated probability that a leaf is true.
+    SELECTIVITY = {
+        Operators.EQUAL: 0.1,
+        Operators.GREATER: 0.5,
+        Operators.LESS: 0.5,
+        Operators.CONTAINS: 0.3,
+        Operators.IN: 0.1, # for every literal, at most 0.5
+    }
+
+    def __init__(self, select):
+        '''select is the SELECTed element name (candidate tag).'''
+
+        self.select = select
+
+    def rewrite(self, condition):
+        '''Returns new, rewritten Condition tree.'''
+
+        condition = self._normalize(condition, False)
+        self._order(condition)
+        return condition
+
+    def _normalize(self, condition, negate):
+        '''Copy of condition without single-child brackets, with
+        flattened AND/OR; negate adds NOT.'''
+
+        negate = negate != condition.n
+        if condition.op is None and not (condition.a or condition.o):
+            return self._normalize(condition.children[0], negate)
+
+        node = Condition()
+        node.n = negate
+        if condition.op is not None: # leaf
+            node.element = condition.element
+            node.op = condition.op
+            node.literal = condition.literal
+            return node
+        node.a = condition.a
+        node.o = condition.o
+        for child in condition.children:
+            child = self._normalize(child, False)
+            if not child.n and child.op is None and (
+                    (child.a and node.a) or (child.o and node.o)):
+                node.children.extend(child.children)
+            else:
+                node.children.append(child)
+        for child in node.children:
+            child.parent = node
+        return node
+
+    def estimate(self, condition):
+        '''Returns (cost, selectivity, safe) of condition, safe is False
+        if evaluation may raise FormatError. Children must be ordered.
+        '''
+
+        if condition.op is not None:
+            element = condition.element
+            if element.attribute is None:
+                cost = self.COST_TEXT
+            elif element.name is None or element.name == self.select:
+                cost = self.COST_OWN_ATTRIBUTE
+            else:
+                cost = self.COST_ATTRIBUTE
+            if condition.op == Operators.CONTAINS:
+                cost += self.COST_CONTAINS
+            selectivity = self.SELECTIVITY[condition.op]
+            if condition.op == Operators.IN:
+                selectivity = min(0.5, selectivity * len(condition.literal))
+            safe = element.attribute is not None
+        else:
+            cost = 0.0
+            reach = 1.0 # probability that the child is evaluated
+            safe = True
+            for child in condition.children:
+                child_cost, child_selectivity, child_safe = \
+                    self.estimate(child)
+                cost += reach * child_cost
+                reach *= (child_selectivity if condition.a
+                          else 1 - child_selectivity)
+                safe = safe and child_safe
+            selectivity = reach if condition.a else 1 - reach
+        if condition.n:
+            selectivity = 1 - selectivity
+        return cost, selectivity, safe
+
+    def _order(self, condition):
+        '''Orders children of AND/OR nodes in condition (in place).'''
+
+        if condition.op is not None:
+            return
+        ranked = []
+        for position, child in enumerate(condition.children):
+            self._order(child)
+            cost, selectivity, safe = self.estimate(child)
+            # chance to decide the result - false for AND, true for OR
+            decides = 1 - selectivity if condition.a else selectivity
+            rank = cost / decides if decides > 0 else float("inf")
+            ranked.append((rank, position, safe, child))
+        # Unsafe children split the children into groups and keep their
+        # places, a safe child moves to an earlier group only past unsafe
+        # children with higher rank.
+        groups = [[]]
+        barriers = [] # rank of unsafe child ending each group
+        for item in ranked:
+            rank, position, safe, child = item
+            if not safe:
+                groups[-1].append(item)
+                groups.append([])
+                barriers.append(rank)
+                continue
+            group = len(groups) - 1
+            while group > 0 and rank < barriers[group - 1]:
+                group -= 1
+            groups[group].append(item)
+        children = []
+        for group in groups:
+            unsafe = [item for item in group if not item[2]]
+            group = sorted((item for item in group if item[2]),
+                           key=lambda item: (item[0], item[1]))
+            children.extend(child for rank, position, safe, child in
+                            group + unsafe)
+        condition.children = children
+        if condition.o:
+            condition.children = WhereCompiler.merge_equal(
+                condition.children)
+            for child in condition.children:
+                child.parent = condition
+
+    def explain(self, condition, indent=""):
+        '''Lines describing condition tree with estimates.'''
+
+        cost, selectivity, safe = self.estimate(condition)
+        prefix = indent + ("NOT " if condition.n else "")
+        estimates = "  [cost %.2f, selectivity %.2f]" % (cost, selectivity)
+        if condition.op is not None:
+            return [prefix + self.describe(condition) + estimates]
+        lines = [prefix + ("AND" if condition.a else "OR") + estimates]
+        for child in condition.children:
+            lines.extend(self.explain(child, indent + "  "))
+        return lines
+
+    @staticmethod
+    def describe(condition):
+        '''Leaf condition as text of query.'''
+
+        def literal(value):
+            if type(value) == float:
+                return "%g" % value
+            return '"%s"' % value
+
+        name = str(condition.element)
+        if condition.op == Operators.IN:
+            return "%s IN (%s)" % (name, ", ".join(
+                literal(item) for item in condition.literal))
+        operators = {Operators.EQUAL: "=", Operators.GREATER: ">",
+                     Operators.LESS: "<", Operators.CONTAINS: "CONTAINS"}
+        return "%s %s %s" % (name, operators[condition.op],
+                             literal(condition.literal))
+
+
 class SortObject:
     '''Used in XMLParser for sorting nodes when storing strings for
     comparing. node is an ElementTree.Element.
     '''
 
+    __slots__ = ("node", "string")
+
     def __init__(self, node, string):
         self.node = node
         self.string = string 
 
 
-class XMLParser:
-    '''Element from XML document (xml_input) that meet
-    the XML query (class Query).
+class SearchPath:
+    '''Search for an Element (name and attribute, class Element) in
+    a subtree. path is the ElementPath expression for subelements.
     '''
 
-    def __init__(self, xml_input):
-        self._source = xml_input
-        self._elements = []
+    def __init__(self, name, attribute=None):
+        self.name = name
+        self.attribute = attribute
+        self.path = ".//" + (name if name is not None else "*")
+        if attribute is not None:
+            self.path += "[@" + attribute + "]"
 
-    def find(self, query):
-        '''Finds all elements from self._source that meet
-        the XML query (query). Result is stored in self._elements.
+    def first(self, root):
+        '''First matching element - root or its subelement (in document
+        order). None if there is no such element.
+        Element.iter() is used instead of find(), so the path doesn\'t have
+        to be processed for every root.
         '''
 
-        try:
-            tree = ET.parse(self._source)
-        except:
-            raise FormatError("Given XML is not valid")
-        root = tree.getroot()
+        if self.attribute is None:
+            for found in root.iter(self.name):
+                return found
+        else:
+            for found in root.iter(self.name):
+                if self.attribute in found.attrib:
+                    return found
+        return None
 
-        if query.from_ is None: # empty output
-            return
-        elif (query.from_ != "ROOT" and
-                root.tag != query.from_.name):
-            find_query = ".//"
-            if query.from_.name is not None:
-                find_query += query.from_.name
-            else:
-                find_query += "*"
-            if query.from_.attribute is not None: 
-                find_query += "[@" + query.from_.attribute + "]"
-            root = root.find(find_query)
-        if root is not None:
-            if (query.from_ == "ROOT" and query.select == root.tag and
-                    (query.where is None or self._where(root , query.where))):
-                self._elements.append(root)
-
-            for element in root.findall(".//" + query.select):
-                if (query.where is None or
-                        self._where(element, query.where)):
-                    self._elements.append(element)
 
-        if query.order_element is not None:
-            self._sort(query.order_element, query.order_desc)
+class PathCache:
+    '''LRU cache of SearchPath objects keyed by (name, attribute).
+    hits and misses count lookups.
+    '''
 
-        self._limit(query.limit)
+    def __init__(self, size=1024):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._paths = OrderedDict()
 
-    def _limit(self, limit):
-        '''LIMIT - takes only first x (limit) elements.'''
+    def get(self, name, attribute=None):
+        '''SearchPath for element name with attribute.'''
 
-        if limit is not None:
-            self._elements = self._elements[:limit] 
- 
-           
-    def _sort(self, by, desc=False):
-        '''ORDER BY - ordering.
-        by is the Element (may include an attribute) to order by.
-        Uses class SortObject to store elements with found strings.
-        desc says which way to order elements.
-        '''
+        key = (name, attribute)
+        try:
+            path = self._paths[key]
+        except KeyError:
+            self.misses += 1
+            path = SearchPath(name, attribute)
+            self._paths[key] = path
+            if len(self._paths) > self.size:
+                self._paths.popitem(last=False) # least recently used
+        else:
+            self.hits += 1
+            self._paths.move_to_end(key)
+        return path
 
-        aux_list = []
-        for el in self._elements:
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._paths)}
 
-            if by.attribute is None:
-                if el.tag == by.name:
-                    if len(el) != 0:
-                        raise FormatError("Sort: An element contains subelements instead of text")
-                    string = el.text
-                else:
-                    element = el.find(".//" + by.name)
-                    if element is None:
-                        raise FormatError("Sort: Element not found")
-                    if len(element) != 0:
-                        raise FormatError("Sort: An element contains subelements instead of text")
-                    string = element.text
-            else:
-                element = None
-                if by.name is not None:
-                    if el.tag == by.name:
-                        element = el.find(".[@" + by.attribute + "]")
-                    if element is None: # not found yet, continue searching
-                        element = el.find(".//" + by.name + "[@"
-                                          + by.attribute + "]")
-                        if element is None:
-                            raise FormatError("Sort: Element not found")
-                else:
-                    element = el.find(".[@" + by.attribute + "]") # search root
-                    if element is None: # not found yet, continue searching
-                        element = el.find(".//*[@" + by.attribute + "]")
-                        if element is None:
-                            raise FormatError("Sort: Element not found")
-                string = element.attrib[by.attribute]
 
-            try: 
-                string = float(string) 
-            except:
-                pass
+PATH_CACHE = PathCache()
 
-            sort_object = SortObject(el, string)
-            index = 0
-            for el_compare in aux_list:
-                if string > el_compare.string:                                
-                    aux_list.insert(index, sort_object)
-                    break;
-                index += 1
-            else: 
-                aux_list.append(sort_object)
-        
-        self._elements = [] # final result
-        index = 1
-        for el_final in aux_list:
-            if desc:
-                el_final.node.set("order", str(len(aux_list) - index + 1))
-                self._elements.insert(0, el_final.node)
-            else:
-                el_final.node.set("order", str(index))
-                self._elements.append(el_final.node)
-            index += 1
 
-    def write(self, output, root_element, declaration=True):
-        '''Writes results (self._elements) to given output.
-        root_element wraps all result elements if is not None.
-        If declaration is False, declaration header is not included
-        in output document.
-        '''
+class ValueCache:
+    '''Values found in candidates of one query: for an element (class
+    Element) and a candidate the located node, its text (or attribute
+    value) and the text converted to float (None if it is not a number).
+    Only elements used more than once by the query are cached. All WHERE
+    leaves with the same element share the entry of the candidate being
+    evaluated, entries of the ORDER BY element (if it is in WHERE too)
+    are kept for _sort if the candidate meets the condition. clear() drops the entries when the query is
+    finished, kept entries are also dropped when there are more than
+    MAX_SIZE of them (streaming mode keeps only a part of the document).
+    '''
 
-        if len(self._elements) == 0 and not root_element:
-            root = ET.Element(None)
-            if declaration: # include XML declaration
-                ET.ElementTree(root).write(output.buffer, encoding="utf-8", xml_declaration=True)
-        elif root_element is not None:
-            output_root = ET.Element(root_element)
-            output_tree = ET.ElementTree(output_root) 
+    MAX_SIZE = 65536
+
+    def __init__(self, elements, kept=()):
+        '''elements and kept are (name, attribute) pairs.'''
+
+        self._current = dict((key, [None, None]) for key in elements)
+        self._kept = dict((key, {}) for key in kept)
+
+    @classmethod
+    def for_query(cls, query):
+        '''Cache of elements used more than once by query (Query).'''
+
+        uses = {}
+        for leaf in query.leaves():
+            key = (leaf.element.name, leaf.element.attribute)
+            uses[key] = uses.get(key, 0) + 1
+        kept = []
+        if query.order_element is not None:
+            key = (query.order_element.name, query.order_element.attribute)
+            if key in uses:
+                uses[key] += 1
+                kept.append(key)
+        return cls([key for key, count in uses.items() if count > 1], kept)
+
+    def __contains__(self, element):
+        return (element.name, element.attribute) in self._current
+
+    def current(self, element):
+        '''[candidate, entry] of candidate evaluated last, entry is
+        (node, text, number).'''
+
+        return self._current[(element.name, element.attribute)]
+
+    def kept(self, element):
+        '''Dictionary candidate -> entry for ORDER BY element, None if
+        entries of element are not kept.'''
+
+        return self._kept.get((element.name, element.attribute))
+
+    def keeping(self, match, element):
+        '''Returns match (compiled WHERE clause) that keeps entries of
+        element (ORDER BY) of candidates meeting the condition.'''
+
+        kept = self.kept(element) if element is not None else None
+        if kept is None:
+            return match
+        current = self.current(element)
+        max_size = self.MAX_SIZE
+
+        def keeping(root):
+            if not match(root):
+                return False
+            if current[0] is root:
+                if len(kept) >= max_size:
+                    kept.clear()
+                kept[root] = current[1]
+            return True
+        return keeping
+
+    def clear(self):
+        for current in self._current.values():
+            current[0] = current[1] = None
+        for kept in self._kept.values():
+            kept.clear()
+
+
+class WhereCompiler:
+    '''Compiles a Condition tree (WHERE clause) into a Python function.
+    The function takes an ElementTree.Element and returns True if it meets
+    the condition. Everything that doesn\'t depend on the element
+    (operators, negations, searched elements, type of literal) is resolved once
+    here instead of for every element (XMLParser._where).
+    '''
+
+    # Comparisons of leafs: op(value from document, literal)
+    _operators = {
+        Operators.EQUAL: operator.eq,
+        Operators.GREATER: operator.gt,
+        Operators.LESS: operator.lt,
+        Operators.CONTAINS: operator.contains,
+        Operators.IN: None, # set lookup, see _compile_leaf
+    }
+
+    # Returned by value functions if there is no value to compare.
+    MISSING = object()
+
+    def __init__(self, values=None, profile=None):
+        '''values is ValueCache shared by leaves of the condition,
+        profile (Profile) counts evaluations of leaves.'''
+
+        self._values = values
+        self._profile = profile
+
+    def compile(self, condition):
+        '''Returns function for the whole condition tree.'''
+
+        if condition.o: # OR
+            function = self._compile_or(
+                [self.compile(child)
+                 for child in self.merge_equal(condition.children)])
+        elif condition.a: # AND
+            function = self._compile_and(
+                [self.compile(child) for child in condition.children])
+        elif condition.op is None: # only brackets
+            function = self.compile(condition.children[0])
+        else: # leaf node
+            function = self._compile_leaf(condition)
+
+        if condition.n: # NEG
+            return lambda root: not function(root)
+        return function
+
+    @staticmethod
+    def merge_equal(children):
+        '''Joins neighbouring OR-ed conditions "element = literal" (and
+        "element IN (...)") with the same element into one IN leaf, so
+        a long chain is a single set lookup. Only neighbours are joined,
+        so the order of evaluation (and errors raised) doesn't change.
+        Returns new list of children of the OR node.
+        '''
+
+        def leaf(condition):
+            while (condition.flags == 0 and condition.op is None and
+                    len(condition.children) == 1):
+                condition = condition.children[0] # only brackets
+            if condition.flags & Condition.NOT == 0 and condition.op in (
+                    Operators.EQUAL, Operators.IN):
+                return condition
+            return None
+
+        merged = []
+        run = [] # leafs with the same element
+        for child in list(children) + [None]:
+            found = leaf(child) if child is not None else None
+            if (found is not None and run and
+                    (found.element.name, found.element.attribute) ==
+                    (run[0].element.name, run[0].element.attribute)):
+                run.append(found)
+                continue
+            if len(run) > 1:
+                joined = Condition()
+                joined.element = run[0].element
+                joined.op = Operators.IN
+                joined.literal = tuple(itertools.chain.from_iterable(
+                    item.literal if item.op == Operators.IN
+                    else (item.literal,) for item in run))
+                merged[-1] = joined
+            run = [found] if found is not None else []
+            if child is not None:
+                merged.append(child)
+        return merged
+
+    def _compile_or(self, functions):
+        if len(functions) == 2:
+            first, second = functions
+            return lambda root: first(root) or second(root)
+
+        def function(root):
+            for sub_function in functions:
+                if sub_function(root):
+                    return True
+            return False
+        return function
+
+    def _compile_and(self, functions):
+        if len(functions) == 2:
+            first, second = functions
+            return lambda root: first(root) and second(root)
+
+        def function(root):
+            for sub_function in functions:
+                if not sub_function(root):
+                    return False
+            return True
+        return function
+
+    def _compile_leaf(self, condition):
+        '''Leaf node - comparison of a value found in the element and
+        a literal. Values of different types never meet the condition.
+        '''
+
+        if condition.op not in self._operators:
+            raise Exception("Operator missing!")
+        function = self._compile_comparison(condition)
+        if self._profile is not None:
+            return self._profile.leaf(QueryOptimizer.describe(condition),
+                                      function)
+        return function
+
+    def _compile_comparison(self, condition):
+        literal = condition.literal
+        missing = self.MISSING
+        compare = self._operators[condition.op]
+        if condition.op == Operators.IN:
+            numbers = frozenset(item for item in literal
+                                if type(item) == float)
+            strings = frozenset(item for item in literal
+                                if type(item) != float)
+
+        if self._values is not None and condition.element in self._values:
+            value = self.compile_cached(condition.element)
+            if condition.op == Operators.IN:
+                def function(root):
+                    check = value(root)
+                    if check is missing:
+                        return False
+                    if check[2] is None:
+                        return check[1] in strings
+                    return check[2] in numbers
+            elif type(literal) == float:
+                def function(root):
+                    check = value(root)
+                    if check is missing or check[2] is None:
+                        return False
+                    return compare(check[2], literal)
+            else:
+                def function(root):
+                    check = value(root)
+                    if check is missing or check[2] is not None:
+                        return False
+                    return compare(check[1], literal)
+            return function
+
+        value = self.compile_value(condition.element)
+        if self._profile is not None:
+            value = self._profile.lookups(value, self.MISSING)
+        if condition.op == Operators.IN:
+            def function(root):
+                check = value(root)
+                if check is missing:
+                    return False
+                try:
+                    check = float(check)
+                except:
+                    return check in strings
+                return check in numbers
+        elif type(literal) == float:
+            def function(root):
+                check = value(root)
+                if check is missing:
+                    return False
+                try:
+                    check = float(check)
+                except:
+                    return False
+                return compare(check, literal)
+        else:
+            def function(root):
+                check = value(root)
+                if check is missing:
+                    return False
+                try:
+                    float(check)
+                except:
+                    return compare(check, literal)
+                return False
+        return function
+
+    def compile_cached(self, element):
+        '''Returns function finding entry (node, text, number) of element
+        in the root element (see compile_value and ValueCache), MISSING
+        if there is no such node. The entry is shared by all leaves with
+        the element.
+        '''
+
+        attribute = element.attribute
+        first = PATH_CACHE.get(element.name, attribute).first
+        current = self._values.current(element)
+        missing = self.MISSING
+
+        def value(root):
+            if root is current[0]:
+                return current[1]
+            node = first(root)
+            if node is None:
+                entry = missing
+            else:
+                if attribute is not None:
+                    text = node.attrib[attribute]
+                elif len(node) != 0:
+                    raise FormatError("An element contains subelements instead of text")
+                else:
+                    text = node.text
+                try:
+                    entry = (node, text, float(text))
+                except (TypeError, ValueError):
+                    entry = (node, text, None)
+            current[0] = root
+            current[1] = entry
+            return entry
+
+        if self._profile is not None:
+            return self._profile.cached_lookups(value, current, missing)
+        return value
+
+    def compile_value(self, element):
+        '''Returns function finding text or attribute given by element
+        (class Element) in the root element or its subelements.
+        '''
+
+        attribute = element.attribute
+        first = PATH_CACHE.get(element.name, attribute).first
+        missing = self.MISSING
+
+        if attribute is None:
+            def value(root):
+                found = first(root)
+                if found is None:
+                    return missing
+                if len(found) != 0:
+                    raise FormatError("An element contains subelements instead of text")
+                return found.text
+        else:
+            def value(root):
+                found = first(root)
+                if found is None:
+                    return missing
+                return found.attrib[attribute]
+        return value
+
+
+class TagIndex:
+    '''Index of an XML file stored next to it (filename + SUFFIX).
+    For every tag and attribute name it contains sorted byte offsets of
+    elements - where the element starts and where its tail ends (next tag).
+    Such part of file can be parsed alone (element()), so a query needs to
+    read only its candidates instead of the whole document.
+    Index is not used if the file was changed (size or mtime).
+    '''
+
+    SUFFIX = ".xqi"
+    MAGIC = b"XQRINDEX1\n"
+    RUN = 1024 * 1024
+
+    def __init__(self, path, header, data_offset):
+        self.path = path
+        self._header = header
+        self._data_offset = data_offset # where arrays start in index file
+        self._arrays = {} # loaded arrays (kind, name) -> (starts, ends)
+        self._xml = None # input opened for reading of fragments
+
+    @classmethod
+    def build(cls, path):
+        '''Parses XML file path and writes its index.'''
+
+        try:
+            stat = os.stat(path)
+            xml_input = open(path, "rb")
+        except:
+            raise InputError("Input file couldn't be opened.")
+
+        tags = {} # name -> (starts, ends)
+        attributes = {}
+        stack = [] # open elements - [(ends, index in ends), ...]
+        closed = [] # elements waiting for end of their tail
+        info = {"root": None, "fragments": True}
+        parser = xml.parsers.expat.ParserCreate()
+
+        def close_tails():
+            position = parser.CurrentByteIndex
+            for positions in closed:
+                for ends, i in positions:
+                    ends[i] = position
+            del closed[:]
+
+        def start(name, attrs):
+            close_tails()
+            position = parser.CurrentByteIndex
+            if info["root"] is None:
+                info["root"] = [name, position]
+            arrays = [tags.setdefault(name, (array.array("q"),
+                                             array.array("q")))]
+            for attribute in attrs:
+                if attribute == "xmlns" or attribute.startswith("xmlns:"):
+                    info["fragments"] = False # prefixes out of fragment
+                arrays.append(attributes.setdefault(
+                    attribute, (array.array("q"), array.array("q"))))
+            positions = []
+            for starts, ends in arrays:
+                starts.append(position)
+                ends.append(0) # set when the tail ends
+                positions.append((ends, len(ends) - 1))
+            stack.append(positions)
+
+        def end(name):
+            close_tails()
+            closed.append(stack.pop())
+
+        def doctype(*args):
+            info["fragments"] = False # entities may be declared
+
+        def declaration(version, encoding, standalone):
+            if encoding is not None and encoding.lower() not in ("utf-8",
+                                                                 "utf8"):
+                info["fragments"] = False # fragments are parsed as UTF-8
+
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.StartDoctypeDeclHandler = doctype
+        parser.XmlDeclHandler = declaration
+        try:
+            while True:
+                data = xml_input.read(1024 * 1024)
+                parser.Parse(data, not data)
+                if not data:
+                    break
+        except xml.parsers.expat.ExpatError:
+            raise FormatError("Given XML is not valid")
+        finally:
+            xml_input.close()
+        for positions in closed: # root has no tail
+            for ends, i in positions:
+                ends[i] = stat.st_size
+
+        header = {
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "byteorder": sys.byteorder,
+            "root": info["root"],
+            "fragments": info["fragments"],
+        }
+        offset = 0
+        for kind, names in (("tags", tags), ("attributes", attributes)):
+            header[kind] = {}
+            for name, (starts, ends) in names.items():
+                header[kind][name] = [offset, len(starts)]
+                offset += 2 * len(starts) * starts.itemsize
+
+        try:
+            index_file = open(path + cls.SUFFIX, "wb")
+        except:
+            raise OutputError("Index file couldn't be opened.")
+        try:
+            index_file.write(cls.MAGIC)
+            index_file.write(json.dumps(header).encode("utf-8") + b"\n")
+            for names in (tags, attributes):
+                for starts, ends in names.values():
+                    starts.tofile(index_file)
+                    ends.tofile(index_file)
+        finally:
+            index_file.close()
+
+    @classmethod
+    def open(cls, path):
+        '''Returns TagIndex of XML file path, None if there is no index
+        or it is out of date.
+        '''
+
+        try:
+            stat = os.stat(path)
+            with open(path + cls.SUFFIX, "rb") as index_file:
+                if index_file.readline() != cls.MAGIC:
+                    return None
+                header = json.loads(index_file.readline().decode("utf-8"))
+                data_offset = index_file.tell()
+        except (OSError, ValueError):
+            return None
+        if header["mtime"] != stat.st_mtime_ns or header["size"] != stat.st_size:
+            return None
+        return cls(path, header, data_offset)
+
+    def _load(self, kind, name):
+        '''Returns (starts, ends) arrays for tag or attribute name.'''
+
+        key = (kind, name)
+        if key not in self._arrays:
+            starts = array.array("q")
+            ends = array.array("q")
+            if name in self._header[kind]:
+                offset, count = self._header[kind][name]
+                with open(self.path + self.SUFFIX, "rb") as index_file:
+                    index_file.seek(self._data_offset + offset)
+                    starts.fromfile(index_file, count)
+                    ends.fromfile(index_file, count)
+                if self._header["byteorder"] != sys.byteorder:
+                    starts.byteswap()
+                    ends.byteswap()
+            self._arrays[key] = (starts, ends)
+        return self._arrays[key]
+
+    def spans(self, query):
+        '''Returns list of (start, end) of candidates for query (elements
+        SELECTed FROM its context, in document order). None if the index
+        can\'t be used for query.
+        '''
+
+        if not self._header["fragments"]:
+            return None
+        if query.from_ is None: # empty output
+            return []
+        root_tag, root_start = self._header["root"]
+
+        if query.from_ == "ROOT" or query.from_.name == root_tag:
+            if query.from_ == "ROOT" and query.select == root_tag:
+                return None # whole document is a candidate
+            context = (root_start, self._header["size"])
+        else:
+            context = self._context(query.from_, root_start)
+            if context is None:
+                return []
+
+        starts, ends = self._load("tags", query.select)
+        first = bisect.bisect_right(starts, context[0])
+        last = bisect.bisect_left(starts, context[1])
+        spans = list(zip(starts[first:last], ends[first:last]))
+        for i in range(1, len(spans)):
+            if spans[i][0] < spans[i - 1][1]:
+                return None # nested candidates share their elements
+        return spans
+
+    def _context(self, from_, root_start):
+        '''(start, end) of the first element (not root) matching FROM
+        element from_, None if there is no such element.
+        '''
+
+        if from_.attribute is None:
+            starts, ends = self._load("tags", from_.name)
+            others = None
+        elif from_.name is None:
+            starts, ends = self._load("attributes", from_.attribute)
+            others = None
+        else:
+            starts, ends = self._load("tags", from_.name)
+            others = self._load("attributes", from_.attribute)[0]
+        for i in range(bisect.bisect_right(starts, root_start), len(starts)):
+            if others is not None:
+                j = bisect.bisect_left(others, starts[i])
+                if j == len(others) or others[j] != starts[i]:
+                    continue
+            return (starts[i], ends[i])
+        return None
+
+    def elements(self, spans):
+        '''Parses elements (with their tails) from given parts of XML file.
+        Adjacent parts are parsed together, up to RUN bytes at once.
+        '''
+
+        if self._xml is None:
+            self._xml = open(self.path, "rb")
+        i = 0
+        while i < len(spans):
+            start, end = spans[i]
+            i += 1
+            while (i < len(spans) and spans[i][0] == end and
+                    end - start < self.RUN):
+                end = spans[i][1]
+                i += 1
+            self._xml.seek(start)
+            parser = ET.XMLParser(encoding="utf-8")
+            parser.feed(b"<xqr>")
+            parser.feed(self._xml.read(end - start))
+            parser.feed(b"</xqr>")
+            for element in parser.close():
+                yield element
+
+    def close(self):
+        if self._xml is not None:
+            self._xml.close()
+            self._xml = None
+
+
+class ValueIndex:
+    '''In-memory index of values of an Element (e.g. "price" or ".id") in
+    all <select> elements of a document, used to find elements possibly
+    meeting a leaf condition of WHERE clause without evaluating it on every
+    element (see Document.create_index). Kinds of index:
+        "equal" - hash of values (Operators.EQUAL)
+        "range" - sorted numeric values (Operators.GREATER, LESS)
+        "contains" - trigrams of string values (Operators.CONTAINS)
+    Lookups return sets of ordinals - positions of elements in document
+    order (self.elements).
+    '''
+
+    KINDS = ("equal", "range", "contains")
+    GRAM = 3
+
+    def __init__(self, elements, element, kinds=("equal", "range")):
+        '''elements are all <select> elements in document order, element
+        is the indexed Element.
+        '''
+
+        self.elements = elements
+        self.element = element
+        self.kinds = kinds
+        self.usable = True # False if the value is not text of an element
+        self._equal = {} # value (float or string) -> set of ordinals
+        self._numbers = [] # sorted numeric values
+        self._numbers_ordinals = [] # ordinals in the same order
+        self._grams = {} # trigram -> set of ordinals
+        self._has_none = False # element without text found
+        self._build()
+
+    def _build(self):
+        value = WhereCompiler().compile_value(self.element)
+        numbers = []
+        for ordinal, el in enumerate(self.elements):
+            try:
+                check = value(el)
+            except FormatError: # must be reported by the query itself
+                self.usable = False
+                return
+            if check is WhereCompiler.MISSING:
+                continue
+            try:
+                check = float(check)
+            except:
+                if check is None:
+                    self._has_none = True
+                    continue
+                if "contains" in self.kinds:
+                    for i in range(len(check) - self.GRAM + 1):
+                        self._grams.setdefault(check[i:i + self.GRAM],
+                                               set()).add(ordinal)
+            else:
+                if check == check: # not NaN
+                    numbers.append((check, ordinal))
+            if "equal" in self.kinds:
+                self._equal.setdefault(check, set()).add(ordinal)
+        if "range" in self.kinds:
+            numbers.sort()
+            self._numbers = [number for number, ordinal in numbers]
+            self._numbers_ordinals = [ordinal for number, ordinal in numbers]
+
+    def lookup(self, op, literal):
+        '''Returns set of ordinals of elements which may meet condition
+        "element op literal", None if this index can\'t be used.
+        '''
+
+        if not self.usable:
+            return None
+        if op == Operators.EQUAL and "equal" in self.kinds:
+            return set(self._equal.get(literal, ()))
+        if op == Operators.IN and "equal" in self.kinds:
+            found = set()
+            for item in literal:
+                found.update(self._equal.get(item, ()))
+            return found
+        if type(literal) == float and "range" in self.kinds:
+            if op == Operators.GREATER:
+                first = bisect.bisect_right(self._numbers, literal)
+                return set(self._numbers_ordinals[first:])
+            if op == Operators.LESS:
+                last = bisect.bisect_left(self._numbers, literal)
+                return set(self._numbers_ordinals[:last])
+        if (op == Operators.CONTAINS and "contains" in self.kinds and
+                len(literal) >= self.GRAM and not self._has_none):
+            found = None
+            for i in range(len(literal) - self.GRAM + 1):
+                ordinals = self._grams.get(literal[i:i + self.GRAM], set())
+                found = ordinals if found is None else found & ordinals
+                if not found:
+                    return set()
+            return set(found)
+        return None
+
+
+class InputReader:
+    '''Binary XML input. Regular files of at least MMAP_SIZE bytes are
+    memory-mapped and read() returns views of the mapping, so blocks get
+    to expat without decoding or copying. Already parsed part of the
+    mapping is released (madvise), so the mapping doesn't add the whole
+    file to the resident memory. Pipes, stdin and small files are read
+    from the buffered binary stream by BLOCK bytes.
+    Compressed input (Codecs) is recognized by its magic bytes and is
+    decompressed by a ReadAhead thread.
+    '''
+
+    MMAP_SIZE = 4 * 1024 * 1024
+    BLOCK = 64 * 1024
+    RELEASE = 1024 * 1024 # madvise granularity
+
+    def __init__(self, raw, name=None, owned=True):
+        '''raw is a binary file, owned tells whether close() closes it.'''
+
+        self.name = name
+        self.compressed = None # name of codec (Codecs)
+        self._file = raw
+        self._raw = raw
+        self._owned = owned
+        self._detect = True # magic bytes not checked yet
+        self._map = None
+        self._view = None
+        self._position = 0
+        self._released = 0
+        try:
+            info = os.fstat(raw.fileno())
+            if not stat.S_ISREG(info.st_mode):
+                return
+            self._start(os.pread(raw.fileno(), Codecs.MAGIC_SIZE, 0))
+            if (self.compressed is None and
+                    info.st_size >= self.MMAP_SIZE):
+                self._map = mmap.mmap(raw.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+                self._view = memoryview(self._map)
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    self._map.madvise(mmap.MADV_SEQUENTIAL)
+        except (OSError, ValueError): # not a real file, mmap not possible
+            pass
+
+    @classmethod
+    def open(cls, filename):
+        '''Opens input file given by filename.'''
+
+        try:
+            return cls(open(filename, "rb"), filename)
+        except:
+            raise InputError("Input file couldn't be opened.")
+
+    @classmethod
+    def stdin(cls):
+        '''Reader of standard input (not closed by close()).'''
+
+        return cls(getattr(sys.stdin, "buffer", sys.stdin), owned=False)
+
+    def _start(self, magic):
+        '''Starts decompression if magic (beginning of input) belongs to
+        a compressed format.
+        '''
+
+        self._detect = False
+        codec = Codecs.detect(magic)
+        if codec is not None:
+            self.compressed = codec
+            self._raw = ReadAhead(Codecs.reader(codec, self._file))
+
+    @staticmethod
+    def parser():
+        '''ElementTree parser for the input (encoding is taken from
+        the XML declaration, UTF-8 by default).
+        '''
+
+        return ET.XMLParser()
+
+    @property
+    def mapped(self):
+        return self._view is not None
+
+    def read(self, size=-1):
+        '''Reads up to size bytes (BLOCK at least), b"" at the end.'''
+
+        if size is not None and 0 <= size < self.BLOCK:
+            size = self.BLOCK
+        if self._view is None:
+            if self._detect: # pipe, stdin
+                peek = getattr(self._raw, "peek", None)
+                self._start(peek(Codecs.MAGIC_SIZE)[:Codecs.MAGIC_SIZE]
+                            if peek is not None else b"")
+            return self._raw.read(size)
+        start = self._position
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(start + size, len(self._view))
+        self._position = end
+        self._release(start)
+        return self._view[start:end]
+
+    def _release(self, position):
+        '''Drops pages before position (already parsed) from memory.'''
+
+        position -= position % mmap.PAGESIZE
+        if (position - self._released >= self.RELEASE and
+                hasattr(mmap, "MADV_DONTNEED")):
+            self._map.madvise(mmap.MADV_DONTNEED, self._released,
+                              position - self._released)
+            self._released = position
+
+    def close(self):
+        if self._view is not None:
+            try:
+                self._view.release()
+                self._map.close()
+            except BufferError: # block still referenced (unfinished parse)
+                pass
+            self._view = None
+            self._map = None
+        if self._raw is not self._file:
+            self._raw.close()
+        if self._owned:
+            self._file.close()
+
+
+class Codecs:
+    '''Compression formats of input and output files. Input is recognized
+    by magic bytes, output by file extension.
+    '''
+
+    # (name, magic bytes, extension)
+    FORMATS = (
+        ("gzip", b"\x1f\x8b", ".gz"),
+        ("bz2", b"BZh", ".bz2"),
+        ("xz", b"\xfd7zXZ\x00", ".xz"),
+    )
+    MAGIC_SIZE = 6
+
+    @classmethod
+    def detect(cls, magic):
+        '''Name of format starting with magic, None if not compressed.'''
+
+        for name, start, extension in cls.FORMATS:
+            if magic.startswith(start):
+                return name
+        return None
+
+    @classmethod
+    def by_extension(cls, filename):
+        '''Name of format given by extension of filename or None.'''
+
+        for name, start, extension in cls.FORMATS:
+            if filename.lower().endswith(extension):
+                return name
+        return None
+
+    @staticmethod
+    def reader(name, raw):
+        '''Binary file decompressing raw (raw is not closed with it).'''
+
+        if name == "gzip":
+            return gzip.GzipFile(fileobj=raw, mode="rb")
+        elif name == "bz2":
+            return bz2.BZ2File(raw)
+        else:
+            return lzma.LZMAFile(raw)
+
+    @staticmethod
+    def writer(name, filename, level=None):
+        '''Text file (UTF-8) compressed to filename, level is 1-9
+        (None for default of the format).
+        '''
+
+        if name == "gzip":
+            return gzip.open(filename, "wt", encoding="utf-8",
+                             compresslevel=9 if level is None else level)
+        elif name == "bz2":
+            return bz2.open(filename, "wt", encoding="utf-8",
+                            compresslevel=9 if level is None else level)
+        else:
+            return lzma.open(filename, "wt", encoding="utf-8", preset=level)
+
+
+class ReadAhead:
+    '''Reads binary file (e.g. decompressing one) in a thread, so
+    decompression runs while the parser processes previous blocks.
+    At most DEPTH blocks of BLOCK bytes wait for read().
+    '''
+
+    BLOCK = 256 * 1024
+    DEPTH = 8
+
+    def __init__(self, source):
+        self._source = source
+        self._queue = queue.Queue(self.DEPTH)
+        self._stop = False
+        self._done = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop:
+                data = self._source.read(self.BLOCK)
+                self._put(data)
+                if not data:
+                    return
+        except Exception as e: # corrupted input, passed to read()
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        '''Next decompressed block (size is ignored), b"" at the end.'''
+
+        if self._done:
+            return b""
+        data = self._queue.get()
+        if isinstance(data, Exception):
+            self._done = True
+            raise InputError("Input file couldn't be decompressed.")
+        if not data:
+            self._done = True
+        return data
+
+    def close(self):
+        self._stop = True
+        self._thread.join()
+        self._source.close()
+
+
+class Document:
+    '''Parsed XML document. Any number of queries can be executed over it
+    without parsing it again:
+
+        document = Document.load("input.xml")
+        query = Query.prepare("SELECT book FROM library WHERE price > 100")
+        for element in document.execute(query):
+            ...
+
+    Executing a query doesn\'t modify the document - ORDER BY results
+    are copies of the elements with "order" attribute.
+    '''
+
+    def __init__(self, root):
+        '''root is ElementTree.Element - root of the document.'''
+
+        self.root = root
+        self._indexes = {} # (select, name, attribute) -> ValueIndex
+        self._selected = {} # select -> all <select> elements
+        self._contexts = {} # (select, name, attribute) -> (first, end)
+
+    def create_index(self, select, element, kinds=("equal", "range")):
+        '''Creates ValueIndex of element (string, e.g. "price" or
+        "book.isbn") in <select> elements. Queries SELECTing select with
+        this element in WHERE clause use it (see execute).
+        '''
+
+        where_element = Element()
+        if not where_element.parse(element):
+            raise QueryError("Element not correct.")
+        for kind in kinds:
+            if kind not in ValueIndex.KINDS:
+                raise QueryError("Unknown kind of index: " + kind)
+        if select not in self._selected:
+            self._selected[select] = list(self.root.iter(select))
+        index = ValueIndex(self._selected[select], where_element, kinds)
+        self._indexes[(select, where_element.name,
+                       where_element.attribute)] = index
+        return index
+
+    @classmethod
+    def load(cls, path):
+        '''Parses XML document from file given by path.'''
+
+        xml_input = InputReader.open(path)
+        try:
+            return cls.parse(xml_input)
+        finally:
+            xml_input.close()
+
+    @classmethod
+    def parse(cls, xml_input):
+        '''Parses XML document from opened file xml_input (InputReader
+        or binary file).'''
+
+        try:
+            tree = ET.parse(xml_input, InputReader.parser())
+        except InputError:
+            raise
+        except:
+            raise FormatError("Given XML is not valid")
+        return cls(tree.getroot())
+
+    def execute(self, query):
+        '''Returns iterator of elements meeting query (parsed Query).
+        If WHERE clause contains conditions with indexed elements
+        (create_index), only elements found in the indexes are evaluated.
+        '''
+
+        parser = XMLParser(None, copy_ordered=True)
+        candidates = self._plan(query)
+        if candidates is None: # no index can be used
+            parser.find_in(self.root, query)
+        else:
+            stop = query.limit if query.order_element is None else None
+            match = query.predicate()
+            elements = []
+            if stop != 0:
+                for element in candidates:
+                    if match(element):
+                        elements.append(element)
+                        if len(elements) == stop:
+                            break
+            parser.found(elements, query)
+        return parser.results()
+
+    def _plan(self, query):
+        '''Returns list of candidates (in document order) of query that
+        may meet its WHERE clause according to indexes. None if no index
+        can be used - all candidates must be evaluated.
+        '''
+
+        if query.where is None or query.from_ is None:
+            return None
+        if query.from_ == "ROOT" and query.select == self.root.tag:
+            return None
+        ordinals = self._lookup(query.select, query.where)
+        if ordinals is None:
+            return None
+
+        selected = self._selected[query.select]
+        first, end = self._context(query.select, query.from_)
+        return [selected[ordinal] for ordinal in sorted(ordinals)
+                if first <= ordinal < end]
+
+    def _context(self, select, from_):
+        '''Ordinals (first, end) of <select> elements in context given by
+        from_ (as XMLParser.candidates). Descendants of an element are
+        a continuous part of document order, so only the first one is
+        looked up.
+        '''
+
+        if from_ == "ROOT" or from_.name == self.root.tag:
+            key = (select, None) # the whole document
+        else:
+            key = (select, from_.name, from_.attribute)
+        if key not in self._contexts:
+            if len(key) == 2:
+                context = self.root
+            else:
+                context = self.root.find(PATH_CACHE.get(from_.name,
+                                                        from_.attribute).path)
+            inside = []
+            if context is not None:
+                inside = [element for element in context.iter(select)
+                          if element is not context]
+            if inside:
+                first = self._selected[select].index(inside[0])
+                self._contexts[key] = (first, first + len(inside))
+            else:
+                self._contexts[key] = (0, 0)
+        return self._contexts[key]
+
+    def _lookup(self, select, condition):
+        '''Set of ordinals (ValueIndex) of <select> elements which may meet
+        condition, None if it can\'t be found using indexes.
+        '''
+
+        if condition.n:
+            return None
+        if condition.o: # OR - all sub-conditions must use indexes
+            found = set()
+            for sub_condition in condition.children:
+                ordinals = self._lookup(select, sub_condition)
+                if ordinals is None:
+                    return None
+                found |= ordinals
+            return found
+        elif condition.a: # AND - enough if any sub-condition uses index
+            found = None
+            for sub_condition in condition.children:
+                ordinals = self._lookup(select, sub_condition)
+                if ordinals is not None:
+                    found = ordinals if found is None else found & ordinals
+            return found
+        elif condition.op is None: # only brackets
+            return self._lookup(select, condition.children[0])
+        key = (select, condition.element.name, condition.element.attribute)
+        if key not in self._indexes:
+            return None
+        return self._indexes[key].lookup(condition.op, condition.literal)
+
+
+class ResultWriter:
+    '''Incremental serializer of results. The declaration and the start
+    tag of root_element are written first, every element is serialized
+    as soon as it is passed to element(). Bytes are collected up to
+    BUFFER and written to the binary buffer of output; the first element
+    is flushed immediately so a consumer of the output gets it early.
+    Output is UTF-8 with the declaration, US-ASCII (with character
+    references) without it - as ElementTree.write does. Without
+    root_element, elements after the first one have no declaration and
+    so are written in US-ASCII too.
+    '''
+
+    BUFFER = 1024 * 1024
+
+    def __init__(self, output, root_element=None, declaration=True):
+        # ElementTree's own serializer, without a tree and writer per
+        # element (ET.tostring if its private functions are missing)
+        self._private = (hasattr(ET, "_namespaces") and
+                         hasattr(ET, "_serialize_xml"))
+        self._output = getattr(output, "buffer", output)
+        self._root = root_element
+        self._declaration = declaration
+        self._encoding = "utf-8" if declaration else "us-ascii"
+        self._pending = []
+        self._size = 0
+        self.count = 0
+        if declaration:
+            self._write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+
+    def element(self, element):
+        '''Writes element (with its tail).'''
+
+        if self.count == 0 and self._root is not None:
+            self._write(("<%s>" % self._root).encode("ascii"))
+        if self._private:
+            text = []
+            qnames, namespaces = ET._namespaces(element)
+            ET._serialize_xml(text.append, element, qnames, namespaces, True)
+            text = "".join(text)
+        else:
+            text = ET.tostring(element, encoding="unicode")
+        self._write(text.encode(self._encoding, "xmlcharrefreplace"))
+        self.count += 1
+        if self.count == 1:
+            if self._root is None:
+                self._encoding = "us-ascii"
+            self.flush()
+
+    def close(self):
+        '''Ends root element and flushes the output.'''
+
+        if self._root is not None:
+            if self.count == 0:
+                self._write(("<%s />" % self._root).encode("ascii"))
+            else:
+                self._write(("</%s>" % self._root).encode("ascii"))
+        self.flush()
+
+    def flush(self):
+        if self._pending:
+            self._output.write(b"".join(self._pending))
+            self._pending = []
+            self._size = 0
+        self._output.flush()
+
+    def _write(self, data):
+        self._pending.append(data)
+        self._size += len(data)
+        if self._size >= self.BUFFER:
+            self.flush()
+
+
+class XMLParser:
+    '''Element from XML document (xml_input) that meet
+    the XML query (class Query).
+    '''
+
+    def __init__(self, xml_input, stream=False, copy_ordered=False,
+                 index=None, jobs=1, profile=None):
+        '''stream=True evaluates query while the input is being parsed
+        (see _iterfind), otherwise the whole document is loaded first.
+        copy_ordered=True sets "order" attribute (ORDER BY) on copies of
+        found elements instead of the elements themselves.
+        index is TagIndex of xml_input - only candidates are read if
+        it can be used for the query.
+        jobs > 1 evaluates WHERE clause in jobs processes (ParallelMatcher)
+        when the whole document is loaded.
+        profile (Profile) measures stages of find() and write().
+        '''
+
+        self._source = xml_input
+        self._profile = profile
+        self._stream = stream
+        self._index = index
+        self._jobs = jobs
+        self._copy_ordered = copy_ordered
+        self._elements = []
+        self._ordered = [] # (element, previous "order" attribute)
+
+    def find(self, query):
+        '''Finds all elements from self._source that meet
+        the XML query (query). Result is stored in self._elements.
+        In streaming mode self._elements is an iterator producing results
+        as the input is read.
+        '''
+
+        if self._index is not None:
+            spans = self._index.spans(query)
+            if spans is not None:
+                self._elements = []
+                self._find_spans(spans, query)
+                self._order(query)
+                return
+
+        if self._stream:
+            self._elements = self._iterfind(query)
+            self._order(query)
+            return
+
+        path = getattr(self._source, "name", None)
+        if (self._jobs > 1 and isinstance(path, str) and
+                getattr(self._source, "compressed", None) is None and
+                os.path.isfile(path) and ParallelMatcher.available()):
+            self._enter("parse") # parsing and evaluation in workers
+            try:
+                found = ChunkedParser(path, self._jobs).find(query)
+            finally:
+                self._leave()
+            if found is not None:
+                self._elements = found
+                self._order(query)
+                return
+
+        self._enter("parse")
+        try:
+            document = Document.parse(self._source)
+        finally:
+            self._leave()
+        self.find_in(document.root, query)
+
+    def _enter(self, stage):
+        if self._profile is not None:
+            self._profile.enter(stage)
+
+    def _leave(self):
+        if self._profile is not None:
+            self._profile.leave()
+
+    def _predicate(self, match):
+        '''match (compiled WHERE clause) measured if profiling.'''
+
+        if self._profile is None:
+            return match
+        return self._profile.predicate(match)
+
+    def _timed(self, stage, iterable, counter=None):
+        if self._profile is None:
+            return iterable
+        return self._profile.timed(stage, iterable, counter)
+
+    def results(self):
+        '''Iterator of elements found by find(), in order of output.
+        In streaming mode they are produced as the input is read.
+        '''
+
+        return iter(self._elements)
+
+    def explain(self, query):
+        '''Lines describing query (Query.explain) and how find() would
+        read the input.'''
+
+        lines = query.explain()
+        if self._index is not None and self._index.spans(query) is not None:
+            access = "tag index (only candidates are parsed)"
+        elif self._stream:
+            access = "stream (evaluated while parsing)"
+        elif self._jobs > 1:
+            access = ("parallel chunks or full parse, WHERE in %d processes"
+                      % self._jobs)
+        else:
+            access = "full parse"
+        lines.append("ACCESS " + access)
+        return lines
+
+    def find_in(self, root, query):
+        '''Same as find, root is ElementTree.Element of already parsed
+        document.
+        '''
+
+        self._elements = []
+        self._find_tree(root, query)
+        self._order(query)
+
+    def found(self, elements, query):
+        '''Stores elements already meeting query (found by QuerySet) as
+        results - only ORDER BY and LIMIT are applied.
+        '''
+
+        self._elements = elements
+        self._order(query)
+
+    def _order(self, query):
+        '''ORDER BY and LIMIT of found elements.'''
+
+        if query.order_element is not None:
+            self._enter("sort")
+            try:
+                self._sort(query.order_element, query.order_desc,
+                           query.limit, query.values)
+            finally:
+                self._leave()
+        if query.values is not None: # query is finished
+            query.values.clear()
+
+        self._limit(query.limit)
+
+    def _find_tree(self, root, query):
+        '''Stores all elements meeting the query to self._elements.
+        root is root of the whole document.
+        '''
+
+        # Without ORDER BY the first LIMIT matches are the result, so
+        # searching can stop early.
+        stop = query.limit if query.order_element is None else None
+        match = query.predicate()
+
+        if stop == 0:
+            return
+        candidates = self._timed("scan", self.candidates(root, query),
+                                 "elements_visited")
+        if self._jobs > 1 and ParallelMatcher.available():
+            candidates = list(candidates)
+            if len(candidates) >= ParallelMatcher.MIN_CANDIDATES:
+                matcher = ParallelMatcher(self._jobs)
+                self._enter("where")
+                try:
+                    self._elements = matcher.find(candidates, match, stop)
+                finally:
+                    self._leave()
+                return
+        match = self._predicate(match)
+        for element in candidates:
+            if match(element):
+                self._elements.append(element)
+                if len(self._elements) == stop:
+                    break
+
+    def _find_spans(self, spans, query):
+        '''Same as _find_tree, candidates are read from parts of the input
+        given by spans (TagIndex).
+        '''
+
+        stop = query.limit if query.order_element is None else None
+        match = self._predicate(query.predicate())
+
+        if stop == 0:
+            return
+        for element in self._timed("parse", self._index.elements(spans),
+                                   "elements_visited"):
+            if match(element):
+                self._elements.append(element)
+                if len(self._elements) == stop:
+                    break
+
+    def candidates(self, root, query):
+        '''Returns iterable of elements (in document order) SELECTed FROM
+        context given by query, before WHERE is applied.
+        root is root of the whole document.
+        '''
+
+        if query.from_ is None: # empty output
+            return []
+        elif (query.from_ != "ROOT" and
+                root.tag != query.from_.name):
+            root = root.find(PATH_CACHE.get(query.from_.name,
+                                            query.from_.attribute).path)
+        if root is None:
+            return []
+        candidates = root.iterfind(PATH_CACHE.get(query.select).path)
+        if query.from_ == "ROOT" and query.select == root.tag:
+            candidates = itertools.chain([root], candidates)
+        return candidates
+
+    def _events(self):
+        '''Events ("start" and "end") from iterparse of self._source.'''
+
+        parser = ET.iterparse(self._source, events=("start", "end"),
+                              parser=InputReader.parser())
+        while True:
+            try:
+                event = next(parser)
+            except StopIteration:
+                return
+            except InputError:
+                raise
+            except:
+                raise FormatError("Given XML is not valid")
+            yield event
+
+    def _iterfind(self, query):
+        '''Streaming version of _find_tree. Yields elements meeting
+        the query in document order.
+        A candidate (query.select inside FROM context) is evaluated when
+        it is closed. Elements outside of candidates are detached from
+        their parents and cleared after closing, so only currently
+        evaluated subtrees are kept in memory.
+        '''
+
+        stack = [] # open elements
+        candidates = [] # open candidates, [element, result] items
+        pending = deque() # candidates in document order, not yielded yet
+        context = None # FROM element
+        context_open = False
+        match = self._predicate(query.predicate())
+
+        for event, elem in self._timed("parse", self._events()):
+            # Tail of a closed element is known after the next event.
+            while pending and pending[0][1] is not None:
+                element, result = pending.popleft()
+                if result:
+                    yield element
+
+            if event == "start":
+                if query.from_ is None:
+                    pass
+                elif context_open:
+                    if elem.tag == query.select:
+                        candidate = [elem, None]
+                        candidates.append(candidate)
+                        pending.append(candidate)
+                elif context is None:
+                    if not stack: # root
+                        if (query.from_ == "ROOT" or
+                                elem.tag == query.from_.name):
+                            context = elem
+                            context_open = True
+                            if (query.from_ == "ROOT" and
+                                    query.select == elem.tag):
+                                candidate = [elem, None]
+                                candidates.append(candidate)
+                                pending.append(candidate)
+                    elif ((query.from_.name is None or
+                            elem.tag == query.from_.name) and
+                            (query.from_.attribute is None or
+                            query.from_.attribute in elem.attrib)):
+                        context = elem
+                        context_open = True
+                stack.append(elem)
+            else: # end
+                stack.pop()
+                result = False
+                if candidates and candidates[-1][0] is elem:
+                    if self._profile is not None:
+                        self._profile.add("elements_visited")
+                    result = match(elem)
+                    candidates.pop()[1] = result
+                if elem is context:
+                    context_open = False
+                if not candidates and stack: # not needed by any candidate
+                    stack[-1].remove(elem)
+                    if not result:
+                        elem.clear()
+
+        while pending:
+            element, result = pending.popleft()
+            if result:
+                yield element
+
+    def _limit(self, limit):
+        '''LIMIT - takes only first x (limit) elements.'''
+
+        if limit is not None:
+            if isinstance(self._elements, list):
+                self._elements = self._elements[:limit]
+            else: # input is not read any further after limit is reached
+                self._elements = itertools.islice(self._elements, limit)
+ 
+           
+    def _sort(self, by, desc=False, limit=None, values=None):
+        '''ORDER BY - ordering.
+        by is the Element (may include an attribute) to order by.
+        Uses class SortObject to store elements with found strings.
+        desc says which way to order elements.
+        If limit is given, only first limit elements are kept (top-k
+        selection using a heap instead of sorting all elements).
+        values is ValueCache with values found by WHERE clause.
+        '''
+
+        search = PATH_CACHE.get(by.name, by.attribute)
+        entries = None
+        if values is not None:
+            entries = values.kept(by)
+        if entries is None:
+            entries = {}
+        aux_list = [SortObject(el, self._sort_key(el, by, search,
+                                                  entries.get(el)))
+                    for el in self._elements]
+        key = lambda sort_object: sort_object.string
+
+        # Greater strings go first, equal ones keep document order.
+        # desc reverses this, so equal ones go in reversed document order.
+        if desc:
+            aux_list.reverse()
+            if limit is None:
+                aux_list.sort(key=key)
+            else:
+                aux_list = heapq.nsmallest(limit, aux_list, key=key)
+        else:
+            if limit is None:
+                aux_list.sort(key=key, reverse=True)
+            else:
+                aux_list = heapq.nlargest(limit, aux_list, key=key)
+
+        self._elements = [] # final result
+        index = 1
+        for el_final in aux_list:
+            node = el_final.node
+            if self._copy_ordered:
+                node = ET.Element(node.tag, node.attrib)
+                node.text = el_final.node.text
+                node.tail = el_final.node.tail
+                node.extend(el_final.node)
+            else:
+                self._ordered.append((node, node.get("order")))
+            node.set("order", str(index))
+            self._elements.append(node)
+            index += 1
+
+    def restore(self):
+        '''Restores "order" attributes of elements changed by ORDER BY,
+        so another query can be executed over the same document.
+        '''
+
+        for node, order in reversed(self._ordered):
+            if order is None:
+                del node.attrib["order"]
+            else:
+                node.set("order", order)
+        self._ordered = []
+
+    def _sort_key(self, el, by, search, entry=None):
+        '''Finds string (or float) to order el by, see _sort.
+        search is SearchPath for by, entry is (node, text, number) from
+        ValueCache if el was already searched.
+        '''
+
+        if entry is not None and entry is not WhereCompiler.MISSING:
+            element, string, number = entry
+            return string if number is None else number
+        element = search.first(el)
+        if self._profile is not None:
+            self._profile.add("find_calls")
+        if element is None:
+            raise FormatError("Sort: Element not found")
+        if by.attribute is None:
+            if len(element) != 0:
+                raise FormatError("Sort: An element contains subelements instead of text")
+            string = element.text
+        else:
+            string = element.attrib[by.attribute]
+
+        try: 
+            string = float(string) 
+        except:
+            if self._profile is not None:
+                self._profile.add("float_failures")
+        return string
+
+    def write(self, output, root_element, declaration=True):
+        '''Writes results (self._elements) to given output.
+        root_element wraps all result elements if is not None.
+        If declaration is False, declaration header is not included
+        in output document. Returns number of written elements.
+        '''
+
+        self._enter("write")
+        writer = ResultWriter(output, root_element, declaration)
+        try:
             for el in self._elements:
-                output_root.append(el)
-            if declaration: # include XML declaration
-                output_tree.write(output.buffer, encoding='utf-8', xml_declaration=True)
+                writer.element(el)
+            writer.close()
+        finally:
+            self._leave()
+            if self._profile is not None:
+                self._profile.add("rows_emitted", writer.count)
+        return writer.count
+
+    def _where(self, root, condition):
+        '''Does root meet condition? Returns True if so, False otherwise.
+        Uses recursion to go to leaf nodes and back.
+        find() uses WhereCompiler instead, this interpreter is kept as its
+        reference implementation (see benchmarks/bench_where.py).
+        '''
+        
+        # NEG
+        if condition.n:
+            true = False
+            false = True
+        else:
+            true = True
+            false = False
+
+        if condition.o: # OR
+            for sub_condition in condition.children:
+                if self._where(root, sub_condition):
+                    return true
+            return false
+        elif condition.a: # AND
+            for sub_condition in condition.children:
+                if not self._where(root, sub_condition):
+                    return false
+            return true
+        elif condition.op is None: # only brackets
+            if self._where(root, condition.children[0]):
+                return true
+            else:
+                return false
+        else: # leaf node
+            if condition.element.attribute is None:
+                if root.tag == condition.element.name:
+                    if len(root) != 0:
+                        raise FormatError("An element contains subelements instead of text")
+                    check = root.text
+                else:
+                    element = root.find(".//" + condition.element.name)
+                    if element is None:
+                        return false
+                    if len(element) != 0:
+                        raise FormatError("An element contains subelements instead of text")
+                    check = element.text
+            else:
+                element = None
+                if condition.element.name is not None:
+                    if root.tag == condition.element.name:
+                        element = root.find(".[@" +
+                                           condition.element.attribute + "]")
+                    if element is None: # not found yet, continue searching
+
+                        element = root.find(".//" +
+                                           condition.element.name +
+                                           "[@" +
+                                           condition.element.attribute + "]")
+                        if element is None:
+                            return false
+                else:
+                    element = root.find(".[@" +
+                                       condition.element.attribute + "]")
+                    if element is None: # not found yet, continue searching
+                        element = root.find(".//*[@" + condition.element.attribute + "]")
+                        if element is None:
+                            return false
+                check = element.attrib[condition.element.attribute]
+
+            if condition.op == Operators.IN:
+                try:
+                    check = float(check)
+                except:
+                    pass
+                for literal in condition.literal:
+                    if type(literal) == type(check) and check == literal:
+                        return true
+                return false
+                
+            try: # different types in CONDITION clause -> FALSE
+                check = float(check)
+                if type(condition.literal) != float:
+                    return false
+            except:
+                if type(condition.literal) == float:
+                    return false
+
+            # Comparisons of leafs
+            if condition.op == Operators.GREATER:
+                if check > condition.literal:
+                    return true
+                else:
+                    return false
+            elif condition.op == Operators.LESS:
+                if check < condition.literal:
+                    return true
+                else:
+                    return false
+            elif condition.op == Operators.EQUAL:
+                if check == condition.literal:
+                    return true
+                else:
+                    return false
+            elif condition.op == Operators.CONTAINS:
+                if condition.literal in check:
+                    return true
+                else:
+                    return false
+            else:
+                raise Exception("Operator missing!")
+
+
+class ParallelMatcher:
+    '''Evaluates WHERE clause (compiled predicate) of candidates in a pool
+    of worker processes. Candidates are split into chunks. Workers are
+    forked, so they share the parsed document with this process and send
+    back only positions of matching candidates. Results are merged in
+    document order.
+    '''
+
+    MIN_CANDIDATES = 1000 # fewer candidates are evaluated serially
+    CHUNKS_PER_JOB = 4
+
+    # State of current find(), inherited by forked workers.
+    _candidates = None
+    _match = None
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    @staticmethod
+    def available():
+        '''Can workers be forked on this platform?'''
+
+        return "fork" in multiprocessing.get_all_start_methods()
+
+    def find(self, candidates, match, stop=None):
+        '''Returns candidates meeting match (in document order). Ends
+        after stop candidates are found (if stop is not None).
+        '''
+
+        size = -(-len(candidates) // (self.jobs * self.CHUNKS_PER_JOB))
+        chunks = [(start, min(start + size, len(candidates)))
+                  for start in range(0, len(candidates), size)]
+        found = []
+        ParallelMatcher._candidates = candidates
+        ParallelMatcher._match = match
+        try:
+            context = multiprocessing.get_context("fork")
+            with context.Pool(self.jobs) as pool:
+                for positions, error in pool.imap(ParallelMatcher._chunk,
+                                                  chunks):
+                    for position in positions:
+                        found.append(candidates[position])
+                        if len(found) == stop:
+                            return found
+                    if error is not None:
+                        raise FormatError(error)
+        finally:
+            ParallelMatcher._candidates = None
+            ParallelMatcher._match = None
+        return found
+
+    @staticmethod
+    def _chunk(bounds):
+        '''Worker - returns positions of matching candidates in chunk
+        given by bounds and message of FormatError that stopped the
+        evaluation (None if there was none).
+        '''
+
+        positions = []
+        try:
+            for position in range(*bounds):
+                if ParallelMatcher._match(ParallelMatcher._candidates[position]):
+                    positions.append(position)
+        except FormatError as e:
+            return positions, e.value
+        return positions, None
+
+
+class ChunkedParser:
+    '''Parses and queries a record-oriented XML file
+    (<root><record>...</record><record>...</record>...</root>) in worker
+    processes. The file is memory-mapped and split into chunks at starts
+    of top-level records, every worker parses its chunk alone and returns
+    elements meeting the query.
+    A wrong split point (e.g. a record nested in a record) makes a chunk
+    unparseable, in such case (and for queries with other FROM than root)
+    find() returns None and the document has to be parsed as a whole.
+    '''
+
+    MIN_SIZE = 8 * 1024 * 1024 # smaller files are not split
+    MAX_CHUNK = 64 * 1024 * 1024
+    CHUNKS_PER_JOB = 4
+    _tag_re = re.compile(rb"<([a-zA-Z_][a-zA-Z_\-0-9]*)")
+    _xmlns_re = re.compile(rb"\sxmlns\s*[=:]")
+
+    def __init__(self, path, jobs):
+        self.path = path
+        self.jobs = jobs
+
+    def find(self, query):
+        '''Returns elements meeting query (in document order, ORDER BY and
+        LIMIT are not applied). None if the file can\'t be split.
+        '''
+
+        try:
+            with open(self.path, "rb") as xml_input:
+                if os.fstat(xml_input.fileno()).st_size < self.MIN_SIZE:
+                    return None
+                data = mmap.mmap(xml_input.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            chunks = self._split(data, query)
+        finally:
+            data.close()
+        if chunks is None:
+            return None
+
+        stop = query.limit if query.order_element is None else None
+        tasks = [(self.path, start, end, query.text, stop)
+                 for start, end in chunks]
+        found = []
+        context = multiprocessing.get_context("fork")
+        with context.Pool(self.jobs) as pool:
+            for elements, error in pool.imap(ChunkedParser._chunk, tasks):
+                if elements is None: # chunk can\'t be parsed alone
+                    return None
+                for element in elements:
+                    found.append(element)
+                    if len(found) == stop:
+                        return found
+                if error is not None:
+                    raise FormatError(error)
+        return found
+
+    def _split(self, data, query):
+        '''Returns list of (start, end) of chunks of records, None if
+        the document or query is not suitable.
+        '''
+
+        bounds = self.bounds(data, query)
+        if bounds is None:
+            return None
+        root_tag, content_start, content_end = bounds
+        record = self._tag_re.search(data, content_start, content_end)
+        if record is None:
+            return None
+        record_tag = record.group(0)
+        size = content_end - content_start
+        count = max(self.jobs * self.CHUNKS_PER_JOB,
+                    -(-size // self.MAX_CHUNK))
+        chunk_size = -(-size // count)
+
+        points = [content_start]
+        position = record.start() + chunk_size
+        while position < content_end:
+            position = data.find(record_tag, position, content_end)
+            if position == -1:
+                break
+            after = data[position + len(record_tag):
+                         position + len(record_tag) + 1]
+            if after in (b">", b"/", b" ", b"\t", b"\n", b"\r"):
+                points.append(position)
+                position += chunk_size
+            else:
+                position += len(record_tag)
+        points.append(content_end)
+        return list(zip(points[:-1], points[1:]))
+
+    @classmethod
+    def bounds(cls, data, query):
+        '''Returns (root tag, start, end) of content of the root element
+        of document data, None if the document or query is not suitable
+        for parsing records alone.
+        '''
+
+        # Root start tag
+        root = cls._tag_re.search(data, 0, 64 * 1024)
+        if root is None or data.find(b"<!DOCTYPE", 0, root.start()) != -1:
+            return None
+        root_tag = root.group(1).decode("ascii")
+        if query.from_ is None:
+            return None
+        if query.from_ == "ROOT":
+            if query.select == root_tag:
+                return None
+        elif query.from_.name != root_tag:
+            return None
+        content_start = cls._tag_end(data, root.end())
+        content_end = data.rfind(b"</" + root.group(1))
+        if content_start is None or content_end < content_start:
+            return None
+
+        # Namespaces declared by the root are out of the records (as in
+        # TagIndex.build).
+        if (data[root.end():root.end() + 1] == b":" or
+                cls._xmlns_re.search(data, root.end(), content_start)):
+            return None
+
+        # Chunks are parsed as UTF-8.
+        declaration = re.search(rb"encoding\s*=\s*[\"']([^\"']*)",
+                                data[:root.start()])
+        if (declaration is not None and
+                declaration.group(1).lower() not in (b"utf-8", b"utf8")):
+            return None
+
+        # Declaration, root element and what follows it must be well-formed.
+        parser = ET.XMLParser(encoding="utf-8")
+        try:
+            parser.feed(data[:content_start])
+            parser.feed(data[content_end:])
+            parser.close()
+        except ET.ParseError:
+            return None
+        return root.group(1), content_start, content_end
+
+    @staticmethod
+    def records(path, start, end):
+        '''Parses records of file path from start to end (a part of
+        content of the root element) and returns them wrapped in an element,
+        None if the part is not well-formed alone.
+        '''
+
+        parser = ET.XMLParser(encoding="utf-8")
+        with open(path, "rb") as xml_input:
+            data = mmap.mmap(xml_input.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                parser.feed(b"<xqr>")
+                for position in range(start, end, 1024 * 1024):
+                    parser.feed(data[position:min(position + 1024 * 1024,
+                                                  end)])
+                parser.feed(b"</xqr>")
+                return parser.close()
+            except ET.ParseError:
+                return None
+            finally:
+                data.close()
+
+    @staticmethod
+    def _tag_end(data, position):
+        '''Position after ">" of a start tag (attribute values may contain
+        ">"), None for an empty element tag.
+        '''
+
+        quote = None
+        while position < len(data):
+            char = data[position:position + 1]
+            if quote is not None:
+                if char == quote:
+                    quote = None
+            elif char in (b'"', b"'"):
+                quote = char
+            elif char == b">":
+                if data[position - 1:position] == b"/":
+                    return None
+                return position + 1
+            position += 1
+        return None
+
+    @staticmethod
+    def _chunk(task):
+        '''Worker - parses chunk of records and returns elements meeting
+        query and message of FormatError that stopped the evaluation
+        (None if there was none). Returns (None, None) if the chunk is not
+        well-formed alone.
+        '''
+
+        path, start, end, text, stop = task
+        query = Query.prepare(text)
+        match = query.predicate()
+        records = ChunkedParser.records(path, start, end)
+        if records is None:
+            return None, None
+
+        found = []
+        try:
+            for record in records:
+                for element in record.iter(query.select):
+                    if match(element):
+                        found.append(element)
+                        if len(found) == stop:
+                            return found, None
+        except FormatError as e:
+            return found, e.value
+        return found, None
+
+
+class IncrementalQuery:
+    '''Results of a query over a record-oriented file that is appended to
+    (new records are written before the end tag of the root element, see
+    ChunkedParser). update() parses only records after the offset where
+    the last evaluation ended and merges newly matched elements into
+    the results - appended for queries without ORDER BY, merged into
+    the sorted results (and cut to LIMIT) with ORDER BY.
+    The beginning of the file and WINDOW bytes before the offset are
+    checked by hashes, if they changed, the file is evaluated again as
+    a whole. The state can be stored in a file (--state) and used by
+    the next run.
+    Queries and documents ChunkedParser can't split are always evaluated
+    as a whole.
+    '''
+
+    VERSION = 2 # 1 kept offsets in documents with namespaces
+    WINDOW = 64 * 1024
+
+    def __init__(self, path, query, state_file=None):
+        '''query is an optimized Query.'''
+
+        self.path = path
+        self.query = query
+        self.state_file = state_file
+        self.elements = [] # results in output order
+        self._keys = [] # ORDER BY values of elements
+        self._offset = None # end of evaluated records, None - no state
+        self._root_tag = None
+        self._head = None # hash of the file up to the first record
+        self._window = None # hash of WINDOW bytes before offset
+        self._last = None # last record of the file if it is in elements
+        self._seen = None # (mtime, size) of the file at last update
+        if state_file is not None:
+            self._load()
+
+    def update(self):
+        '''Evaluates changes of the file, returns False if there were
+        none.'''
+
+        try:
+            xml_input = open(self.path, "rb")
+        except OSError:
+            raise InputError("Input file couldn't be opened.")
+        try:
+            info = os.fstat(xml_input.fileno())
+            seen = (info.st_mtime_ns, info.st_size)
+            if seen == self._seen:
+                return False
+            if info.st_size == 0:
+                data = b""
+            else:
+                data = mmap.mmap(xml_input.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            try:
+                changed = self._update(data)
+            finally:
+                if info.st_size != 0:
+                    data.close()
+        finally:
+            xml_input.close()
+        self._seen = seen
+        return changed
+
+    def _update(self, data):
+        if self._offset is not None and self._unchanged(data):
+            end = data.rfind(b"</" + self._root_tag, self._offset)
+            if end == self._offset:
+                return False
+            if end != -1:
+                records = ChunkedParser.records(self.path, self._offset, end)
+                if records is not None:
+                    self._add(records)
+                    self._offset = end
+                    self._window = self._hash(data, end)
+                    return True
+
+        # the whole file, previous results are kept until it is parsed
+        bounds = ChunkedParser.bounds(data, self.query)
+        records = None
+        if bounds is not None:
+            root_tag, start, end = bounds
+            records = ChunkedParser.records(self.path, start, end)
+        if records is None:
+            xml_input = InputReader.open(self.path)
+            try:
+                parser = XMLParser(xml_input, copy_ordered=True)
+                parser.find(self.query)
+                elements = list(parser.results())
+            finally:
+                xml_input.close()
+            self._reset()
+            self.elements = elements
+            return True
+        self._reset()
+        self._add(records)
+        self._root_tag = root_tag
+        self._head = hashlib.sha256(data[:start]).hexdigest()
+        self._offset = end
+        self._window = self._hash(data, end)
+        return True
+
+    def _reset(self):
+        self.elements = []
+        self._keys = []
+        self._offset = None
+        self._last = None
+
+    def _unchanged(self, data):
+        '''Is the evaluated part of the file (probably) the same?'''
+
+        if len(data) < self._offset:
+            return False
+        root = ChunkedParser._tag_re.search(data, 0, 64 * 1024)
+        if root is None:
+            return False
+        start = ChunkedParser._tag_end(data, root.end())
+        return (start is not None and start <= self._offset and
+                hashlib.sha256(data[:start]).hexdigest() == self._head and
+                self._hash(data, self._offset) == self._window)
+
+    def _hash(self, data, end):
+        return hashlib.sha256(data[max(0, end - self.WINDOW):end]).hexdigest()
+
+    def _add(self, records):
+        '''Merges elements of records (parsed part of the file) meeting
+        the query into results.'''
+
+        query = self.query
+        if records.text and self._last is not None:
+            # text before the first new record ends tail of the last one
+            self._last.tail = (self._last.tail or "") + records.text
+        stop = query.limit if query.order_element is None else None
+        match = query.predicate()
+        found = []
+        for record in records:
+            if stop is not None and len(self.elements) + len(found) >= stop:
+                break
+            for element in record.iter(query.select):
+                if match(element):
+                    found.append(element)
+                    if len(self.elements) + len(found) == stop:
+                        break
+        if len(records) != 0:
+            last = records[-1]
+            self._last = last if any(element is last
+                                     for element in found) else None
+
+        if query.order_element is None:
+            self.elements.extend(found)
+            query.values.clear()
+            return
+        by = query.order_element
+        search = PATH_CACHE.get(by.name, by.attribute)
+        entries = query.values.kept(by) or {}
+        parser = XMLParser(None)
+        new = [(parser._sort_key(element, by, search, entries.get(element)),
+                element) for element in found]
+        query.values.clear()
+
+        # The same order as XMLParser._sort, old elements are earlier in
+        # the document than new ones.
+        key = operator.itemgetter(0)
+        old = zip(self._keys, self.elements)
+        if query.order_desc:
+            new.reverse()
+            new.sort(key=key)
+            merged = heapq.merge(new, old, key=key)
+        else:
+            new.sort(key=key, reverse=True)
+            merged = heapq.merge(old, new, key=key, reverse=True)
+        merged = list(itertools.islice(merged, query.limit))
+        self._keys = [value for value, element in merged]
+        self.elements = [element for value, element in merged]
+
+    def write(self, output, root_element, declaration=True):
+        '''Writes results to output (see XMLParser.write).'''
+
+        writer = ResultWriter(output, root_element, declaration)
+        for index, element in enumerate(self.elements, 1):
+            if self.query.order_element is not None:
+                element.set("order", str(index))
+            writer.element(element)
+        writer.close()
+
+    def write_file(self, filename, root_element, declaration=True,
+                   level=None):
+        '''Replaces file filename with results, readers never see
+        a partly written file.'''
+
+        codec = Codecs.by_extension(filename)
+        temporary = filename + ".tmp"
+        try:
+            if codec is None:
+                output = open(temporary, "w", encoding="utf-8")
+            else:
+                output = Codecs.writer(codec, temporary, level)
+        except OSError:
+            raise OutputError("Output file couldn't be opened.")
+        try:
+            self.write(output, root_element, declaration)
+        finally:
+            output.close()
+        os.replace(temporary, filename)
+
+    def save(self):
+        '''Stores the state to state_file.'''
+
+        if self.state_file is None:
+            return
+        elements = []
+        for element in self.elements:
+            tail = element.tail
+            element.tail = None
+            elements.append([ET.tostring(element, encoding="unicode"),
+                             tail, element is self._last])
+            element.tail = tail
+        state = OrderedDict([
+            ("version", self.VERSION),
+            ("path", os.path.realpath(self.path)),
+            ("query", self.query.canonical()),
+            ("offset", self._offset),
+            ("root", None if self._root_tag is None else
+             self._root_tag.decode("ascii")),
+            ("head", self._head),
+            ("window", self._window),
+            ("keys", self._keys),
+            ("elements", elements),
+        ])
+        try:
+            with open(self.state_file + ".tmp", "w",
+                      encoding="utf-8") as state_file:
+                json.dump(state, state_file)
+            os.replace(self.state_file + ".tmp", self.state_file)
+        except OSError:
+            raise OutputError("State file couldn't be written.")
+
+    def _load(self):
+        '''Restores the state from state_file if it belongs to the same
+        file and query.'''
+
+        try:
+            with open(self.state_file, encoding="utf-8") as state_file:
+                state = json.load(state_file)
+        except OSError:
+            return # first run
+        except ValueError:
+            raise InputError("State file is not valid.")
+        if (state.get("version") != self.VERSION or
+                state["path"] != os.path.realpath(self.path) or
+                state["query"] != self.query.canonical() or
+                state["offset"] is None):
+            return
+        for text, tail, last in state["elements"]:
+            element = ET.fromstring(text)
+            element.tail = tail
+            self.elements.append(element)
+            if last:
+                self._last = element
+        self._keys = state["keys"]
+        self._offset = state["offset"]
+        self._root_tag = state["root"].encode("ascii")
+        self._head = state["head"]
+        self._window = state["window"]
+
+
+class QuerySet:
+    '''Several queries evaluated over one document in a single traversal.
+    Queries are grouped by FROM context and SELECT element, every visited
+    element is passed only to predicates of queries interested in it.
+    '''
+
+    def __init__(self, queries):
+        '''queries is a list of parsed Query objects.'''
+
+        self.queries = queries
+
+    def find(self, root):
+        '''Returns list of elements meeting WHERE (in document order) for
+        each query. ORDER BY and LIMIT are not applied (XMLParser.found),
+        but search for a query without ORDER BY ends after LIMIT elements.
+        root is root of the whole document.
+        '''
+
+        results = [[] for query in self.queries]
+        contexts = OrderedDict() # FROM -> [from_, {select: [states]}]
+        remaining = 0 # queries that need more elements
+        for index, query in enumerate(self.queries):
+            stop = query.limit if query.order_element is None else None
+            if query.from_ is None or stop == 0: # empty output
+                continue
+            key = query.context_key()
+            if key not in contexts:
+                contexts[key] = [query.from_, {}]
+            selects = contexts[key][1]
+            selects.setdefault(query.select, []).append(
+                (results[index], query.predicate(), stop))
+            remaining += 1
+
+        waiting = [] # (from_, selects) - FROM contexts not found yet
+        active = [] # (selects, last element of FROM context)
+        ends = {} # last element of FROM context -> contexts
+        for from_, selects in contexts.values():
+            if from_ == "ROOT" or root.tag == from_.name:
+                active.append((selects, root))
+                if from_ == "ROOT" and root.tag in selects:
+                    remaining -= self._dispatch(root, selects[root.tag])
             else:
-                output_tree.write(output.buffer)
-        else:
-            for el in self._elements:
-                output_tree = ET.ElementTree(el) 
-                if declaration: # include XML declaration
-                    output_tree.write(output.buffer, encoding='utf-8', xml_declaration=True)
-                    declaration = False
-                else:
-                    output_tree.write(output.buffer)
+                waiting.append((from_, selects))
+        if remaining == 0:
+            return results
 
+        elements = root.iter()
+        next(elements) # root itself is not in any FROM context
+        for element in elements:
+            for selects, last in active:
+                states = selects.get(element.tag)
+                if states:
+                    remaining -= self._dispatch(element, states)
+                    if remaining == 0:
+                        return results
+            if element in ends: # leaving FROM context
+                del ends[element]
+                active = [context for context in active
+                          if context[1] is not element]
+            if waiting:
+                for context in [context for context in waiting
+                                if self._is_context(element, context[0])]:
+                    waiting.remove(context)
+                    last = element
+                    while len(last) != 0:
+                        last = last[-1]
+                    if last is not element: # context contains elements
+                        context = (context[1], last)
+                        active.append(context)
+                        ends.setdefault(last, []).append(context)
+        return results
 
-    def _where(self, root, condition):
-        '''Does root meet condition? Returns True if so, False otherwise.
-        Uses recursion to go to leaf nodes and back.
+    def _is_context(self, element, from_):
+        '''Is element (not root) the FROM context from_ (class Element)?'''
+
+        return ((from_.name is None or element.tag == from_.name) and
+                (from_.attribute is None or from_.attribute in element.attrib))
+
+    def _dispatch(self, element, states):
+        '''Evaluates predicates of states (queries) for element.
+        Returns number of queries that got all elements they need,
+        these are removed from states.
         '''
-        
-        # NEG
-        if condition.n:
-            true = False
-            false = True
+
+        finished = 0
+        for state in list(states):
+            elements, match, stop = state
+            if match(element):
+                elements.append(element)
+                if len(elements) == stop:
+                    states.remove(state)
+                    finished += 1
+        return finished
+
+
+class Profile:
+    '''Wall time of stages of a query (parse, scan, where, sort, write)
+    and counters, see --profile. With memory, peak memory of stages is
+    traced too (tracemalloc, --profile-memory) - tracing slows Python
+    down several times, so times of such profile are not comparable.
+    Time of a stage doesn't include stages entered from it (e.g. parsing
+    of the streamed input while writing results). Counters of worker
+    processes (--jobs) are not included.
+    '''
+
+    STAGES = ("parse", "scan", "where", "sort", "write")
+    COUNTERS = ("elements_visited", "predicate_evaluations", "find_calls",
+                "float_failures", "rows_emitted")
+
+    def __init__(self, memory=False):
+        self.stages = OrderedDict((name, [0.0, 0]) for name in self.STAGES)
+        self.counters = OrderedDict((name, 0) for name in self.COUNTERS)
+        self.leaves = [] # [condition, evaluations, true]
+        self.memory = memory
+        self._stack = [] # entered stages
+        self._peak = 0
+        if memory:
+            tracemalloc.start()
+        self._start = self._last = time.perf_counter()
+
+    def _switch(self):
+        '''Adds time and peak memory since last switch to current stage.'''
+
+        now = time.perf_counter()
+        peak = 0
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            self._peak = max(self._peak, peak)
+            tracemalloc.reset_peak()
+        if self._stack:
+            stage = self.stages[self._stack[-1]]
+            stage[0] += now - self._last
+            stage[1] = max(stage[1], peak)
+        self._last = now
+
+    def enter(self, name):
+        self._switch()
+        self._stack.append(name)
+
+    def leave(self):
+        self._switch()
+        self._stack.pop()
+
+    def add(self, counter, count=1):
+        self.counters[counter] += count
+
+    def timed(self, name, iterable, counter=None):
+        '''Iterates over iterable, getting items is stage name and
+        counted by counter.'''
+
+        iterator = iter(iterable)
+        while True:
+            self.enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.leave()
+            if counter is not None:
+                self.counters[counter] += 1
+            yield item
+
+    def predicate(self, match):
+        '''match (compiled WHERE clause) running in stage where.'''
+
+        def profiled(element):
+            self.enter("where")
+            try:
+                return match(element)
+            finally:
+                self.leave()
+                self.counters["predicate_evaluations"] += 1
+        return profiled
+
+    def leaf(self, condition, function):
+        '''function of leaf condition (text) counting evaluations.'''
+
+        counts = [condition, 0, 0]
+        self.leaves.append(counts)
+
+        def profiled(root):
+            result = function(root)
+            counts[1] += 1
+            if result:
+                counts[2] += 1
+            return result
+        return profiled
+
+    def lookups(self, value, missing):
+        '''value function (WhereCompiler.compile_value) counting searches
+        and values that are not numbers.'''
+
+        def profiled(root):
+            check = value(root)
+            self.counters["find_calls"] += 1
+            if check is not missing:
+                try:
+                    float(check)
+                except (TypeError, ValueError):
+                    self.counters["float_failures"] += 1
+            return check
+        return profiled
+
+    def cached_lookups(self, value, current, missing):
+        '''Same as lookups for WhereCompiler.compile_cached, only
+        searches of new candidates are counted.'''
+
+        def profiled(root):
+            searched = root is not current[0]
+            entry = value(root)
+            if searched:
+                self.counters["find_calls"] += 1
+                if entry is not missing and entry[2] is None:
+                    self.counters["float_failures"] += 1
+            return entry
+        return profiled
+
+    def report(self, query, jobs=1):
+        '''Profile as a JSON-serializable dictionary.'''
+
+        def kilobytes(size):
+            return round(size / 1024, 1) if self.memory else None
+
+        total = time.perf_counter() - self._start
+        return OrderedDict([
+            ("query", query.text),
+            ("jobs", jobs),
+            ("total_ms", round(total * 1000, 3)),
+            ("peak_memory_kb", kilobytes(self._peak)),
+            ("stages", OrderedDict(
+                (name, OrderedDict([("wall_ms", round(wall * 1000, 3)),
+                                    ("peak_memory_kb", kilobytes(peak))]))
+                for name, (wall, peak) in self.stages.items())),
+            ("counters", self.counters),
+            ("leaves", [OrderedDict([("condition", condition),
+                                     ("evaluations", evaluations),
+                                     ("true", true)])
+                        for condition, evaluations, true in self.leaves]),
+        ])
+
+    def write(self, filename, query, jobs=1):
+        '''Writes report to filename ("" for stderr) and stops tracing.'''
+
+        self._switch()
+        report = json.dumps(self.report(query, jobs), indent=2) + "\n"
+        if self.memory:
+            tracemalloc.stop()
+        if filename == "":
+            sys.stderr.write(report)
+            return
+        try:
+            with open(filename, "w", encoding="utf-8") as profile_file:
+                profile_file.write(report)
+        except OSError:
+            raise OutputError("Profile file couldn't be written.")
+
+
+class ResultCache:
+    '''Serialized results (XML output) of queries keyed by fingerprint of
+    the input file and canonical text of the query (Query.canonical) with
+    options of the output. Entries are kept in memory (at most MEMORY_SIZE
+    bytes, least recently used are dropped) and, if directory is given,
+    in files there (at most DISK_SIZE bytes, oldest files are removed).
+    Entries older than ttl seconds (if not None) are not used.
+    Fingerprint is (path, modification time, size) of the file, or hash
+    of its content if content is True.
+    '''
+
+    MEMORY_SIZE = 64 * 1024 * 1024
+    DISK_SIZE = 256 * 1024 * 1024
+    SUFFIX = ".xqc"
+    BLOCK = 1024 * 1024
+
+    def __init__(self, directory=None, ttl=None, content=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.content = content
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (time, data)
+        self._size = 0 # bytes of data in _entries
+        if directory is not None:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError:
+                raise OutputError("Cache directory couldn't be created.")
+
+    def fingerprint(self, path):
+        '''Fingerprint of input file path.'''
+
+        try:
+            if not self.content:
+                info = os.stat(path)
+                return [os.path.realpath(path), info.st_mtime_ns,
+                        info.st_size]
+            digest = hashlib.sha256()
+            with open(path, "rb") as input_file:
+                for block in iter(lambda: input_file.read(self.BLOCK), b""):
+                    digest.update(block)
+            return digest.hexdigest()
+        except OSError:
+            raise InputError("Input file couldn't be opened.")
+
+    def key(self, fingerprint, query, root_element, header):
+        '''Key of results of query (optimized Query) over input with
+        fingerprint written with root_element and header (XMLParser.write).
+        '''
+
+        return json.dumps([fingerprint, query.canonical(), root_element,
+                           header])
+
+    def get(self, key):
+        '''Cached results (bytes) of key, None if they are not cached.'''
+
+        entry = self._entries.get(key)
+        if entry is not None and self._fresh(entry[0]):
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+        cached = self._open(key)
+        if cached is None:
+            self.misses += 1
+            return None
+        created, cache_file = cached
+        with cache_file:
+            data = cache_file.read()
+        self.hits += 1
+        self._remember(key, created, data)
+        return data
+
+    def write(self, key, output):
+        '''Writes cached results of key to output (file), a file in
+        directory is copied by blocks. Returns False if they are not
+        cached.'''
+
+        output = getattr(output, "buffer", output)
+        entry = self._entries.get(key)
+        if entry is not None and self._fresh(entry[0]):
+            self.hits += 1
+            self._entries.move_to_end(key)
+            output.write(entry[1])
         else:
-            true = True
-            false = False
+            cached = self._open(key)
+            if cached is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+            with cached[1] as cache_file:
+                shutil.copyfileobj(cache_file, output, self.BLOCK)
+        output.flush()
+        return True
 
-        if condition.o: # OR
-            for sub_condition in condition.children:
-                if self._where(root, sub_condition):
-                    return true
-            return false
-        elif condition.a: # AND
-            for sub_condition in condition.children:
-                if not self._where(root, sub_condition):
-                    return false
-            return true
-        elif condition.op is None: # only brackets
-            if self._where(root, condition.children[0]):
-                return true
+    def put(self, key, data):
+        '''Stores results (bytes) of key.'''
+
+        created = time.time()
+        self._remember(key, created, data)
+        if self.directory is None:
+            return
+        path = self._path(key)
+        try:
+            with open(path + ".tmp", "wb") as cache_file:
+                cache_file.write(json.dumps([key, created]).encode() + b"\n")
+                cache_file.write(data)
+            os.replace(path + ".tmp", path)
+            self._prune()
+        except OSError:
+            pass # results are just not cached
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self._entries), "bytes": self._size}
+
+    def _fresh(self, created):
+        return self.ttl is None or time.time() - created <= self.ttl
+
+    def _remember(self, key, created, data):
+        '''Stores entry in memory.'''
+
+        if len(data) > self.MEMORY_SIZE:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old[1])
+        self._entries[key] = (created, data)
+        self._size += len(data)
+        while self._size > self.MEMORY_SIZE:
+            old = self._entries.popitem(last=False)[1] # least recently used
+            self._size -= len(old[1])
+
+    def _path(self, key):
+        name = hashlib.sha256(key.encode()).hexdigest() + self.SUFFIX
+        return os.path.join(self.directory, name)
+
+    def _open(self, key):
+        '''(time, file positioned at data) of key from directory, None
+        if it isn't there or is too old.'''
+
+        if self.directory is None:
+            return None
+        try:
+            cache_file = open(self._path(key), "rb")
+        except OSError:
+            return None
+        try:
+            stored_key, created = json.loads(cache_file.readline().decode())
+        except ValueError:
+            stored_key, created = None, 0
+        if stored_key != key or not self._fresh(created):
+            cache_file.close()
+            return None
+        return created, cache_file
+
+    def _prune(self):
+        '''Removes oldest files of directory over DISK_SIZE.'''
+
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.SUFFIX):
+                info = entry.stat()
+                files.append((info.st_mtime, info.st_size, entry.path))
+                total += info.st_size
+        files.sort()
+        while total > self.DISK_SIZE and files:
+            modified, size, path = files.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+class RecordingOutput:
+    '''Output (for XMLParser.write) writing to output and keeping
+    a copy of written data (up to limit bytes, data is None above it).
+    '''
+
+    def __init__(self, output, limit=ResultCache.MEMORY_SIZE):
+        self._output = getattr(output, "buffer", output)
+        self._blocks = []
+        self._size = 0
+        self._limit = limit
+
+    def write(self, data):
+        self._output.write(data)
+        if self._blocks is not None:
+            self._size += len(data)
+            if self._size > self._limit:
+                self._blocks = None
             else:
-                return false
-        else: # leaf node
-            if condition.element.attribute is None:
-                if root.tag == condition.element.name:
-                    if len(root) != 0:
-                        raise FormatError("An element contains subelements instead of text")
-                    check = root.text
-                else:
-                    element = root.find(".//" + condition.element.name)
-                    if element is None:
-                        return false
-                    if len(element) != 0:
-                        raise FormatError("An element contains subelements instead of text")
-                    check = element.text
+                self._blocks.append(bytes(data))
+
+    def flush(self):
+        self._output.flush()
+
+    @property
+    def data(self):
+        if self._blocks is None:
+            return None
+        return b"".join(self._blocks)
+
+
+class DocumentPool:
+    '''Parsed documents (class Document) kept in memory, at most size
+    of them (least recently used is dropped). A document is parsed again
+    when modification time or size of its file changes.
+    '''
+
+    def __init__(self, size=8):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._documents = OrderedDict() # real path -> (stat key, Document)
+
+    def get(self, path):
+        '''Document parsed from file path.'''
+
+        try:
+            info = os.stat(path)
+        except OSError:
+            raise InputError("Input file couldn't be opened.")
+        key = (info.st_mtime_ns, info.st_size)
+        real_path = os.path.realpath(path)
+        cached = self._documents.get(real_path)
+        if cached is not None and cached[0] == key:
+            self.hits += 1
+            self._documents.move_to_end(real_path)
+            return cached[1]
+        self.misses += 1
+        self._documents.pop(real_path, None)
+        document = Document.load(path)
+        self._documents[real_path] = (key, document)
+        if len(self._documents) > self.size:
+            self._documents.popitem(last=False) # least recently used
+        return document
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._documents), "capacity": self.size}
+
+
+class QueryServer:
+    '''Long-running process answering queries over HTTP (--serve) on TCP
+    port or Unix socket. Documents are kept parsed in DocumentPool.
+
+        GET|POST /query?document=file.xml&query=...[&root=element][&n=1]
+            Results as with --input=file.xml --query=... (--root, -n).
+            document is relative to the working directory of the server.
+        GET /metrics
+            JSON with request counts, latencies and pool statistics.
+
+    Errors are answered with text of the error and header X-XQR-Exit-Code
+    with exit code xqr.py would end with. Requests are served one at
+    a time, a client that doesn't send its request in TIMEOUT seconds
+    is disconnected.
+    '''
+
+    LATENCIES = 1024 # number of recent requests for latency percentiles
+    TIMEOUT = 10 # seconds
+
+    def __init__(self, address, pool, cache=None):
+        '''address is "[host:]port" (host is 127.0.0.1 by default) or path
+        of Unix socket (contains "/"). pool is DocumentPool, results are
+        answered from cache (ResultCache) if it is not None.'''
+
+        self.pool = pool
+        self.cache = cache
+        self.directory = os.path.realpath(os.getcwd())
+        self.requests = 0
+        self.errors = 0
+        self._latencies = deque(maxlen=self.LATENCIES)
+        self._start = time.time()
+        self._socket_path = None
+        handler = self._handler()
+        try:
+            if "/" in address:
+                self._socket_path = address
+                if os.path.exists(address) and stat.S_ISSOCK(
+                        os.stat(address).st_mode):
+                    os.unlink(address) # left by a previous server
+                self._server = UnixHTTPServer(address, handler)
             else:
-                element = None
-                if condition.element.name is not None:
-                    if root.tag == condition.element.name:
-                        element = root.find(".[@" +
-                                           condition.element.attribute + "]")
-                    if element is None: # not found yet, continue searching
+                host, _, port = address.rpartition(":")
+                self._server = http.server.HTTPServer(
+                    (host or "127.0.0.1", int(port)), handler)
+        except ValueError:
+            raise ArgError("Wrong address in --serve.")
+        except OSError:
+            raise OutputError("Server socket couldn't be opened.")
 
-                        element = root.find(".//" +
-                                           condition.element.name +
-                                           "[@" +
-                                           condition.element.attribute + "]")
-                        if element is None:
-                            return false
-                else:
-                    element = root.find(".[@" +
-                                       condition.element.attribute + "]")
-                    if element is None: # not found yet, continue searching
-                        element = root.find(".//*[@" + condition.element.attribute + "]")
-                        if element is None:
-                            return false
-                check = element.attrib[condition.element.attribute]
-                
-            try: # different types in CONDITION clause -> FALSE
-                check = float(check)
-                if type(condition.literal) != float:
-                    return false
-            except:
-                if type(condition.literal) == float:
-                    return false
+    def run(self):
+        '''Serves requests until interrupted (SIGINT, SIGTERM).'''
 
-            # Comparisons of leafs
-            if condition.op == Operators.GREATER:
-                if check > condition.literal:
-                    return true
-                else:
-                    return false
-            elif condition.op == Operators.LESS:
-                if check < condition.literal:
-                    return true
-                else:
-                    return false
-            elif condition.op == Operators.EQUAL:
-                if check == condition.literal:
-                    return true
-                else:
-                    return false
-            elif condition.op == Operators.CONTAINS:
-                if condition.literal in check:
-                    return true
-                else:
-                    return false
+        signal.signal(signal.SIGTERM, self._stop)
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+            if self._socket_path is not None:
+                os.unlink(self._socket_path)
+
+    def _stop(self, signum, frame):
+        raise KeyboardInterrupt
+
+    def execute(self, fields):
+        '''Executes query given by request fields (dict of strings),
+        returns results as XML (bytes).'''
+
+        if "query" not in fields or "document" not in fields:
+            raise ArgError("Both query and document must be entered.")
+        root_element = fields.get("root")
+        if root_element is not None and ELEMENT_NAME_RE.match(
+                root_element) is None:
+            raise ArgError("Wrong root element.")
+        path = os.path.realpath(os.path.join(self.directory,
+                                             fields["document"]))
+        if os.path.commonpath([self.directory, path]) != self.directory:
+            raise InputError("Input file couldn't be opened.")
+
+        query = Query.prepare(fields["query"])
+        header = fields.get("n") != "1"
+        if self.cache is not None:
+            key = self.cache.key(self.cache.fingerprint(path), query,
+                                 root_element, header)
+            data = self.cache.get(key)
+            if data is not None:
+                return data
+        document = self.pool.get(path)
+        output = io.BytesIO()
+        writer = ResultWriter(output, root_element, header)
+        for element in document.execute(query):
+            writer.element(element)
+        writer.close()
+        if self.cache is not None:
+            self.cache.put(key, output.getvalue())
+        return output.getvalue()
+
+    def metrics(self):
+        '''Statistics of the server as a JSON-serializable dictionary.'''
+
+        latencies = sorted(self._latencies)
+        percentiles = OrderedDict()
+        for percent in (50, 90, 99):
+            if latencies:
+                rank = -(-len(latencies) * percent // 100)
+                percentiles["p%d" % percent] = round(
+                    latencies[rank - 1] * 1000, 3)
+        uptime = time.time() - self._start
+        return OrderedDict([
+            ("uptime_s", round(uptime, 1)),
+            ("requests", self.requests),
+            ("errors", self.errors),
+            ("requests_per_s", round(self.requests / uptime, 2)),
+            ("latency_ms", percentiles),
+            ("pool", self.pool.stats()),
+            ("results", None if self.cache is None else self.cache.stats()),
+            ("path_cache", PATH_CACHE.stats()),
+        ])
+
+    def _handler(self):
+        '''Request handler class calling this server.'''
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            timeout = server.TIMEOUT
+
+            def do_GET(self):
+                server._respond(self)
+
+            def do_POST(self):
+                server._respond(self)
+
+            def log_message(self, format, *args):
+                pass # see /metrics
+
+        return Handler
+
+    def _respond(self, handler):
+        '''Answers request of handler.'''
+
+        start = time.perf_counter()
+        url = urllib.parse.urlsplit(handler.path)
+        status, exit_code = 200, 0
+        if url.path == "/metrics":
+            content_type = "application/json"
+            data = (json.dumps(self.metrics(), indent=2) + "\n").encode()
+        elif url.path == "/query":
+            content_type = "application/xml"
+            try:
+                data = self.execute(self._fields(handler, url))
+            except socket.timeout:
+                raise # the client is gone, see TIMEOUT
+            except Exception as e:
+                status, exit_code, data = self.describe(e)
+                content_type = "text/plain; charset=utf-8"
+        else:
+            status, exit_code, data = 404, 1, b"Unknown path.\n"
+            content_type = "text/plain; charset=utf-8"
+
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(data)))
+        if exit_code:
+            handler.send_header("X-XQR-Exit-Code", str(exit_code))
+        handler.end_headers()
+        handler.wfile.write(data)
+        if url.path != "/metrics":
+            self.requests += 1
+            if status != 200:
+                self.errors += 1
+            self._latencies.append(time.perf_counter() - start)
+
+    @staticmethod
+    def _fields(handler, url):
+        '''Fields of query request - from URL and data of POST request.'''
+
+        fields = dict(urllib.parse.parse_qsl(url.query))
+        if handler.command == "POST":
+            try:
+                length = int(handler.headers.get("Content-Length") or 0)
+                if length < 0:
+                    raise ValueError
+                body = handler.rfile.read(length).decode("utf-8")
+            except ValueError:
+                raise ArgError("Wrong Content-Length or body of request.")
+            fields.update(urllib.parse.parse_qsl(body))
+        return fields
+
+    @staticmethod
+    def describe(error):
+        '''HTTP status, exit code and text (bytes) for exception error
+        (called in its except block).'''
+
+        errors = ((ArgError, 400, 1, "Arguments error"),
+                  (InputError, 404, 2, "Input error"),
+                  (OutputError, 500, 3, "Output error"),
+                  (FormatError, 422, 4, "Format error"),
+                  (QueryError, 400, 80, "Query error"))
+        for error_class, status, exit_code, kind in errors:
+            if isinstance(error, error_class):
+                text = "%s: %s\n" % (kind, error.value)
+                return status, exit_code, text.encode("utf-8")
+        return 500, 80, traceback.format_exc().encode("utf-8")
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    '''HTTPServer listening on a Unix socket.'''
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+class Task:
+    '''Query over one input file executed by TaskRunner.'''
+
+    __slots__ = ("number", "input_name", "query", "root_element", "header",
+                 "params", "result", "error")
+
+    def __init__(self, input_name, query, root_element=None, header=True):
+        self.number = None # line of tasks file
+        self.input_name = input_name
+        self.query = query # text of query
+        self.root_element = root_element
+        self.header = header
+        self.params = None # Params of line of tasks file (--output)
+        self.result = None # XML (bytes)
+        self.error = None # (exit code, message) if the task failed
+
+    @classmethod
+    def from_line(cls, line, number):
+        '''Task from line of tasks file (--tasks), None for an empty line.
+        A line that can't be parsed gives a task with error.'''
+
+        try:
+            argv = shlex.split(line, comments=True)
+        except ValueError:
+            argv = None
+        if argv == []:
+            return None
+        task = cls(None, None)
+        task.number = number
+        try:
+            if argv is None:
+                raise ArgError("Wrong quoting.")
+            task.params = Params()
+            task.params.get_line_args(argv, with_input=True)
+        except Exception as e:
+            task.error = QueryServer.describe(e)[1:]
+            return task
+        task.input_name = task.params.input_name
+        task.query = task.params.query
+        task.root_element = task.params.root_element
+        task.header = task.params.header
+        return task
+
+
+class TaskRunner:
+    '''Executes queries over many (small) input files concurrently
+    (--tasks). Input files are read by IO_THREADS threads, parsing and
+    evaluation runs in jobs worker processes (a thread if jobs is 1), so
+    reading of next files overlaps with queries. At most pending tasks
+    are in progress, next tasks are not taken from the source until
+    a result is consumed (backpressure).
+    Results come in order of completion.
+
+        runner = TaskRunner(jobs=4)
+        async for task in runner.results(tasks):
+            ... task.result or task.error
+    '''
+
+    IO_THREADS = 4
+
+    def __init__(self, jobs=1, pending=None):
+        self.jobs = jobs
+        self.pending = pending if pending is not None else 4 * jobs
+
+    def run(self, lines, output):
+        '''Executes tasks from lines of tasks file and writes results
+        (to --output of a task or to output). Failed tasks are reported
+        to stderr, returns exit code of the first one (0 if all succeeded).
+        '''
+
+        return asyncio.run(self._run(lines, output))
+
+    async def _run(self, lines, output):
+        tasks = (Task.from_line(line, number)
+                 for number, line in enumerate(lines, 1))
+        exit_code = 0
+        async for task in self.results(task for task in tasks
+                                       if task is not None):
+            if task.error is None:
+                if task.params.output is sys.stdout:
+                    task.params.output = output
+                target = getattr(task.params.output, "buffer",
+                                 task.params.output)
+                try:
+                    target.write(task.result)
+                    target.flush()
+                except OSError:
+                    task.error = QueryServer.describe(
+                        OutputError("Output couldn't be written."))[1:]
+            if task.params is not None:
+                task.params.cleanup()
+            if task.error is not None:
+                sys.stderr.write("Tasks file, line %d: %s" % (
+                    task.number, task.error[1].decode("utf-8")))
+                exit_code = exit_code or task.error[0]
+        return exit_code
+
+    async def results(self, tasks):
+        '''Executes tasks (iterable of Task), yields them with result or
+        error as they complete.'''
+
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.pending)
+        done = asyncio.Queue()
+        running = 0
+        iterator = iter(tasks)
+        with concurrent.futures.ThreadPoolExecutor(
+                self.IO_THREADS) as io_pool, self._workers() as workers:
+
+            async def produce():
+                nonlocal running, failure
+                try:
+                    while True:
+                        await slots.acquire()
+                        # the source may block (e.g. tasks from a pipe)
+                        task = await loop.run_in_executor(io_pool, next,
+                                                          iterator, None)
+                        if task is None:
+                            break
+                        running += 1
+                        future = loop.create_task(
+                            self._execute(task, io_pool, workers))
+                        future.add_done_callback(done.put_nowait)
+                except Exception as e:
+                    failure = e # raised by the consumer
+                finally:
+                    done.put_nowait(None)
+
+            failure = None
+            producer = loop.create_task(produce())
+            ended = False
+            try:
+                while running or not ended:
+                    future = await done.get()
+                    if future is None:
+                        if failure is not None:
+                            raise failure
+                        ended = True
+                        continue
+                    running -= 1
+                    yield future.result()
+                    slots.release()
+            finally:
+                producer.cancel()
+
+    def _workers(self):
+        '''Executor of parsing and evaluation.'''
+
+        if self.jobs > 1:
+            # Reading threads are running, so workers are not forked from
+            # this process; tasks and results are bytes and strings.
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
             else:
-                raise Exception("Operator missing!")
+                context = multiprocessing.get_context("spawn")
+            return concurrent.futures.ProcessPoolExecutor(self.jobs, context)
+        return concurrent.futures.ThreadPoolExecutor(1)
+
+    async def _execute(self, task, io_pool, workers):
+        if task.error is not None:
+            return task
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.run_in_executor(io_pool, self._read,
+                                              task.input_name)
+            task.result = await loop.run_in_executor(
+                workers, TaskRunner._query, data, task.query,
+                task.root_element, task.header)
+        except Exception as e:
+            task.error = QueryServer.describe(e)[1:]
+        return task
+
+    @staticmethod
+    def _read(input_name):
+        '''Whole (decompressed) content of input file.'''
+
+        xml_input = InputReader.open(input_name)
+        try:
+            blocks = []
+            while True:
+                block = xml_input.read()
+                if not block:
+                    return b"".join(blocks)
+                blocks.append(bytes(block))
+        finally:
+            xml_input.close()
+
+    @staticmethod
+    def _query(data, text, root_element, header):
+        '''Worker - executes query text over XML data, returns results.'''
+
+        query = Query.prepare(text)
+        parser = XMLParser(io.BytesIO(data))
+        parser.find(query)
+        output = io.BytesIO()
+        parser.write(output, root_element, header)
+        return output.getvalue()
 
 
 '''Definition of Error classes:''' 
@@ -773,11 +4588,101 @@ def main():
     try:
         params = Params()
         params.get_args()
-        query = Query(params.query)
-        query.parse()
-        xmlparser = XMLParser(params.xml_input)
-        xmlparser.find(query)
-        xmlparser.write(params.output, params.root_element, params.header)
+        if params.serve is not None:
+            cache = ResultCache(params.cache, params.cache_ttl,
+                                params.cache_hash)
+            QueryServer(params.serve, DocumentPool(params.pool), cache).run()
+            return
+        if params.tasks is not None:
+            runner = TaskRunner(params.jobs, params.pending)
+            err_code = runner.run(params.tasks, sys.stdout)
+            return
+        if params.build_index:
+            TagIndex.build(params.input_name)
+            if params.query is None and params.batch is None:
+                return
+        if params.batch is not None:
+            document = Document.parse(params.xml_input)
+            params.batch.run(document)
+        else:
+            query = Query(params.query)
+            query.parse()
+            query.optimize()
+            if params.state is not None or params.watch is not None:
+                incremental = IncrementalQuery(params.input_name, query,
+                                               params.state)
+                if params.watch is None:
+                    incremental.update()
+                    incremental.write(params.output, params.root_element,
+                                      params.header)
+                    incremental.save()
+                    return
+                try:
+                    failed = None # message of the last failed update
+                    while True:
+                        # the file can be in the middle of a write, the
+                        # last results are kept and it is read again
+                        try:
+                            changed = incremental.update()
+                        except (InputError, FormatError, OSError) as e:
+                            message = "%s: %s\n" % (
+                                "Format error" if isinstance(e, FormatError)
+                                else "Input error",
+                                getattr(e, "value", e))
+                            if message != failed:
+                                sys.stderr.write(message)
+                            failed = message
+                            changed = False
+                        else:
+                            failed = None
+                        if changed:
+                            incremental.write_file(
+                                params.output_name, params.root_element,
+                                params.header, params.level)
+                            incremental.save()
+                        time.sleep(params.watch)
+                except KeyboardInterrupt:
+                    return
+            cache = None
+            if (params.cache is not None and not params.explain and
+                    params.profile is None):
+                cache = ResultCache(params.cache, params.cache_ttl,
+                                    params.cache_hash)
+                key = cache.key(cache.fingerprint(params.input_name), query,
+                                params.root_element, params.header)
+                if cache.write(key, params.output): # input is not parsed
+                    return
+            index = None
+            if (params.input_name is not None and
+                    params.xml_input.compressed is None):
+                index = TagIndex.open(params.input_name)
+            profile = None
+            if params.profile is not None:
+                profile = Profile(params.profile_memory)
+                query.instrument(profile)
+            xmlparser = XMLParser(params.xml_input, params.stream,
+                                  index=index, jobs=params.jobs,
+                                  profile=profile)
+            try:
+                if params.explain:
+                    for line in xmlparser.explain(query):
+                        params.output.write(line + "\n")
+                else:
+                    xmlparser.find(query)
+                    if cache is None:
+                        xmlparser.write(params.output, params.root_element,
+                                        params.header)
+                    else:
+                        output = RecordingOutput(params.output)
+                        xmlparser.write(output, params.root_element,
+                                        params.header)
+                        if output.data is not None:
+                            cache.put(key, output.data)
+            finally:
+                if index is not None:
+                    index.close()
+                if profile is not None:
+                    profile.write(params.profile, query, params.jobs)
 
     except ArgError as e:
         sys.stderr.write("Arguments error: " + e.value + "\n")
@@ -800,8 +4705,11 @@ def main():
         err_code = 80
     finally:
         params.cleanup()
+        if params.batch is not None:
+            params.batch.cleanup()
         exit(err_code)
 
 
-main()
+if __name__ == "__main__":
+    main()
 